@@ -1,25 +1,30 @@
 import logging
 import time
-import threading
-import uuid
-from queue import Queue, Empty
 import os
+from pathlib import Path
 from flask import Flask, request, render_template, Response, send_from_directory
 import redis
-from arxiv_translator import translate, TranslatorConfig
-from pathlib import Path
-import time
+from arxiv_translator import TranslatorConfig
+from arxiv_translator.metrics import MetricsRegistry
+from arxiv_translator.job_queue import RedisJobQueue, JOB_DONE, EVENT_END
+from arxiv_translator.log_utils import setup_logging
+from arxiv_translator.file_utils import extract_arxiv_id, probe_arxiv_source, SOURCE_FORMAT_PDF, UnsupportedSourceError
 
 # --- 基本設定 ---
 APP = Flask(__name__)
 
-# 並列実行の上限数
-CONCURRENCY_LIMIT = 2
+# ジョブキューに使う Redis. 翻訳は `arxiv-translate worker` で起動したワーカーが実行する.
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# 翻訳に使うモデル
+MODEL = "gpt-4o"
+# ログのストリーミングで、新しいログを待つ最大時間(ミリ秒). この間に何も無ければハートビートを送る.
+SSE_BLOCK_MS = 15000
+# 1つの接続を保つ最大秒数. 過ぎたら閉じ、ブラウザが Last-Event-ID を付けて再接続する.
+SSE_MAX_SECONDS = 300
+# ブラウザが再接続するまでの待ち時間(ミリ秒)
+SSE_RETRY_MS = 1000
 
 translator_config = TranslatorConfig.load()
-OPENAI_API_KEY = translator_config.openai_api_key
-WORKING_DIR    = translator_config.working_dir
-TEMPLATE_DIR   = translator_config.template_dir
 OUTPUT_DIR     = translator_config.output_dir
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -27,191 +32,18 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 def setup_global_logger() -> logging.Logger:
     """
     グローバルロガーを作成する関数
+    ハンドラーはルートロガーに1度だけ設定する (リロードなどで何度呼ばれてもログが重複しない)
 
     Returns:
         logging.Logger: ログ出力用のロガー
     """
-    logger = logging.getLogger("global")
-    logger.setLevel(logging.INFO)
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
+    setup_logging()
+    return logging.getLogger("global")
 
 global_logger = setup_global_logger()
 
-class JobQueueHandler(logging.Handler):
-    """
-    ログレコードをジョブ専用のキューへ出力するハンドラー
-
-    Attributes:
-        queue (Queue): ログメッセージを格納するキュー
-    """
-    def __init__(self, queue: Queue):
-        """
-        コンストラクタ
-
-        Args:
-            queue (Queue): ログを送信するキュー
-        """
-        super().__init__()
-        self.queue = queue
-
-    def emit(self, record):
-        """
-        ログレコードをキューへ出力する
-
-        Args:
-            record (logging.LogRecord): ログレコード
-        """
-        try:
-            msg = self.format(record)
-            self.queue.put(msg)
-        except Exception:
-            self.handleError(record)
-
-class JobQueues:
-    """
-    ジョブ管理クラス
-    各ジョブに対し、キュー、ロガー、arxiv_id を一元管理し、さらに並列実行のスロット管理も行う。
-
-    Attributes:
-        queues (dict): {job_id: Queue} の辞書
-        loggers (dict): {job_id: logger} の辞書
-        arxiv_ids (dict): {job_id: arxiv_id} の辞書
-        parent_logger (logging.Logger): 親ロガー
-        redis_conn (redis.Redis): Redis 接続オブジェクト
-        concurrency_limit (int): 同時実行可能なジョブ数の上限
-        _lock (threading.Lock): スレッドセーフな操作用ロック
-    """
-    def __init__(self,
-                 parent_logger: logging.Logger,
-                 redis_conn: redis.client.Redis,
-                 concurrency_limit: int
-                 ):
-        """
-        コンストラクタ
-
-        Args:
-            parent_logger (logging.Logger): 親となるグローバルロガー
-            redis_conn (redis.Redis): Redis 接続オブジェクト
-            concurrency_limit (int): 同時実行可能なジョブ数の上限
-        """
-        self.queues = {}
-        self.loggers = {}
-        self.arxiv_ids = {}
-        self._lock = threading.Lock()
-        self.parent_logger = parent_logger
-        self.redis_conn = redis_conn
-        self.concurrency_limit = concurrency_limit
-
-    def set(self, job_id: str, arxiv_id: str = None):
-        """
-        指定した job_id に対し、ジョブ用のキューとロガーを作成し、内部に登録する。
-
-        Args:
-            job_id (str): ジョブ固有の識別子
-            arxiv_id (str, optional): 対応する arxiv_id。デフォルトは None
-
-        Returns:
-            tuple: (Queue, logger, arxiv_id)
-        """
-        with self._lock:
-            queue = Queue()
-            self.queues[job_id] = queue
-
-            logger = self.parent_logger.getChild(job_id)
-            logger.setLevel(logging.INFO)
-            job_handler = JobQueueHandler(queue)
-            job_handler.setLevel(logging.INFO)
-            formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-            job_handler.setFormatter(formatter)
-            logger.addHandler(job_handler)
-            self.loggers[job_id] = logger
-
-            self.arxiv_ids[job_id] = arxiv_id
-
-            return queue, logger, arxiv_id
-
-    def get(self, job_id: str) -> tuple:
-        """
-        指定した job_id に関連するキュー、ロガー、arxiv_id を取得する
-
-        Args:
-            job_id (str): ジョブ固有の識別子
-
-        Returns:
-            tuple: (Queue or None, logger or None, arxiv_id or None)
-        """
-        with self._lock:
-            return self.queues.get(job_id), self.loggers.get(job_id), self.arxiv_ids.get(job_id)
-
-    def release(self, job_id: str):
-        """
-        指定した job_id に関連するリソース（キュー、ロガー、arxiv_id）を削除し、
-        並列実行カウントを減少させる
-
-        Args:
-            job_id (str): ジョブ固有の識別子
-        """
-        with self._lock:
-            logger = self.loggers.get(job_id)
-            arxiv_id = self.arxiv_ids.get(job_id)
-            if logger:
-                logger.info(f"release: {job_id} (arxiv_id: {arxiv_id})")
-            self.decrement_slot()
-            self.queues.pop(job_id, None)
-            self.loggers.pop(job_id, None)
-            self.arxiv_ids.pop(job_id, None)
-
-    def current_slots(self) -> int:
-        """
-        現在の並列実行数を取得する
-
-        Returns:
-            int: 現在の並列実行数
-        """
-        current = self.redis_conn.get("running_count")
-        return int(current) if current else 0
-
-    def increment_slot(self):
-        """
-        並列実行カウントを 1 増加させる
-        """
-        self.redis_conn.incr("running_count")
-
-    def decrement_slot(self):
-        """
-        並列実行カウントを 1 減少させる
-        """
-        self.redis_conn.decr("running_count")
-
-    def acquire_slot(self, job_id: str):
-        """
-        利用可能なスロットが確保できるまで待機し、スロットを確保する
-
-        Args:
-            job_id (str): ジョブ固有の識別子
-        """
-        _, logger, arxiv_id = self.get(job_id)
-        while True:
-            current = self.current_slots()
-            if current < self.concurrency_limit:
-                self.increment_slot()
-                if self.current_slots() <= self.concurrency_limit:
-                    logger.info(f"Queue acquired for {arxiv_id} (current running: {current})")
-                    break
-                else:
-                    self.decrement_slot()
-            logger.info(f"Queue waiting for {arxiv_id} (currently running: {current})")
-            time.sleep(1)
-
 # Redis 接続およびジョブキューのインスタンス生成
-global_job_queues = JobQueues(parent_logger=global_logger,
-                              redis_conn=redis.Redis(),
-                              concurrency_limit=CONCURRENCY_LIMIT)
+global_job_queue = RedisJobQueue(redis.Redis.from_url(REDIS_URL), logger=global_logger)
 
 
 
@@ -246,76 +78,90 @@ def dummy_translate(arxiv_id: str, logger: logging.Logger) -> str:
     logger.info("COMPLETED!")
     return pdf_url
 
-def process_translate(arxiv_id: str, job_id: str) -> str:
+def format_sse(data: str, event_id: str = None, event: str = None) -> str:
     """
-    各ジョブごとに翻訳処理を実行する関数。
-    1. ジョブ用のリソース（キュー、ロガー）をセットアップ
-    2. スロットの確保を行い translate 関数を実行
-    3. 最後にリソースを解放する
+    サーバー送信イベントを1つ組み立てる。複数行のデータは行ごとに data: を付ける。
 
     Args:
-        arxiv_id (str): 対象の arxiv_id
-        job_id (str): ジョブ固有の識別子
+        data (str): 送るデータ
+        event_id (str, optional): イベントの ID (再接続時に Last-Event-ID として返ってくる)
+        event (str, optional): イベントの種類. 指定がなければ message
 
     Returns:
-        str: 生成された PDF の URL
+        str: サーバー送信イベント
     """
-    global_job_queues.set(job_id, arxiv_id)
-    _, logger, arxiv_id = global_job_queues.get(job_id)
-
-    result = None
-    try:
-        global_job_queues.acquire_slot(job_id)
-    except Exception:
-        logger.error("FAILED: キューの登録失敗")
-    try:
-        result = translate(arxiv_id, 
-                           template_dir   = TEMPLATE_DIR,
-                           working_dir    = WORKING_DIR,
-                           output_dir     = OUTPUT_DIR,
-                           openai_api_key = OPENAI_API_KEY,
-                           model          = "gpt-4o",
-                           logger         = logger)
-        if isinstance(result, Path):
-            result = Path("/pdf") / result.name
-            logger.info(f"PDF_LINK: {result}")
-        else:
-            logger.error("FAILED.")
-    except Exception as e:
-            logger.error(e)
-    finally:
-        time.sleep(1)
-        global_job_queues.release(job_id)
-    return result
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines += [f"data: {line}" for line in (data.splitlines() or [""])]
+    return "\n".join(lines) + "\n\n"
 
 @APP.route('/logs')
 def stream_logs():
     """
     ログのストリーミングを行うエンドポイント
-    クエリパラメータ job_id に紐付くログキューからデータを取得し、サーバー送信イベントとして返す。
+    クエリパラメータ job_id に紐付くログを Redis Stream から読み出し、サーバー送信イベントとして返す。
+    各イベントには Stream の ID を付けるので、再接続時は Last-Event-ID の続きから送る。
+    ジョブが終了したら end イベントを送ってストリームを閉じる。
+    新しいログが無い間だけハートビートを送り、SSE_MAX_SECONDS を過ぎたら接続を閉じて再接続させる。
 
     Returns:
         Response: サーバー送信イベント形式のレスポンス
     """
     job_id = request.args.get("job_id")
-    queue, _, _ = global_job_queues.get(job_id)
-    if not job_id or not queue:
+    if not job_id or global_job_queue.get(job_id) is None:
         return "job_id が不正です.", 400
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
+
+    def generate(last_id: str):
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            events = global_job_queue.read_logs(job_id, last_id, block_ms=SSE_BLOCK_MS)
+            if not events:
+                if global_job_queue.get(job_id) is None:
+                    # ジョブの記録が期限切れで消えている
+                    yield format_sse("", event="end")
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for last_id, event in events:
+                if event.get("type") == EVENT_END:
+                    yield format_sse(event.get("status", ""), event_id=last_id, event="end")
+                    return
+                yield format_sse(event.get("message", ""), event_id=last_id)
+    return Response(generate(last_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def find_translated_pdf(arxiv_id: str) -> str:
+    """
+    翻訳済みの PDF があればその URL を返す。
+    同じモデルで完了したジョブの結果を優先し、無ければ OUTPUT_DIR に出力済みの PDF を探す。
 
-    def generate():
-        while True:
-            try:
-                message = queue.get(timeout=0.5)
-                yield f"data: {message}\n\n"
-            except Empty:
-                yield "data: \n\n"
-    return Response(generate(), mimetype="text/event-stream")
+    Args:
+        arxiv_id (str): 正規化済みの arxiv_id
+
+    Returns:
+        str: PDF の URL。無ければ None
+    """
+    job = global_job_queue.find(arxiv_id, model=MODEL)
+    if job is not None and job["status"] == JOB_DONE and job.get("result"):
+        filename = job["result"].removeprefix("/pdf/")
+        if (Path(OUTPUT_DIR) / filename).exists():
+            return job["result"]
+    filename = f"{arxiv_id}_ja.pdf"
+    if (Path(OUTPUT_DIR) / filename).exists():
+        return f"/pdf/{filename}"
+    return None
 
 @APP.route('/translate', methods=['GET', 'POST'])
 def translate_route():
     """
     翻訳処理のエンドポイント
-    POST リクエスト時には、ジョブ ID を生成し、バックグラウンドスレッドで処理を開始する。
+    POST リクエスト時には、ジョブを Redis のジョブキューに登録する。翻訳はワーカーが実行する。
+    同じ arxiv_id とモデルのジョブが実行中ならそのジョブのログに合流し、翻訳済みなら既存の PDF を返す。
     GET リクエスト時には、ジョブ ID を表示するテンプレートを返す。
 
     Returns:
@@ -325,10 +171,50 @@ def translate_route():
     arxiv_id = ""
     if request.method == 'POST':
         arxiv_id = request.form.get('arxiv_id')
-        job_id = str(uuid.uuid4())
-        threading.Thread(target=process_translate, args=(arxiv_id, job_id)).start()
+        try:
+            arxiv_id = extract_arxiv_id(arxiv_id)
+        except ValueError as e:
+            return render_template('translate.j2', job_id=job_id, arxiv_id=arxiv_id, error=str(e))
+
+        # 翻訳済みなら PDF をそのまま返す
+        pdf_url = find_translated_pdf(arxiv_id)
+        if pdf_url is not None:
+            return render_template('translate.j2', job_id=job_id, arxiv_id=arxiv_id, pdf_url=pdf_url)
+
+        # 実行中のジョブがあれば、ソースを確認せずにそのジョブに合流する
+        job = global_job_queue.find(arxiv_id, model=MODEL)
+        # 完了済みでも PDF が見つからなければ(削除された場合など)、失敗したジョブと同じく登録し直す
+        pdf_missing = job is not None and job["status"] == JOB_DONE
+        if pdf_missing:
+            global_logger.info("完了済みのジョブの PDF が見つからないので、翻訳し直します: %s (arxiv_id: %s)", job["job_id"], arxiv_id)
+            job = None
+        if job is None:
+            # 翻訳できないソース(PDFのみの投稿など)はジョブを登録する前に弾く
+            try:
+                if probe_arxiv_source(arxiv_id, logger=global_logger) == SOURCE_FORMAT_PDF:
+                    raise UnsupportedSourceError("PDFのみの投稿なのでtexソースがありません。")
+            except ValueError as e:
+                return render_template('translate.j2', job_id=job_id, arxiv_id=arxiv_id, error=str(e))
+            except Exception as e:
+                global_logger.warning("ソースの形式を確認できませんでした: %s", e)
+        job_id, attached = global_job_queue.submit(arxiv_id, model=MODEL, replace_done=pdf_missing)
+        if attached:
+            global_logger.info("実行中のジョブに合流します: %s (arxiv_id: %s)", job_id, arxiv_id)
     return render_template('translate.j2', job_id=job_id, arxiv_id=arxiv_id)
 
+@APP.route('/metrics')
+def metrics():
+    """
+    Prometheus 形式のメトリクスを返すエンドポイント
+    翻訳ジョブはワーカーで実行されるので、各ワーカーが Redis に集計した値の合計を返す。
+    ワーカーごとの値は `arxiv-translate worker --metrics_port` で公開される。
+
+    Returns:
+        Response: Prometheus のテキスト形式のレスポンス
+    """
+    registry = MetricsRegistry.from_redis(global_job_queue.redis_conn, key=f"{global_job_queue.prefix}:metrics")
+    return Response(registry.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 @APP.route('/pdf/')
 def list_pdfs():
     try:
@@ -1,5 +1,6 @@
 """init"""
 from .translator import translate
-from .openai_chat import OpenAIChat
+from .openai_chat import OpenAIChat, AsyncOpenAIChat
 from .tex_compiler import compile_tex
-from .config import TranslatorConfig 
+from .config import TranslatorConfig
+from .translation_cache import TranslationCache
@@ -0,0 +1,512 @@
+"""OpenAIのBatch APIを使ったまとめ翻訳"""
+
+import hashlib
+import json
+import logging
+import shutil
+import time
+from dataclasses import replace
+from pathlib import Path
+from jinja2 import Environment, FileSystemLoader
+from .config import TranslatorConfig
+from .file_utils import extract_arxiv_id
+from .metrics import JobMetrics, MAX_REPORTS
+from .openai_chat import OpenAIChat, get_client
+from .source_store import ArxivSourceStore
+from .tex_validator import TranslationValidationError, validate_translation
+from .translation_cache import TranslationCache
+from .compile_repair import CompileRepairer
+from .translator import prepare_source, split_tex_dir, write_translated_chunks, compile_and_export, is_skip_chunk, extract_translation, RETRY_TEMPERATURE
+from .workspace import Workspace
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 1つのバッチに入れられるリクエスト数の上限 (Batch APIの制限)
+MAX_REQUESTS_PER_BATCH = 50000
+# 終了したバッチの状態
+TERMINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# 1つのチャンクを送信する回数の上限. 失敗・検証エラーのチャンクは1度だけ次のバッチで送り直す
+MAX_BATCH_ATTEMPTS = 2
+
+# 論文ごとの状態
+PAPER_PENDING = "pending"
+PAPER_PREPARED = "prepared"
+PAPER_COMPILED = "compiled"
+PAPER_FAILED = "failed"
+
+def default_batch_name(arxiv_ids: list, model: str) -> str:
+    """arxiv_idの集合とモデルから決まるバッチ名. 同じ指定で実行し直せば同じバッチを再開する。"""
+    digest = hashlib.sha1("\n".join(sorted(set(arxiv_ids))).encode("utf-8")).hexdigest()[:12]
+    return f"{model}-{digest}"
+
+def _custom_id(arxiv_id: str, file_index: int, chunk_index: int) -> str:
+    return f"{arxiv_id}:{file_index}:{chunk_index}"
+
+def _parse_custom_id(custom_id: str) -> tuple:
+    arxiv_id, file_index, chunk_index = custom_id.rsplit(":", 2)
+    return arxiv_id, int(file_index), int(chunk_index)
+
+class BatchState:
+    """バッチの状態. JSONで保存し、再起動後はそこから再開する。
+
+    チャンクごとの翻訳結果は論文数に比例して大きくなるので、状態のJSONには入れず、
+    隣の`results.jsonl`に1行ずつ追記する (保存のたびに全体を書き直さない)。
+
+    Attributes:
+        path (Path): 状態ファイルのパス
+        results_path (Path): 翻訳結果を追記するファイルのパス
+        data (dict): 状態
+    """
+
+    def __init__(self, path: Path, logger: logging.Logger = LOGGER):
+        self.path = Path(path)
+        self.results_path = self.path.with_name("results.jsonl")
+        self._logger = logger
+        # 最後の行が追記の途中で切れているとき、次の追記の前に改行を入れる
+        self._truncated = False
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            self._logger.info("保存されたバッチの状態から再開します: %s", self.path)
+        else:
+            self.data = {"papers": {}, "batches": [], "created_at": time.time()}
+        # 以前の形式では結果も状態のJSONに入っていた
+        self._results = self.data.pop("results", {})
+        self._load_results()
+
+    def _load_results(self):
+        if not self.results_path.exists():
+            return
+        with self.results_path.open(encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                self._truncated = not line.endswith("\n")
+                try:
+                    custom_id, translated_chunk = json.loads(line)
+                except ValueError:
+                    # 追記の途中で落ちた行は読み飛ばす (そのチャンクは送り直す)
+                    self._logger.warning("翻訳結果の壊れた行を読み飛ばしました: %s", self.results_path)
+                    continue
+                if translated_chunk is None:
+                    self._results.pop(custom_id, None)
+                else:
+                    self._results[custom_id] = translated_chunk
+
+    @property
+    def papers(self) -> dict:
+        """{arxiv_id: 論文ごとの状態}"""
+        return self.data["papers"]
+
+    @property
+    def batches(self) -> list:
+        """送信したバッチのリスト"""
+        return self.data["batches"]
+
+    @property
+    def results(self) -> dict:
+        """{custom_id: 翻訳済みのチャンク}. 変更は`add_results`・`discard_results`で行う"""
+        return self._results
+
+    def _append_results(self, results: dict):
+        if not results:
+            return
+        self.results_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.results_path.open("a", encoding="utf-8") as f:
+            if self._truncated:
+                f.write("\n")
+                self._truncated = False
+            f.write("".join(json.dumps([custom_id, translated_chunk], ensure_ascii=False) + "\n"
+                            for custom_id, translated_chunk in results.items()))
+
+    def add_results(self, results: dict):
+        """翻訳結果を追加して、結果のファイルに追記する。
+
+        Args:
+            results (dict): {custom_id: 翻訳済みのチャンク}
+        """
+        self._append_results(results)
+        self._results.update(results)
+
+    def discard_results(self, arxiv_id: str):
+        """論文の翻訳結果を捨てる. 準備をやり直してチャンクが変わる場合に使う。"""
+        prefix = f"{arxiv_id}:"
+        discarded = {custom_id: None for custom_id in self._results if custom_id.startswith(prefix)}
+        self._append_results(discarded)
+        for custom_id in discarded:
+            del self._results[custom_id]
+
+    def save(self):
+        """状態を保存する。書き込み途中で落ちても壊れないよう、一時ファイルから置き換える。"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = self.path.with_suffix(".part")
+        part_path.write_text(json.dumps(self.data, ensure_ascii=False), encoding="utf-8")
+        part_path.replace(self.path)
+
+def _prepare_paper(arxiv_id: str,
+                   paper: dict,
+                   state: BatchState,
+                   config: TranslatorConfig,
+                   jinja_env: Environment,
+                   translator: OpenAIChat,
+                   workspace: Workspace,
+                   source_store: ArxivSourceStore,
+                   cache: TranslationCache,
+                   metrics: JobMetrics,
+                   logger: logging.Logger):
+    """論文のソースを準備してチャンクに分け、キャッシュにあるものは結果に入れておく。"""
+    tex_dir, main_tex_path, _, manifest = prepare_source(arxiv_id, config, jinja_env,
+                                                         source_store=source_store,
+                                                         workspace=workspace,
+                                                         metrics=metrics,
+                                                         logger=logger)
+    chunks_by_file = split_tex_dir(tex_dir, translator, metrics=metrics,
+                                   main_tex_path=main_tex_path, manifest=manifest, logger=logger)
+    paper["main_tex_path"] = str(main_tex_path)
+    paper["files"] = [{"path": str(path), "chunks": chunks} for path, chunks in chunks_by_file.items()]
+    results = {}
+    hits = 0
+    for file_index, file in enumerate(paper["files"]):
+        for chunk_index, tex_chunk in enumerate(file["chunks"]):
+            custom_id = _custom_id(arxiv_id, file_index, chunk_index)
+            if is_skip_chunk(tex_chunk):
+                results[custom_id] = tex_chunk
+                continue
+            if cache is not None:
+                cached = cache.get(cache.make_key(translator.model, translator.render_prompt(tex_chunk)))
+                # 検証を導入する前に保存されたものもあるので、キャッシュも検証する (`_lookup_cache`と同じ)
+                if cached is not None and not validate_translation(tex_chunk, cached):
+                    results[custom_id] = cached
+                    hits += 1
+    state.add_results(results)
+    paper["status"] = PAPER_PREPARED
+    logger.info("バッチ用に準備しました: %s (チャンク %d 個, キャッシュヒット %d 件)",
+                arxiv_id, sum(len(file["chunks"]) for file in paper["files"]), hits)
+
+def _write_batch_inputs(state: BatchState,
+                        batch_dir: Path,
+                        translator: OpenAIChat,
+                        max_requests_per_batch: int,
+                        logger: logging.Logger,
+                        max_attempts: int = MAX_BATCH_ATTEMPTS) -> int:
+    """結果の無いチャンクを、JSONLのリクエストファイルに書き出してバッチとして登録する。
+
+    結果を取り込んでいないバッチに入っているチャンクと、`max_attempts`回送信したチャンクは飛ばす。
+    送り直すチャンクは、`translate_chunk`の再試行と同じくtemperatureを上げて送る。
+
+    Returns:
+        int: 書き出したリクエスト数
+    """
+    attempts = {}
+    in_flight = set()
+    for batch in state.batches:
+        for custom_id in batch["custom_ids"]:
+            attempts[custom_id] = attempts.get(custom_id, 0) + 1
+            if not batch["collected"]:
+                in_flight.add(custom_id)
+    requests = []
+    retried = 0
+    for arxiv_id, paper in state.papers.items():
+        if paper["status"] != PAPER_PREPARED:
+            continue
+        for file_index, file in enumerate(paper["files"]):
+            for chunk_index, tex_chunk in enumerate(file["chunks"]):
+                custom_id = _custom_id(arxiv_id, file_index, chunk_index)
+                if custom_id in state.results or custom_id in in_flight or attempts.get(custom_id, 0) >= max_attempts:
+                    continue
+                retry = custom_id in attempts
+                retried += retry
+                requests.append({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": {
+                        "model": translator.model,
+                        "messages": [{"role": "user", "content": translator.render_prompt(tex_chunk)}],
+                        "temperature": RETRY_TEMPERATURE if retry else 0,
+                    },
+                })
+
+    for start in range(0, len(requests), max_requests_per_batch):
+        group = requests[start:start + max_requests_per_batch]
+        input_path = batch_dir / f"requests-{len(state.batches):04d}.jsonl"
+        with open(input_path, "w", encoding="utf-8") as f:
+            for request in group:
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        state.batches.append({
+            "input_path": str(input_path),
+            "custom_ids": [request["custom_id"] for request in group],
+            "input_file_id": None,
+            "batch_id": None,
+            "status": None,
+            "output_file_id": None,
+            "error_file_id": None,
+            "collected": False,
+        })
+        state.save()
+        logger.info("バッチのリクエストを書き出しました: %s (%d 件)", input_path, len(group))
+    if retried:
+        logger.info("失敗したチャンクを送り直します: %d 件", retried)
+    return len(requests)
+
+def _submit_batches(state: BatchState, client, logger: logging.Logger):
+    """まだ送信していないバッチをアップロードして作成する。ステップごとに状態を保存する。"""
+    for batch in state.batches:
+        if batch["input_file_id"] is None:
+            with open(batch["input_path"], "rb") as f:
+                batch["input_file_id"] = client.files.create(file=f, purpose="batch").id
+            state.save()
+            logger.info("バッチの入力をアップロードしました: %s", batch["input_file_id"])
+        if batch["batch_id"] is None:
+            created = client.batches.create(input_file_id=batch["input_file_id"],
+                                            endpoint=BATCH_ENDPOINT,
+                                            completion_window="24h")
+            batch["batch_id"] = created.id
+            batch["status"] = created.status
+            state.save()
+            logger.info("バッチを作成しました: %s", batch["batch_id"])
+
+def _wait_batches(state: BatchState, client, poll_interval: float, logger: logging.Logger):
+    """全てのバッチが終了するまで待つ。"""
+    while True:
+        running = 0
+        for batch in state.batches:
+            if batch["status"] in TERMINAL_BATCH_STATUSES:
+                continue
+            retrieved = client.batches.retrieve(batch["batch_id"])
+            batch["status"] = retrieved.status
+            batch["output_file_id"] = retrieved.output_file_id
+            batch["error_file_id"] = retrieved.error_file_id
+            counts = retrieved.request_counts
+            logger.info("バッチの状態: %s %s (完了 %s/%s, 失敗 %s)", batch["batch_id"], retrieved.status,
+                        getattr(counts, "completed", "?"), getattr(counts, "total", "?"), getattr(counts, "failed", "?"))
+            if retrieved.status not in TERMINAL_BATCH_STATUSES:
+                running += 1
+        state.save()
+        if running == 0:
+            return
+        time.sleep(poll_interval)
+
+def _collect_results(state: BatchState,
+                     client,
+                     translator: OpenAIChat,
+                     cache: TranslationCache,
+                     metrics_by_paper: dict,
+                     logger: logging.Logger):
+    """終了したバッチの出力を読み込み、結果とキャッシュに入れる。"""
+    for batch in state.batches:
+        if batch["collected"] or batch["status"] not in TERMINAL_BATCH_STATUSES:
+            continue
+        results = {}
+        failed = 0
+        for file_id in (batch["output_file_id"], batch["error_file_id"]):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                custom_id = record["custom_id"]
+                response = record.get("response") or {}
+                body = response.get("body") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    failed += 1
+                    logger.warning("バッチのリクエストが失敗しました: %s (%s)", custom_id, record.get("error") or body.get("error"))
+                    continue
+                arxiv_id, file_index, chunk_index = _parse_custom_id(custom_id)
+                tex_chunk = state.papers[arxiv_id]["files"][file_index]["chunks"][chunk_index]
+                try:
+                    results[custom_id] = extract_translation(tex_chunk, body["choices"][0]["message"]["content"])
+                except TranslationValidationError as e:
+                    # 結果に入れずにおき、次のバッチで送り直す
+                    failed += 1
+                    logger.warning("翻訳の検証に失敗しました: %s (%s)", custom_id, e)
+                    continue
+                if cache is not None:
+                    cache.put(cache.make_key(translator.model, translator.render_prompt(tex_chunk)), results[custom_id])
+                usage = body.get("usage") or {}
+                if arxiv_id in metrics_by_paper:
+                    metrics_by_paper[arxiv_id].record_llm_call(model=translator.model,
+                                                               seconds=0.0,
+                                                               prompt_tokens=usage.get("prompt_tokens"),
+                                                               completion_tokens=usage.get("completion_tokens"),
+                                                               status="batch")
+        # 結果を書き込んでから取り込み済みにする (途中で落ちたら、もう1度取り込み直す)
+        state.add_results(results)
+        batch["collected"] = True
+        state.save()
+        logger.info("バッチの結果を取り込みました: %s (失敗 %d 件)", batch["batch_id"], failed)
+
+def _reassemble_paper(arxiv_id: str, paper: dict, state: BatchState, logger: logging.Logger) -> tuple:
+    """結果をファイルごとに書き戻す。結果の無いチャンクは原文のまま残す。
+
+    Returns:
+        tuple: (mainのtexファイルのパス, コンパイルエラーを修復するためのCompileRepairer)
+    """
+    chunks_by_file = {}
+    translated_all_chunks = []
+    missing = 0
+    for file_index, file in enumerate(paper["files"]):
+        chunks_by_file[Path(file["path"])] = file["chunks"]
+        for chunk_index, tex_chunk in enumerate(file["chunks"]):
+            translated_chunk = state.results.get(_custom_id(arxiv_id, file_index, chunk_index))
+            if translated_chunk is None:
+                missing += 1
+                translated_chunk = tex_chunk
+            translated_all_chunks.append(translated_chunk)
+    if missing:
+        logger.warning("翻訳結果の無いチャンクを原文のまま残しました: %s (%d 件)", arxiv_id, missing)
+    write_translated_chunks(chunks_by_file, translated_all_chunks, logger=logger)
+    return Path(paper["main_tex_path"]), CompileRepairer(chunks_by_file, translated_all_chunks, logger=logger)
+
+def translate_batch(arxiv_ids: list,
+                    template_dir = None,
+                    working_dir: Path = None,
+                    output_dir: Path = None,
+                    openai_api_key = None,
+                    model: str = "gpt-4o",
+                    base_url: str = None,
+                    batch_name: str = None,
+                    poll_interval: float = 60,
+                    use_cache: bool = True,
+                    cache_max_bytes: int = 512 * 1024 * 1024,
+                    use_source_store: bool = True,
+                    source_store_max_bytes: int = 2 * 1024 * 1024 * 1024,
+                    workspace_quota_bytes: int = 1024 * 1024 * 1024,
+                    max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH,
+                    keep_on_failure: bool = False,
+                    logger: logging.Logger = LOGGER,
+                    ) -> dict:
+    """複数の論文のチャンクをまとめてBatch APIで翻訳し、論文ごとにコンパイルする。
+
+    状態は`working_dir/batches/{batch_name}/state.json`に逐次保存するので、
+    途中で止まっても同じ引数で実行し直せば続きから再開する (送信済みのバッチは送り直さない)。
+    失敗したリクエストや検証に失敗した翻訳は、1度だけ次のバッチで送り直す。それでも翻訳できなければ原文のまま残す。
+    論文ごとの作業ディレクトリは再開に備えてtmpfsではなく`working_dir/batches/{batch_name}/papers`に作り、
+    コンパイルに成功したら削除する。失敗した論文は再開しないので、`keep_on_failure`の指定がなければ削除する。
+
+    Args:
+        arxiv_ids (list): arxivのidのリスト
+        model (str, optional): 翻訳に使うモデル. Defaults to "gpt-4o".
+        base_url (str, optional): APIのURL. ローカルの互換サーバーで試す場合に指定する. Defaults to None.
+        batch_name (str, optional): バッチ名. 指定がなければarxiv_idとモデルから決める. Defaults to None.
+        poll_interval (float, optional): バッチの状態を確認する間隔(秒). Defaults to 60.
+        use_cache (bool, optional): Trueなら翻訳キャッシュを使う. Defaults to True.
+        workspace_quota_bytes (int, optional): 論文ごとの作業ディレクトリの容量の上限. Defaults to 1GiB.
+        max_requests_per_batch (int, optional): 1つのバッチに入れるリクエスト数の上限. Defaults to 50000.
+        keep_on_failure (bool, optional): Trueなら失敗した論文の作業ディレクトリを残す (デバッグ用). Defaults to False.
+
+    Returns:
+        dict: {arxiv_id: 出力したPDFのパス (失敗した場合はNone)}
+    """
+    config = TranslatorConfig.load(logger=logger)
+    if template_dir is not None:
+        config.template_dir = template_dir
+    if working_dir is not None:
+        config.working_dir = working_dir
+    if output_dir is not None:
+        config.output_dir = output_dir
+    if openai_api_key is not None:
+        config.openai_api_key = openai_api_key
+    config = replace(config, working_dir=Path(config.working_dir))
+
+    normalized = []
+    for raw_id in arxiv_ids:
+        try:
+            arxiv_id = extract_arxiv_id(raw_id)
+        except ValueError as e:
+            # 1つの誤ったIDでまとめ翻訳全体を止めない
+            logger.error("IDを解釈できません: %s (%s)", raw_id, e)
+            continue
+        if arxiv_id not in normalized:
+            normalized.append(arxiv_id)
+    arxiv_ids = normalized
+    batch_name = batch_name or default_batch_name(arxiv_ids, model)
+    batch_dir = config.working_dir / "batches" / batch_name
+    state = BatchState(batch_dir / "state.json", logger=logger)
+    state.data.setdefault("model", model)
+    for arxiv_id in arxiv_ids:
+        state.papers.setdefault(arxiv_id, {"status": PAPER_PENDING})
+    state.save()
+
+    jinja_env = Environment(loader=FileSystemLoader(config.template_dir))
+    translator = OpenAIChat(api_key=config.openai_api_key,
+                            model=model,
+                            template=jinja_env.get_template('prompt_en_to_ja.j2'),
+                            logger=logger)
+    client = get_client(translator.api_key, base_url=base_url)
+    source_store = None
+    if use_source_store:
+        source_store = ArxivSourceStore(config.working_dir / "sources", max_bytes=source_store_max_bytes, logger=logger)
+    cache = None
+    if use_cache:
+        cache = TranslationCache(config.working_dir / "translation_cache.sqlite3", max_bytes=cache_max_bytes, logger=logger)
+
+    workspaces = {}
+    metrics_by_paper = {}
+    try:
+        ## 準備
+        for arxiv_id, paper in state.papers.items():
+            if paper["status"] in (PAPER_COMPILED, PAPER_FAILED):
+                continue
+            paper_dir = batch_dir / "papers" / arxiv_id.replace("/", "_")
+            if paper["status"] == PAPER_PENDING:
+                # 前回の準備の途中で止まっていれば、やり直す
+                shutil.rmtree(paper_dir, ignore_errors=True)
+                state.discard_results(arxiv_id)
+            workspaces[arxiv_id] = Workspace(paper_dir, workspace_quota_bytes, exist_ok=True, logger=logger)
+            metrics_by_paper[arxiv_id] = JobMetrics(arxiv_id, logger=logger)
+            if paper["status"] != PAPER_PENDING:
+                continue
+            try:
+                _prepare_paper(arxiv_id, paper, state, config, jinja_env, translator, workspaces[arxiv_id],
+                               source_store, cache, metrics_by_paper[arxiv_id], logger)
+            except Exception as e:
+                paper["status"] = PAPER_FAILED
+                paper["error"] = str(e)
+                logger.error("準備に失敗しました: %s (%s)", arxiv_id, e)
+        state.save()
+
+        ## 送信と待機 (結果の無いチャンクを送り直す回を含む)
+        for _ in range(MAX_BATCH_ATTEMPTS):
+            written = _write_batch_inputs(state, batch_dir, translator, max_requests_per_batch, logger)
+            if not written and all(batch["collected"] for batch in state.batches):
+                break
+            _submit_batches(state, client, logger)
+            _wait_batches(state, client, poll_interval, logger)
+            _collect_results(state, client, translator, cache, metrics_by_paper, logger)
+
+        ## 書き戻しとコンパイル
+        for arxiv_id, paper in state.papers.items():
+            if paper["status"] != PAPER_PREPARED:
+                continue
+            metrics = metrics_by_paper[arxiv_id]
+            try:
+                main_tex_path, repairer = _reassemble_paper(arxiv_id, paper, state, logger)
+                output_path = compile_and_export(arxiv_id, main_tex_path, main_tex_path.read_text("utf-8"), config,
+                                                 workspace=workspaces[arxiv_id], metrics=metrics, repairer=repairer,
+                                                 logger=logger)
+                paper["status"] = PAPER_COMPILED
+                paper["output_path"] = str(output_path)
+                metrics.finish("ok")
+            except Exception as e:
+                paper["status"] = PAPER_FAILED
+                paper["error"] = str(e)
+                metrics.finish("error")
+                logger.error("コンパイルに失敗しました: %s (%s)", arxiv_id, e)
+            metrics.save(config.working_dir / "reports" / f"{arxiv_id.replace('/', '_')}-{int(metrics.started_at)}.json",
+                         keep_latest=MAX_REPORTS)
+    finally:
+        state.save()
+        for arxiv_id, workspace in workspaces.items():
+            # 再開に備えて、準備済みでまだコンパイルしていないものだけ残す
+            status = state.papers[arxiv_id]["status"]
+            workspace.close(keep=status == PAPER_PREPARED or (status == PAPER_FAILED and keep_on_failure))
+        if cache is not None:
+            cache.close()
+
+    results = {arxiv_id: Path(paper["output_path"]) if paper.get("output_path") else None
+               for arxiv_id, paper in state.papers.items()}
+    logger.info("バッチ翻訳が完了しました: %s (成功 %d / %d)", batch_name,
+                sum(path is not None for path in results.values()), len(results))
+    return results
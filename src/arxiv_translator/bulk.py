@@ -0,0 +1,207 @@
+"""複数の論文をまとめて翻訳するパイプライン"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from .config import TranslatorConfig
+from .file_utils import extract_arxiv_id
+from .llm_scheduler import PRIORITY_BATCH
+from .translator import translate
+
+LOGGER = logging.getLogger(__name__)
+
+# 論文ごとの状態
+PAPER_PENDING = "pending"
+PAPER_DONE = "done"
+PAPER_FAILED = "failed"
+
+def read_arxiv_ids(lines) -> list:
+    """IDのリスト(1行に1つ)を読み込む。空行と`#`以降は無視し、重複は最初の1つだけ残す。
+
+    Args:
+        lines (Iterable[str]): 行のリスト (ファイルや標準入力)
+
+    Returns:
+        list: arxiv_idまたはURLのリスト (正規化はしない)
+    """
+    arxiv_ids = []
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if line and line not in arxiv_ids:
+            arxiv_ids.append(line)
+    return arxiv_ids
+
+def default_manifest_path(output_dir: Path, arxiv_ids: list, name: str = None) -> Path:
+    """マニフェストのデフォルトのパス. 同じリストなら同じパスになり、実行し直すと続きから再開する。"""
+    if name is None:
+        name = hashlib.sha1("\n".join(arxiv_ids).encode("utf-8")).hexdigest()[:12]
+    return Path(output_dir) / f"manifest-{name}.json"
+
+class BulkManifest:
+    """まとめ翻訳の進捗と結果. 論文が終わるたびにJSONで保存する。
+
+    Attributes:
+        path (Path): マニフェストのパス
+        data (dict): 内容
+    """
+
+    def __init__(self, path: Path, logger: logging.Logger = LOGGER):
+        self.path = Path(path)
+        self._logger = logger
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            self._logger.info("マニフェストから再開します: %s", self.path)
+        else:
+            self.data = {"papers": {}, "created_at": time.time()}
+
+    @property
+    def papers(self) -> dict:
+        """{arxiv_id: 論文ごとの結果}"""
+        return self.data["papers"]
+
+    def is_done(self, arxiv_id: str) -> bool:
+        """翻訳済みで、出力したPDFが残っているか"""
+        paper = self.papers.get(arxiv_id, {})
+        return paper.get("status") == PAPER_DONE and Path(paper.get("output_path", "")).is_file()
+
+    def update(self, arxiv_id: str, **fields):
+        """論文の結果を更新して保存する。"""
+        with self._lock:
+            self.papers.setdefault(arxiv_id, {}).update(fields)
+            self._save()
+
+    def summary(self) -> dict:
+        """状態ごとの論文数"""
+        counts = {}
+        for paper in self.papers.values():
+            counts[paper["status"]] = counts.get(paper["status"], 0) + 1
+        return counts
+
+    def finish(self):
+        """集計を書き込んで保存する。"""
+        with self._lock:
+            self.data["finished_at"] = time.time()
+            self.data["summary"] = self.summary()
+            self._save()
+
+    def _save(self):
+        # 書き込み途中で落ちても壊れないよう、一時ファイルから置き換える
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = self.path.with_suffix(".part")
+        part_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding="utf-8")
+        part_path.replace(self.path)
+
+def translate_many(arxiv_ids: list,
+                   template_dir = None,
+                   working_dir: Path = None,
+                   output_dir: Path = None,
+                   openai_api_key = None,
+                   model: str = "gpt-4o",
+                   download_workers: int = 4,
+                   translate_workers: int = 2,
+                   compile_workers: int = 2,
+                   max_workers: int = 8,
+                   manifest_path: Path = None,
+                   logger: logging.Logger = LOGGER,
+                   **options) -> dict:
+    """複数の論文を、ダウンロード・翻訳・コンパイルのステージに分けてパイプラインで翻訳する。
+
+    論文ごとに`translate`を別スレッドで実行し、各ステージに入る前にステージごとのセマフォを取得する。
+    ある論文をコンパイルしている間に次の論文を翻訳し、その次の論文をダウンロードするので、
+    ネットワーク・API・CPUを同時に使える。同時に処理中の論文は各ステージの同時実行数の合計までに抑える
+    (作業ディレクトリが際限なく増えないように)。
+
+    結果は論文が終わるたびにマニフェスト(JSON)に保存し、同じリストで実行し直すと
+    翻訳済みでPDFが残っている論文は飛ばす。失敗した論文は実行し直すと再び翻訳する。
+
+    Args:
+        arxiv_ids (list): arxivのidまたはURLのリスト
+        model (str, optional): 翻訳に使うモデル. Defaults to "gpt-4o".
+        download_workers (int, optional): 同時にダウンロード・展開する論文数. Defaults to 4.
+        translate_workers (int, optional): 同時に翻訳する論文数. Defaults to 2.
+        compile_workers (int, optional): 同時にコンパイルする論文数. Defaults to 2.
+        max_workers (int, optional): 1つの論文で同時に実行する翻訳リクエストの上限. Defaults to 8.
+        manifest_path (Path, optional): マニフェストのパス. 指定がなければ`output_dir/manifest-{リストのハッシュ}.json`.
+        **options: `translate`に渡すその他の引数
+
+    Returns:
+        dict: {arxiv_id: 出力したPDFのパス (失敗した場合はNone)}
+    """
+    # 正規化できないIDは、翻訳せずに失敗として記録する
+    normalized = {}
+    invalid = {}
+    for raw_id in arxiv_ids:
+        try:
+            normalized.setdefault(extract_arxiv_id(raw_id), raw_id)
+        except ValueError as e:
+            invalid[raw_id] = str(e)
+
+    if manifest_path is None:
+        manifest_dir = output_dir or TranslatorConfig.load(logger=logger).output_dir
+        manifest_path = default_manifest_path(manifest_dir, list(normalized))
+    manifest = BulkManifest(manifest_path, logger=logger)
+    manifest.data.update(model=model, started_at=time.time())
+    for raw_id, error in invalid.items():
+        manifest.update(raw_id, status=PAPER_FAILED, error=error)
+        logger.error("IDを解釈できません: %s (%s)", raw_id, error)
+
+    targets = []
+    for arxiv_id in normalized:
+        if manifest.is_done(arxiv_id):
+            logger.info("翻訳済みのため飛ばします: %s", arxiv_id)
+        else:
+            manifest.update(arxiv_id, status=PAPER_PENDING)
+            targets.append(arxiv_id)
+    logger.info("%d 件の論文を翻訳します (翻訳済み %d 件, ダウンロード %d / 翻訳 %d / コンパイル %d 並列)",
+                len(targets), len(normalized) - len(targets), download_workers, translate_workers, compile_workers)
+
+    stage_gates = {"download": threading.BoundedSemaphore(max(1, download_workers)),
+                   "translation": threading.BoundedSemaphore(max(1, translate_workers)),
+                   "compile": threading.BoundedSemaphore(max(1, compile_workers))}
+    options.setdefault("priority", PRIORITY_BATCH)
+    options.setdefault("use_async", True)
+
+    def _run(arxiv_id: str) -> Path:
+        started_at = time.time()
+        try:
+            output_path = translate(arxiv_id,
+                                    template_dir=template_dir,
+                                    working_dir=working_dir,
+                                    output_dir=output_dir,
+                                    openai_api_key=openai_api_key,
+                                    model=model,
+                                    max_workers=max_workers,
+                                    stage_gates=stage_gates,
+                                    logger=logger,
+                                    **options)
+        except Exception as e:
+            manifest.update(arxiv_id, status=PAPER_FAILED, error=str(e) or e.__class__.__name__,
+                            seconds=round(time.time() - started_at, 3))
+            logger.error("翻訳に失敗しました: %s (%s)", arxiv_id, e)
+            return None
+        manifest.update(arxiv_id, status=PAPER_DONE, output_path=str(output_path), error=None,
+                        seconds=round(time.time() - started_at, 3))
+        return output_path
+
+    in_flight = max(1, download_workers) + max(1, translate_workers) + max(1, compile_workers)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(in_flight, len(targets))), thread_name_prefix="bulk")
+    try:
+        futures = {executor.submit(_run, arxiv_id): arxiv_id for arxiv_id in targets}
+        for done, future in enumerate(as_completed(futures), start=1):
+            logger.info("まとめ翻訳 %d/%d (%s が終了)", done, len(futures), futures[future])
+    except KeyboardInterrupt:
+        logger.warning("中断しました。処理中の論文が終わり次第停止します。実行し直すと続きから再開します。")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        manifest.finish()
+
+    logger.info("まとめ翻訳が完了しました: %s (%s)", manifest.path, manifest.summary())
+    return {arxiv_id: Path(paper["output_path"]) if paper.get("status") == PAPER_DONE else None
+            for arxiv_id, paper in manifest.papers.items()}
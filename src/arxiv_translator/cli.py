@@ -3,6 +3,7 @@ import argparse
 from pathlib import Path
 from .translator import translate
 from .config import TranslatorConfig, mask_openai_key, show
+from .log_utils import setup_logging
 import colorama
 from colorama import Fore, Style
 import logging
@@ -14,15 +15,31 @@ def main():
 
     parser = argparse.ArgumentParser(
         prog='arxiv-translate',
-        description='Arxiv Translate Utility \n\n例1: arxiv-translate 1000.20000v1\n-> 論文の翻訳ができる.\n\n例2: arxiv-translate config\n->デフォルトのファイルパスの指定などができる.',
+        description='Arxiv Translate Utility \n\n例1: arxiv-translate 1000.20000v1\n-> 論文の翻訳ができる.\n\n例2: arxiv-translate config\n->デフォルトのファイルパスの指定などができる.\n\n例3: arxiv-translate worker --redis_url redis://localhost:6379/0\n-> Redisのジョブキューから翻訳ジョブを取り出して実行するワーカーを起動する.\n\n例4: arxiv-translate batch ids.txt\n-> ファイル(省略すると標準入力)に1行ずつ書いた論文をまとめて翻訳する.',
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('arxiv_id', type=str, nargs='?', default=None, help="実行するコマンド。 'config' を指定すると設定を実行、それ以外は翻訳対象のファイル名として扱います。")
+    parser.add_argument('arxiv_id', type=str, nargs='?', default=None, help="実行するコマンド。 'config' を指定すると設定を実行、'worker' を指定するとワーカーを起動、'batch' を指定するとまとめて翻訳、それ以外は翻訳対象のファイル名として扱います。")
+    parser.add_argument('id_file', type=str, nargs='?', default=None, help="(batch) 翻訳するarxiv_idを1行に1つ書いたファイル。省略するか '-' を指定すると標準入力から読みます。")
     parser.add_argument('--working_dir', type=str, default=None, help="作業ディレクトリのパスを指定します。")
     parser.add_argument('--template_dir', type=str, default=None, help="テンプレートディレクトリのパスを指定します。")
     parser.add_argument('--output_dir', type=str, default=None, help="出力ディレクトリのパスを指定します。")
     parser.add_argument('--openai_api_key', type=str, default=None, help="OpenAI APIキーを指定します。")
+    parser.add_argument('--keep_archive', action='store_true', help="ダウンロードしたアーカイブを作業ディレクトリに保存します。")
+    parser.add_argument('--keep_on_failure', action='store_true', help="翻訳に失敗したとき、ジョブの作業ディレクトリを削除せずに残します。")
+    parser.add_argument('--max_workers', type=int, default=8, help="同時に実行する翻訳リクエストの上限を指定します。")
+    parser.add_argument('--batch_api', action='store_true', help="Batch APIで翻訳します。安価ですが完了まで最大24時間かかります。中断しても同じコマンドで再開できます。batchと組み合わせると全ての論文のチャンクを1つのバッチにまとめます。")
+    parser.add_argument('--base_url', type=str, default=None, help="OpenAI互換のAPIのURLを指定します。(Batch APIのローカルの代替サーバーなど)")
+    parser.add_argument('--poll_interval', type=float, default=60, help="Batch APIの状態を確認する間隔(秒)を指定します。")
+    parser.add_argument('--download_workers', type=int, default=4, help="(batch) 同時にダウンロードする論文数を指定します。")
+    parser.add_argument('--translate_workers', type=int, default=2, help="(batch) 同時に翻訳する論文数を指定します。")
+    parser.add_argument('--compile_workers', type=int, default=2, help="(batch) 同時にコンパイルする論文数を指定します。")
+    parser.add_argument('--manifest', type=str, default=None, help="(batch) 結果を書き出すマニフェストのパスを指定します。同じマニフェストで実行し直すと続きから再開します。")
+    parser.add_argument('--redis_url', type=str, default=None, help="(worker) ジョブキューに使うRedisのURLを指定します。指定がなければ環境変数`REDIS_URL`を使います。")
+    parser.add_argument('--concurrency', type=int, default=1, help="(worker) このワーカーで同時に処理するジョブ数を指定します。")
+    parser.add_argument('--slot_limit', type=int, default=2, help="(worker) 全ワーカーで同時に実行できるジョブ数の上限を指定します。")
+    parser.add_argument('--metrics_port', type=int, default=None, help="(worker) 指定したポートでPrometheus形式のメトリクスを公開します。")
     args = parser.parse_args()
+    setup_logging()
 
     if args.arxiv_id is None:
         parser.print_help()
@@ -42,6 +59,50 @@ def main():
             current_config.output_dir = args.output_dir
         if args.openai_api_key is not None:
             current_config.openai_api_key = args.openai_api_key
+
+        if arxiv_id == "worker":
+            from .worker import run_worker
+            current_config.show()
+            run_worker(redis_url=args.redis_url,
+                       concurrency=args.concurrency,
+                       slot_limit=args.slot_limit,
+                       metrics_port=args.metrics_port,
+                       config=current_config)
+            return
+
+        if arxiv_id == "batch":
+            from .bulk import translate_many, read_arxiv_ids
+            if args.id_file in (None, "-"):
+                arxiv_ids = read_arxiv_ids(sys.stdin)
+            else:
+                with open(args.id_file, encoding="utf-8") as f:
+                    arxiv_ids = read_arxiv_ids(f)
+            current_config.show()
+            if args.batch_api:
+                # 全ての論文のチャンクを1つのバッチにまとめて送る
+                from .batch_api import translate_batch
+                translate_batch(arxiv_ids,
+                                working_dir=current_config.working_dir,
+                                template_dir=current_config.template_dir,
+                                output_dir=current_config.output_dir,
+                                openai_api_key=current_config.openai_api_key,
+                                base_url=args.base_url,
+                                poll_interval=args.poll_interval,
+                                keep_on_failure=args.keep_on_failure)
+                return
+            translate_many(arxiv_ids,
+                           working_dir=current_config.working_dir,
+                           template_dir=current_config.template_dir,
+                           output_dir=current_config.output_dir,
+                           openai_api_key=current_config.openai_api_key,
+                           download_workers=args.download_workers,
+                           translate_workers=args.translate_workers,
+                           compile_workers=args.compile_workers,
+                           max_workers=args.max_workers,
+                           manifest_path=args.manifest,
+                           keep_archive=args.keep_archive,
+                           keep_on_failure=args.keep_on_failure)
+            return
         
         show({"arxiv_id": arxiv_id}, logger=logger, border_color=Fore.GREEN, text_color=Fore.LIGHTGREEN_EX)
         current_config.show()
@@ -51,7 +112,13 @@ def main():
             working_dir=current_config.working_dir,
             template_dir=current_config.template_dir,
             output_dir=current_config.output_dir,
-            openai_api_key=current_config.openai_api_key
+            openai_api_key=current_config.openai_api_key,
+            max_workers=args.max_workers,
+            keep_archive=args.keep_archive,
+            keep_on_failure=args.keep_on_failure,
+            use_batch_api=args.batch_api,
+            base_url=args.base_url,
+            batch_poll_interval=args.poll_interval
         )
 
 def update_config_interactive():
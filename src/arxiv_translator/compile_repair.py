@@ -0,0 +1,182 @@
+"""コンパイルエラーの原因になったチャンクを原文に戻して、PDFを生成できるようにする"""
+
+import logging
+from pathlib import Path
+from .tex_compiler import CompileResult
+
+LOGGER = logging.getLogger(__name__)
+
+# 修復のためにコンパイルする回数の上限 (最初のコンパイルを含む)
+MAX_REPAIR_COMPILES = 10
+
+class CompileRepairer:
+    """翻訳したチャンクのうち、コンパイルエラーの原因になったものだけを原文に戻しながらコンパイルする。
+
+    1. エラーの行番号から、その行を含むチャンクを特定して原文に戻す。
+    2. 行番号から特定できず、PDFも生成されなかった場合は、翻訳したチャンクを二分探索して原因を絞り込む。
+    3. 上限の回数に達してもPDFが生成されなければ、最後にすべてを原文に戻してコンパイルする。
+
+    チャンクは`(texファイルのパス, ファイル内の番号)`で識別する。
+
+    Attributes:
+        chunks_by_file (dict): {texファイルのパス: 原文のチャンクのリスト}
+        translated_by_file (dict): {texファイルのパス: 翻訳済みのチャンクのリスト}
+        reverted (set): 原文に戻したチャンク
+    """
+
+    def __init__(self, chunks_by_file: dict, translated_all_chunks: list, logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            chunks_by_file (dict): {texファイルのパス: 原文のチャンクのリスト}
+            translated_all_chunks (list): 全ファイルのチャンクを順に並べたものの翻訳結果 (`write_translated_chunks`と同じ)
+        """
+        self.chunks_by_file = {Path(file_path).resolve(): tex_chunks for file_path, tex_chunks in chunks_by_file.items()}
+        self.translated_by_file = {}
+        offset = 0
+        for file_path, tex_chunks in self.chunks_by_file.items():
+            self.translated_by_file[file_path] = translated_all_chunks[offset:offset + len(tex_chunks)]
+            offset += len(tex_chunks)
+        self.reverted = set()
+        self._logger = logger
+
+    def translated_keys(self) -> list:
+        """原文と異なる(翻訳された)チャンクを文書の順に返す。原文に戻したものは除く。"""
+        return [(file_path, index)
+                for file_path, tex_chunks in self.chunks_by_file.items()
+                for index, tex_chunk in enumerate(tex_chunks)
+                if (file_path, index) not in self.reverted and self.translated_by_file[file_path][index] != tex_chunk]
+
+    def _current_chunks(self, file_path: Path, reverted: set) -> list:
+        return [tex_chunk if (file_path, index) in reverted else self.translated_by_file[file_path][index]
+                for index, tex_chunk in enumerate(self.chunks_by_file[file_path])]
+
+    def write(self, reverted: set = None):
+        """`reverted`のチャンクを原文に、それ以外を翻訳にしてファイルを書き出す。
+
+        Args:
+            reverted (set, optional): 原文に戻すチャンク. 指定がなければ`self.reverted`.
+        """
+        reverted = self.reverted if reverted is None else reverted
+        for file_path in self.chunks_by_file:
+            file_path.write_text("".join(self._current_chunks(file_path, reverted)), encoding="utf-8")
+
+    def locate(self, errors: list, base_dir: Path) -> set:
+        """エラーの行を含むチャンクを返す。
+
+        そのチャンクが翻訳されていない(原文のままの)場合は、同じファイルの直前の翻訳されたチャンクを原因とみなす
+        (閉じ忘れた括弧などは、後ろの段落の終わりでエラーになることが多いため)。
+
+        Args:
+            errors (list): LatexErrorのリスト
+            base_dir (Path): コンパイルした作業ディレクトリ (エラーのファイル名の基準)
+
+        Returns:
+            set: 原因とみなしたチャンク
+        """
+        candidates = set(self.translated_keys())
+        located = set()
+        for error in errors:
+            if error.file is None or error.line is None:
+                continue
+            file_path = (Path(base_dir) / error.file).resolve()
+            if file_path not in self.chunks_by_file:
+                continue
+            # 行番号から、その行を含むチャンクを探す
+            line = 1
+            index = 0
+            for index, tex_chunk in enumerate(self._current_chunks(file_path, self.reverted)):
+                line += tex_chunk.count("\n")
+                if error.line < line:
+                    break
+            for candidate in range(index, -1, -1):
+                if (file_path, candidate) in candidates:
+                    located.add((file_path, candidate))
+                    break
+        return located
+
+    def repair(self, compile_fn: callable, base_dir: Path, max_compiles: int = MAX_REPAIR_COMPILES) -> CompileResult:
+        """コンパイルし、エラーがあれば原因のチャンクを原文に戻してコンパイルし直す。
+
+        Args:
+            compile_fn (callable): 引数なしでコンパイルし、CompileResultを返す関数
+            base_dir (Path): コンパイルする作業ディレクトリ (エラーのファイル名の基準)
+            max_compiles (int, optional): コンパイルする回数の上限. Defaults to MAX_REPAIR_COMPILES.
+
+        Returns:
+            CompileResult: 最後のコンパイル結果
+        """
+        self.write()
+        result = compile_fn()
+        compiles = 1
+        while not result.success and compiles < max_compiles:
+            located = self.locate(result.errors, base_dir)
+            bisected_result = None
+            if not located:
+                if result.pdf_path is not None:
+                    # 原因が翻訳と分からず、PDFは生成されている(原文にもあるエラーなど)ので、そのまま使う
+                    break
+                suspects = self.translated_keys()
+                if not suspects:
+                    break
+                located, bisected_result, used = self._bisect(suspects, compile_fn, max_compiles - compiles)
+                compiles += used
+                if not located:
+                    # 絞り込めなかったので、ファイルを元に戻してすべてを原文に戻す処理に任せる
+                    self.write()
+                    break
+            self.reverted |= located
+            self._logger.warning("コンパイルエラーの原因とみなしたチャンクを原文に戻します: %s",
+                                 ", ".join(f"{file_path.name}:{index + 1}" for file_path, index in sorted(located)))
+            self.write()
+            if bisected_result is not None:
+                # 二分探索の最後のコンパイルが、今の状態のコンパイル結果になっている
+                result = bisected_result
+                continue
+            result = compile_fn()
+            compiles += 1
+
+        if result.pdf_path is None and self.translated_keys():
+            # 上限に達してもPDFが無ければ、すべてを原文に戻す
+            self._logger.warning("PDFを生成できなかったため、すべてのチャンクを原文に戻してコンパイルします。")
+            self.reverted |= set(self.translated_keys())
+            self.write()
+            result = compile_fn()
+            compiles += 1
+        self._logger.info("コンパイル %d 回, 原文に戻したチャンク %d 個", compiles, len(self.reverted))
+        return result
+
+    def _bisect(self, suspects: list, compile_fn: callable, budget: int) -> tuple:
+        """翻訳したチャンクの半分ずつを原文に戻してコンパイルし、エラーの原因のチャンクを1つに絞り込む。
+
+        原文にも致命的でないエラーがあると`success`にはならないので、`repair`と同じくPDFが生成されたかで判定する。
+
+        Args:
+            suspects (list): 原因の候補のチャンク (文書の順)
+            compile_fn (callable): 引数なしでコンパイルし、CompileResultを返す関数
+            budget (int): コンパイルできる回数
+
+        Returns:
+            tuple: (原因とみなしたチャンクのset (絞り込めなければ空),
+                    そのチャンクだけを戻した状態のコンパイル結果 (コンパイルしていなければNone), コンパイルした回数)
+        """
+        used = 0
+        last = None
+        while len(suspects) > 1 and used < budget:
+            half = suspects[:len(suspects) // 2]
+            self.write(self.reverted | set(half))
+            result = compile_fn()
+            used += 1
+            if result.pdf_path is not None:
+                # 前半を戻せばPDFが生成される: 原因は前半にある
+                suspects = half
+                last = (half, result)
+            else:
+                # 前半を戻してもPDFが生成されない: 原因は後半にある
+                suspects = suspects[len(suspects) // 2:]
+                last = None
+        if len(suspects) > 1:
+            return set(), None, used
+        self._logger.info("二分探索でエラーの原因のチャンクを特定しました: %s:%d", suspects[0][0].name, suspects[0][1] + 1)
+        known_result = last[1] if last is not None and last[0] == suspects else None
+        return set(suspects), known_result, used
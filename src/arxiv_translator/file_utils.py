@@ -1,6 +1,7 @@
 """ファイルを取り扱う諸々"""
 
 import tarfile
+import gzip
 import os
 import shutil
 from pathlib import Path
@@ -8,6 +9,7 @@ import logging
 import requests
 from jinja2 import Template
 import re
+from .project_manifest import ProjectManifest
 
 LOGGER = logging.getLogger(__name__)
 
@@ -34,52 +36,237 @@ def extract_arxiv_id(text: str) -> str:
     else:
         return match.group(1)
 
-def download_arxiv_source(arxiv_id: str, output_dir: Path, logger: logging.Logger = LOGGER):
-    """arXivのページから、コンパイル前のデータの圧縮されたデータをダウンロードする。
+# arXivの`/src/`が返すソースの形式
+SOURCE_FORMAT_TARGZ = "tar.gz"
+SOURCE_FORMAT_TAR = "tar"
+SOURCE_FORMAT_TEXGZ = "tex.gz"
+SOURCE_FORMAT_TEX = "tex"
+SOURCE_FORMAT_PDF = "pdf"
+
+class UnsupportedSourceError(ValueError):
+    """翻訳できない形式のソース(PDFのみの投稿など)だった場合のエラー"""
+
+class SourceTooLargeError(ValueError):
+    """展開したソースが容量の上限を超えた場合のエラー"""
+
+class _TeeReader:
+    """読み込んだバイト列を別のファイルにも書き出す、読み込み専用のファイルライクオブジェクト"""
+
+    def __init__(self, source, sink):
+        self._source = source
+        self._sink = sink
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        if data:
+            self._sink.write(data)
+        return data
+
+class _PeekableReader:
+    """先頭のバイト列を消費せずに覗き見できる、読み込み専用のファイルライクオブジェクト"""
+
+    def __init__(self, source):
+        self._source = source
+        self._buffer = b""
+
+    def peek(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            data = self._source.read(size - len(self._buffer))
+            if not data:
+                break
+            self._buffer += data
+        return self._buffer[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = self._buffer + self._source.read()
+            self._buffer = b""
+            return data
+        if self._buffer:
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            return data
+        return self._source.read(size)
+
+def _sniff(head: bytes) -> str:
+    """展開済みのバイト列の先頭から形式を判定する。gzipかどうかは判定しない。"""
+    if head.startswith(b"%PDF"):
+        return SOURCE_FORMAT_PDF
+    if head[257:262] == b"ustar":
+        return SOURCE_FORMAT_TAR
+    if head.lstrip().lower().startswith((b"<!doctype html", b"<html")):
+        raise UnsupportedSourceError("ソースの代わりにHTMLが返されました。")
+    return SOURCE_FORMAT_TEX
+
+def detect_source_format(stream) -> tuple:
+    """ストリームの先頭のマジックバイトからソースの形式を判定する。
+
+    gzipで圧縮されていれば展開した先頭も確認して、tar.gzとtex.gzを区別する。
 
     Args:
-        arxiv_id (str): arxivのid. バージョン指定する場合はバージョンまで含む
-        output_dir (str): ダウンロード先. ファイル名は'arxiv-{arxiv_id}.tar.gz'で固定.
+        stream: ソースのストリーム (readを持つファイルライクオブジェクト)
+
+    Returns:
+        tuple: (形式, 展開済みの中身を先頭から読めるストリーム)
+    """
+    reader = _PeekableReader(stream)
+    if reader.peek(2) == b"\x1f\x8b":
+        inner = _PeekableReader(gzip.GzipFile(fileobj=reader, mode="rb"))
+        source_format = _sniff(inner.peek(512))
+        if source_format == SOURCE_FORMAT_TAR:
+            return SOURCE_FORMAT_TARGZ, inner
+        if source_format == SOURCE_FORMAT_TEX:
+            return SOURCE_FORMAT_TEXGZ, inner
+        return source_format, inner
+    return _sniff(reader.peek(512)), reader
+
+def _extract_tar(stream, output_path: Path, max_bytes: int = None, logger: logging.Logger = LOGGER):
+    """展開済みのtarのストリームを解凍する。展開後の合計サイズが`max_bytes`を超えた時点で打ち切る。"""
+    total = 0
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            total += member.size
+            if max_bytes is not None and total > max_bytes:
+                raise SourceTooLargeError(f"展開後のソースが上限({max_bytes} bytes)を超えました: {member.name}")
+            tar.extract(member, path=output_path, filter="data")
+
+def _extract_single_tex(stream, output_path: Path, max_bytes: int = None, logger: logging.Logger = LOGGER):
+    """単一のtexファイルのストリームを`main.tex`として保存する。"""
+    output_path.mkdir(parents=True, exist_ok=True)
+    total = 0
+    with open(output_path / "main.tex", "wb") as f:
+        while data := stream.read(1024 * 1024):
+            total += len(data)
+            if max_bytes is not None and total > max_bytes:
+                raise SourceTooLargeError(f"展開後のソースが上限({max_bytes} bytes)を超えました: main.tex")
+            f.write(data)
+    logger.info("単一のtexファイルとして保存しました: %s", output_path / "main.tex")
+
+def _reject_pdf(stream, output_path: Path, max_bytes: int = None, logger: logging.Logger = LOGGER):
+    """PDFのみの投稿は翻訳できない。"""
+    raise UnsupportedSourceError(f"PDFのみの投稿なのでtexソースがありません: {output_path.name}")
+
+SOURCE_HANDLERS = {
+    SOURCE_FORMAT_TARGZ: _extract_tar,
+    SOURCE_FORMAT_TAR: _extract_tar,
+    SOURCE_FORMAT_TEXGZ: _extract_single_tex,
+    SOURCE_FORMAT_TEX: _extract_single_tex,
+    SOURCE_FORMAT_PDF: _reject_pdf,
+}
+
+def extract_source_stream(stream, output_path: Path, max_bytes: int = None, logger: logging.Logger = LOGGER) -> str:
+    """ソースのストリームの形式を判定し、形式ごとの方法で`output_path`に展開する。
+
+    Args:
+        stream: ソースのストリーム
+        output_path (Path): 展開先のディレクトリ
+        max_bytes (int, optional): 展開後の合計サイズの上限. 指定がなければ無制限.
 
     Raises:
-        ValueError: ダウンロードに失敗したらエラー.
+        UnsupportedSourceError: PDFのみの投稿など、翻訳できない形式だった場合
+        SourceTooLargeError: 展開後のサイズが`max_bytes`を超えた場合
 
     Returns:
-        Path: ダウンロードしたファイルパス
+        str: ソースの形式
     """
+    source_format, reader = detect_source_format(stream)
+    logger.info("ソースの形式: %s", source_format)
+    SOURCE_HANDLERS[source_format](reader, Path(output_path), max_bytes=max_bytes, logger=logger)
+    return source_format
 
+def _source_url(arxiv_id: str) -> str:
+    """ソースのURL"""
     url_template = Template("https://arxiv.org/src/{{ arxiv_id }}")
-    url = url_template.render(arxiv_id=arxiv_id)
-    response = requests.get(url, timeout=600)
-    output_template = Template("arxiv-{{ arxiv_id }}.tar.gz")
-    output_path = Path(output_dir) / output_template.render(arxiv_id=arxiv_id)
+    return url_template.render(arxiv_id=arxiv_id)
 
-    if response.status_code == 200:
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
-        with open(output_path, "wb") as f:
-            f.write(response.content)
-        logger.info("ダウンロード成功, from %s to: %s", arxiv_id, output_path)
-        return output_path
-    else:
-        raise ValueError(f"ダウンロード失敗. URL: {url}, HTTP status code: {response.status_code}")
+def probe_arxiv_source(arxiv_id: str, logger: logging.Logger = LOGGER) -> str:
+    """ソースの先頭だけをダウンロードして形式を判定する。ジョブを登録する前の確認用。
+
+    Args:
+        arxiv_id (str): arxivのid
 
-def unfreeze_targz(targz_path: Path, output_dir: Path, logger: logging.Logger = LOGGER) -> Path:
-    """.tar.gzの解凍をする。
+    Raises:
+        ValueError: ダウンロードに失敗したらエラー.
+
+    Returns:
+        str: ソースの形式
+    """
+    url = _source_url(arxiv_id)
+    with requests.get(url, stream=True, timeout=60) as response:
+        if response.status_code != 200:
+            raise ValueError(f"ダウンロード失敗. URL: {url}, HTTP status code: {response.status_code}")
+        response.raw.decode_content = True
+        source_format, _ = detect_source_format(response.raw)
+    logger.info("ソースの形式: %s (%s)", source_format, arxiv_id)
+    return source_format
+
+def download_and_extract_arxiv_source(arxiv_id: str,
+                                      output_dir: Path,
+                                      keep_archive: bool = False,
+                                      store=None,
+                                      max_bytes: int = None,
+                                      archive_dir: Path = None,
+                                      logger: logging.Logger = LOGGER) -> Path:
+    """arXivのソースをダウンロードしながら、そのまま解凍する。
+
+    レスポンスをメモリに溜めず、ストリームを直接展開する。
+    ソースの形式はストリームの先頭で判定し、tar(.gz)以外に単一のtex(.gz)にも対応する。
+    解凍先は`output_dir/arxiv-{arxiv_id}`。
 
     Args:
-        targz_path (str): 圧縮されたファイルのパス
-        output_path (str, optional): 出力先のパス
-        
+        arxiv_id (str): arxivのid. バージョン指定する場合はバージョンまで含む
+        output_dir (Path): 解凍先のディレクトリ
+        keep_archive (bool, optional): Trueならダウンロードしたアーカイブも'arxiv-{arxiv_id}.{形式}'として保存する. Defaults to False.
+        store (ArxivSourceStore, optional): 指定されればソースをストア経由で取得する. 保存済みならダウンロードしない. Defaults to None.
+        max_bytes (int, optional): 展開後の合計サイズの上限. 指定がなければ無制限.
+        archive_dir (Path, optional): アーカイブの保存先. 指定がなければoutput_dir.
+
+    Raises:
+        ValueError: ダウンロードに失敗したらエラー.
+        UnsupportedSourceError: PDFのみの投稿など、翻訳できない形式だった場合. 判定した時点でダウンロードを打ち切る.
+        SourceTooLargeError: 展開後のサイズが`max_bytes`を超えた場合. 超えた時点でダウンロードを打ち切る.
+
     Returns:
-        Path: ダウンロードしたファイルパス
+        Path: 解凍したディレクトリのパス
     """
 
-    output_path = Path(output_dir) / Path(targz_path).stem.split(".tar")[0]
+    url = _source_url(arxiv_id)
+    output_template = Template("arxiv-{{ arxiv_id }}")
+    output_path = Path(output_dir) / output_template.render(arxiv_id=arxiv_id)
 
-    with tarfile.open(targz_path, mode='r:gz') as tar:
-        tar.extractall(path=output_path, filter="data")
-        logger.info("解凍成功, from %s to: %s", targz_path, output_path)
+    if store is not None:
+        with store.open(arxiv_id) as stream:
+            extract_source_stream(stream, output_path, max_bytes=max_bytes, logger=logger)
+        logger.info("解凍成功, from %s to: %s", arxiv_id, output_path)
+        return output_path
 
+    with requests.get(url, stream=True, timeout=600) as response:
+        if response.status_code != 200:
+            raise ValueError(f"ダウンロード失敗. URL: {url}, HTTP status code: {response.status_code}")
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        # Content-Encodingが付いていれば展開してから渡す.
+        response.raw.decode_content = True
+
+        if keep_archive:
+            archive_dir = Path(archive_dir) if archive_dir is not None else Path(output_dir)
+            archive_dir.mkdir(parents=True, exist_ok=True)
+            archive_path = archive_dir / f"{output_path.name}.download"
+            try:
+                with open(archive_path, "wb") as archive_file:
+                    tee = _TeeReader(response.raw, archive_file)
+                    source_format = extract_source_stream(tee, output_path, max_bytes=max_bytes, logger=logger)
+                    # アーカイブの末尾(パディング等)まで保存する
+                    while tee.read(1024 * 1024):
+                        pass
+            except Exception:
+                archive_path.unlink(missing_ok=True)
+                raise
+            archive_path = archive_path.rename(archive_path.with_suffix(f".{source_format}"))
+            logger.info("アーカイブを保存しました: %s", archive_path)
+        else:
+            extract_source_stream(response.raw, output_path, max_bytes=max_bytes, logger=logger)
+
+    logger.info("ダウンロード・解凍成功, from %s to: %s", arxiv_id, output_path)
     return output_path
 
 def copy_item(src: Path, dst: Path, overwrite=False, logger: logging.Logger = LOGGER):
@@ -116,28 +303,6 @@ def copy_item(src: Path, dst: Path, overwrite=False, logger: logging.Logger = LO
     else:
         raise ValueError(f"無効なコピー元: {src}")
 
-def find_files_by_ext(source_dir: Path, ext: str, single=False) -> list:
-    """指定されたディレクトリ内の, extを拡張子に持つすべてのファイルを取得する。
-    例:
-        file_file_by_ext("/path/to/source", "tex")
-
-    Args:
-        source_dir (str): 検索対象のディレクトリ
-        ext: 検索対象の拡張子
-        single: singleだったら1つのパスを返すだけ。そうでなければ見つけたPathをリストで返す。
-
-    Returns:
-        list: texファイルのリスト
-    """
-
-    # 指定されたディレクトリ内のすべての .tex ファイルを取得
-    file_paths = list(Path(source_dir).rglob("*"+ext))
-
-    if single:
-        return file_paths[0]
-    else:
-        return file_paths
-
 def find_main_tex(source_dir: Path) -> Path:
     """入力されたディレクトリから、mainのtexファイルを探す。
 
@@ -151,16 +316,5 @@ def find_main_tex(source_dir: Path) -> Path:
         str: texのファイルパス
     """
 
-    tex_files = find_files_by_ext(source_dir=source_dir, ext="tex")
-
-    main_tex_file: Path = None
-    # .tex ファイルを探索して \documentclass を含む最初のファイルを探す
-    for tex_file in tex_files:
-        with open(tex_file, 'r', encoding='utf-8') as file:
-            if '\\documentclass' in file.read():
-                main_tex_file = tex_file
-
-    if main_tex_file is None:
-        raise ValueError(f"適切なtexファイルが見つかりませんでした。 {source_dir}")
-    else:
-        return Path(main_tex_file)
+    # 先頭に \documentclass を含むtexファイルのうち、最も浅い階層のものを選ぶ (同じ階層ならパスの順)
+    return ProjectManifest.build(source_dir).find_main_tex()
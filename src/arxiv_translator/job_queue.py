@@ -0,0 +1,319 @@
+"""Redisを使った永続的なジョブキュー"""
+
+import json
+import logging
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# ジョブのイベントの種類
+EVENT_LOG = "log"
+EVENT_END = "end"
+
+# KEYS[1]: 重複排除のキー, ARGV[1]: 期待する現在のジョブID, ARGV[2]: 新しいジョブID
+# 現在の値がARGV[1]のときだけ書き換える (他のリクエストが先に書き換えていたら何もしない)
+# 戻り値: 書き換えたら1, しなかったら0
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('SET', KEYS[1], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+class RedisJobQueue:
+    """Redisを使った永続的なジョブキュー
+
+    ジョブの状態とログはRedisに保存されるので、Webサーバーやワーカーが再起動しても失われない。
+    ログはジョブごとのRedis Streamに追記し、ジョブが終了したら終了イベントを追記する。
+    読む側はイベントのIDを覚えておけば、どのWebサーバーからでも続きから読み直せる。
+    取り出したジョブはワーカーごとの処理中リストに移し(BLMOVE)、ワーカーのハートビートが途絶えたら
+    `recover_stale_jobs`で待ち行列に戻す。
+    `submit`で登録すると、同じarxiv_idとモデルのジョブが待機中・実行中・完了済みならそれを返す(重複排除)。
+
+    Attributes:
+        redis_conn (redis.Redis): Redis 接続オブジェクト
+        prefix (str): キーの接頭辞
+        worker_ttl (float): ワーカーのハートビートの有効期限(秒)
+        log_ttl (int): 終了したジョブの状態とログを残す秒数
+        max_log_lines (int): ジョブごとに残すログの最大行数 (おおよそ)
+    """
+
+    def __init__(self,
+                 redis_conn,
+                 prefix: str = "arxiv_translator",
+                 worker_ttl: float = 60,
+                 log_ttl: int = 7 * 24 * 60 * 60,
+                 max_log_lines: int = 10000,
+                 logger: logging.Logger = LOGGER):
+        self.redis_conn = redis_conn
+        self.prefix = prefix
+        self.worker_ttl = float(worker_ttl)
+        self.log_ttl = int(log_ttl)
+        self.max_log_lines = int(max_log_lines)
+        self._logger = logger
+        self._replace_script = redis_conn.register_script(_REPLACE_SCRIPT)
+
+    # --- キー ---
+    @property
+    def pending_key(self) -> str:
+        return f"{self.prefix}:jobs:pending"
+
+    @property
+    def workers_key(self) -> str:
+        return f"{self.prefix}:workers"
+
+    def processing_key(self, worker_id: str) -> str:
+        return f"{self.prefix}:jobs:processing:{worker_id}"
+
+    def job_key(self, job_id: str) -> str:
+        return f"{self.prefix}:job:{job_id}"
+
+    def log_key(self, job_id: str) -> str:
+        return f"{self.prefix}:job:{job_id}:events"
+
+    def dedupe_key(self, arxiv_id: str, model: str) -> str:
+        return f"{self.prefix}:dedupe:{model}:{arxiv_id}"
+
+    @staticmethod
+    def _decode(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    # --- ジョブ ---
+    def enqueue(self, arxiv_id: str, model: str = "gpt-4o", job_id: str = None, **options) -> str:
+        """ジョブを登録する。
+
+        Args:
+            arxiv_id (str): arxivのid
+            model (str, optional): 翻訳に使うモデル. Defaults to "gpt-4o".
+            job_id (str, optional): ジョブの識別子. 指定がなければ生成する.
+            **options: `translate`に渡す追加の引数 (JSONにできるもの)
+
+        Returns:
+            str: ジョブの識別子
+        """
+        job_id = job_id or str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "arxiv_id": arxiv_id,
+            "model": model,
+            "options": json.dumps(options),
+            "status": JOB_QUEUED,
+            "created_at": time.time(),
+        }
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(self.job_key(job_id), mapping=job)
+        pipe.lpush(self.pending_key, job_id)
+        pipe.execute()
+        self._logger.info("ジョブを登録しました: %s (arxiv_id: %s)", job_id, arxiv_id)
+        return job_id
+
+    def submit(self, arxiv_id: str, model: str = "gpt-4o", replace_done: bool = False, **options) -> tuple:
+        """同じarxiv_idとモデルのジョブがあればそれを、無ければ新しく登録したジョブを返す。
+
+        待機中・実行中・完了済みのジョブがあれば、新しいジョブは登録しない。
+        失敗したジョブや期限切れで消えたジョブしか無い場合は、新しく登録し直す。
+
+        Args:
+            arxiv_id (str): 正規化済みのarxivのid (`extract_arxiv_id`の戻り値)
+            model (str, optional): 翻訳に使うモデル. Defaults to "gpt-4o".
+            replace_done (bool, optional): Trueなら完了済みのジョブも失敗したジョブと同じく登録し直す.
+                出力したPDFが削除されていて、結果を返せない場合に使う. Defaults to False.
+            **options: `translate`に渡す追加の引数 (JSONにできるもの)
+
+        Returns:
+            tuple: (ジョブの識別子, 既存のジョブならTrue)
+        """
+        key = self.dedupe_key(arxiv_id, model)
+        job_id = str(uuid.uuid4())
+        while True:
+            if self.redis_conn.set(key, job_id, nx=True):
+                return self.enqueue(arxiv_id, model, job_id=job_id, **options), False
+            current = self._decode(self.redis_conn.get(key))
+            if current is None:
+                continue
+            job = self.get(current)
+            if job is not None and job["status"] != JOB_FAILED and not (replace_done and job["status"] == JOB_DONE):
+                self._logger.info("同じジョブが登録済みです: %s (arxiv_id: %s)", current, arxiv_id)
+                return current, True
+            if self._replace_script(keys=[key], args=[current, job_id]):
+                return self.enqueue(arxiv_id, model, job_id=job_id, **options), False
+
+    def find(self, arxiv_id: str, model: str = "gpt-4o") -> dict:
+        """同じarxiv_idとモデルの、待機中・実行中・完了済みのジョブを探す。
+
+        Args:
+            arxiv_id (str): 正規化済みのarxivのid
+            model (str, optional): 翻訳に使うモデル. Defaults to "gpt-4o".
+
+        Returns:
+            dict: ジョブの状態. 無ければ(失敗したジョブしか無い場合も)None
+        """
+        job_id = self.redis_conn.get(self.dedupe_key(arxiv_id, model))
+        if job_id is None:
+            return None
+        job = self.get(self._decode(job_id))
+        if job is None or job["status"] == JOB_FAILED:
+            return None
+        return job
+
+    def get(self, job_id: str) -> dict:
+        """ジョブの状態を取得する。
+
+        Args:
+            job_id (str): ジョブの識別子
+
+        Returns:
+            dict: ジョブの状態. 存在しなければNone
+        """
+        data = self.redis_conn.hgetall(self.job_key(job_id))
+        if not data:
+            return None
+        job = {self._decode(k): self._decode(v) for k, v in data.items()}
+        job["options"] = json.loads(job.get("options") or "{}")
+        return job
+
+    def update(self, job_id: str, **fields):
+        """ジョブの状態を更新する。"""
+        self.redis_conn.hset(self.job_key(job_id), mapping={k: v for k, v in fields.items() if v is not None})
+
+    def dequeue(self, worker_id: str, timeout: float = 5) -> str:
+        """ジョブを1つ取り出し、ワーカーの処理中リストに移す。
+
+        Args:
+            worker_id (str): ワーカーの識別子
+            timeout (float, optional): 待機する最大秒数. Defaults to 5.
+
+        Returns:
+            str: ジョブの識別子. timeoutまでに無ければNone
+        """
+        job_id = self.redis_conn.blmove(self.pending_key, self.processing_key(worker_id), timeout, "RIGHT", "LEFT")
+        if job_id is None:
+            return None
+        job_id = self._decode(job_id)
+        self.update(job_id, status=JOB_RUNNING, started_at=time.time(), worker=worker_id)
+        return job_id
+
+    def finish(self, job_id: str, worker_id: str, result: str = None, error: str = None):
+        """ジョブの終了を記録し、処理中リストから取り除く。
+
+        Args:
+            job_id (str): ジョブの識別子
+            worker_id (str): ワーカーの識別子
+            result (str, optional): 成功した場合の結果 (PDFのURL等)
+            error (str, optional): 失敗した場合のエラーメッセージ
+        """
+        status = JOB_DONE if error is None else JOB_FAILED
+        job = self.get(job_id) or {}
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(self.job_key(job_id), mapping={k: v for k, v in {
+            "status": status,
+            "result": result,
+            "error": error,
+            "finished_at": time.time(),
+        }.items() if v is not None})
+        pipe.lrem(self.processing_key(worker_id), 0, job_id)
+        # 読む側がストリームを閉じられるよう、終了イベントを追記する
+        self._add_event(pipe, job_id, type=EVENT_END, status=status, result=result or "", error=error or "")
+        pipe.expire(self.job_key(job_id), self.log_ttl)
+        pipe.expire(self.log_key(job_id), self.log_ttl)
+        if job.get("arxiv_id") and job.get("model"):
+            # 完了したジョブは状態と同じ期間だけ重複排除の対象にする
+            pipe.expire(self.dedupe_key(job["arxiv_id"], job["model"]), self.log_ttl)
+        pipe.execute()
+
+    # --- ワーカー ---
+    def heartbeat(self, worker_id: str):
+        """ワーカーが生きていることを記録する。"""
+        self.redis_conn.zadd(self.workers_key, {worker_id: time.time() + self.worker_ttl})
+
+    def unregister_worker(self, worker_id: str):
+        """ワーカーの登録を解除し、処理中のジョブがあれば待ち行列に戻す。"""
+        self._requeue(worker_id)
+        self.redis_conn.zrem(self.workers_key, worker_id)
+
+    def _requeue(self, worker_id: str) -> int:
+        """ワーカーの処理中リストのジョブを待ち行列に戻す。"""
+        count = 0
+        while True:
+            job_id = self.redis_conn.lmove(self.processing_key(worker_id), self.pending_key, "RIGHT", "RIGHT")
+            if job_id is None:
+                return count
+            job_id = self._decode(job_id)
+            self.update(job_id, status=JOB_QUEUED)
+            self.append_log(job_id, f"ワーカー {worker_id} が停止したため、ジョブを再登録しました。")
+            count += 1
+
+    def recover_stale_jobs(self) -> int:
+        """ハートビートが途絶えたワーカーの処理中のジョブを待ち行列の先頭に戻す。
+
+        Returns:
+            int: 戻したジョブの数
+        """
+        count = 0
+        for worker_id in self.redis_conn.zrangebyscore(self.workers_key, "-inf", time.time()):
+            worker_id = self._decode(worker_id)
+            # 複数のワーカーが同時に回収しないよう、登録の削除に成功したものだけが回収する
+            if self.redis_conn.zrem(self.workers_key, worker_id):
+                recovered = self._requeue(worker_id)
+                if recovered:
+                    self._logger.warning("停止したワーカー %s のジョブを %d 件再登録しました。", worker_id, recovered)
+                count += recovered
+        return count
+
+    # --- ログ ---
+    def _add_event(self, pipe, job_id: str, **fields):
+        # 古いものから捨てて、おおよそmax_log_lines件に保つ
+        pipe.xadd(self.log_key(job_id), fields, maxlen=self.max_log_lines, approximate=True)
+
+    def append_log(self, job_id: str, message: str):
+        """ジョブのログを1行追加する。"""
+        pipe = self.redis_conn.pipeline()
+        self._add_event(pipe, job_id, type=EVENT_LOG, message=message)
+        pipe.execute()
+
+    def read_logs(self, job_id: str, last_id: str = "0", block_ms: int = None, count: int = 1000) -> list:
+        """ジョブのイベントを、IDが`last_id`より後のものから取得する。
+
+        Args:
+            job_id (str): ジョブの識別子
+            last_id (str, optional): 最後に読んだイベントのID. "0"なら最初から. Defaults to "0".
+            block_ms (int, optional): 指定すると、新しいイベントが無ければ最大この時間(ミリ秒)待つ. Defaults to None.
+            count (int, optional): 一度に取得する最大件数. Defaults to 1000.
+
+        Returns:
+            list: (イベントのID, {"type": EVENT_LOG/EVENT_END, ...}) のリスト
+        """
+        response = self.redis_conn.xread({self.log_key(job_id): last_id}, count=count, block=block_ms)
+        events = []
+        for _, entries in response or []:
+            for event_id, fields in entries:
+                events.append((self._decode(event_id),
+                               {self._decode(key): self._decode(value) for key, value in fields.items()}))
+        return events
+
+class RedisLogHandler(logging.Handler):
+    """
+    ログレコードをRedis上のジョブのログに出力するハンドラー
+
+    Attributes:
+        job_queue (RedisJobQueue): ジョブキュー
+        job_id (str): ジョブの識別子
+    """
+    def __init__(self, job_queue: RedisJobQueue, job_id: str):
+        super().__init__()
+        self.job_queue = job_queue
+        self.job_id = job_id
+
+    def emit(self, record):
+        try:
+            self.job_queue.append_log(self.job_id, self.format(record))
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,296 @@
+"""LLMのAPI呼び出しのレート制限と再試行"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+import openai
+
+LOGGER = logging.getLogger(__name__)
+
+# 優先度 (小さいほど優先)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+# レート制限のデフォルト値. 環境変数で上書きできる.
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+
+# 再試行するHTTPステータスコード
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# 待機中にスケジューラーの状態を確認し直す最大間隔(秒)
+_POLL_INTERVAL = 0.5
+
+_SCHEDULERS_LOCK = threading.Lock()
+_SCHEDULERS: dict = {}
+
+class TokenBucket:
+    """トークンバケット
+
+    `capacity`を上限として毎秒`refill_per_second`ずつ補充される。
+    `capacity`を超える量は、満タンのときに限り取り出せる(残量は負になり、その分だけ次の取り出しが遅れる)。
+
+    Attributes:
+        capacity (float): バケットの容量
+        refill_per_second (float): 1秒あたりの補充量
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self._level = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """`amount`を取り出せるようになるまでの秒数. 今すぐ取り出せれば0."""
+        self._refill(now)
+        needed = min(amount, self.capacity) - self._level
+        if needed <= 0:
+            return 0.0
+        return needed / self.refill_per_second
+
+    def take(self, amount: float, now: float):
+        """`amount`を取り出す。`wait_time`が0であることを確認してから呼ぶこと。"""
+        self._refill(now)
+        self._level -= amount
+
+    def give_back(self, amount: float, now: float):
+        """`amount`を戻す。負なら追加で取り出す。"""
+        self._refill(now)
+        self._level = min(self.capacity, self._level + amount)
+
+@dataclass(order=True)
+class Ticket:
+    """スケジューラーへのリクエスト1回分の予約
+
+    Attributes:
+        priority (int): 優先度 (小さいほど優先)
+        seq (int): 到着順
+        tokens (int): 予約したトークン数 (見積もり)
+    """
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+
+class LLMScheduler:
+    """プロセス全体で共有する、LLMのAPI呼び出しのスケジューラー
+
+    - 1分あたりのリクエスト数(RPM)とトークン数(TPM)をトークンバケットで制限する。
+      トークン数は送信前に見積もって予約し、応答の`usage`で精算する。
+    - 待機中のリクエストは優先度の高いものから、同じ優先度なら到着順に通す。
+    - 429や一時的な5xxは、Retry-Afterを尊重しつつ、ジッター付きの指数バックオフで再試行する。
+      429を受けたときは、同じスケジューラーを使う全リクエストをその間止める。
+
+    同期(スレッド)・非同期(イベントループ)のどちらからでも使える。
+
+    Attributes:
+        requests_per_minute (int): 1分あたりのリクエスト数の上限
+        tokens_per_minute (int): 1分あたりのトークン数の上限
+        max_retries (int): 再試行の最大回数
+        base_delay (float): バックオフの基準の秒数
+        max_delay (float): バックオフの最大秒数
+    """
+
+    def __init__(self,
+                 requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+                 max_retries: int = 6,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            requests_per_minute (int, optional): 1分あたりのリクエスト数の上限. Defaults to 環境変数`OPENAI_RPM_LIMIT`または500.
+            tokens_per_minute (int, optional): 1分あたりのトークン数の上限. Defaults to 環境変数`OPENAI_TPM_LIMIT`または30000.
+            max_retries (int, optional): 再試行の最大回数. Defaults to 6.
+            base_delay (float, optional): バックオフの基準の秒数. Defaults to 1.0.
+            max_delay (float, optional): バックオフの最大秒数. Defaults to 60.0.
+        """
+        self.requests_per_minute = int(requests_per_minute)
+        self.tokens_per_minute = int(tokens_per_minute)
+        self.max_retries = int(max_retries)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self._logger = logger
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self._waiting: list = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    # --- 予約 ---
+    def _enter(self, tokens: int, priority: int) -> Ticket:
+        ticket = Ticket(priority=priority, seq=next(self._seq), tokens=int(tokens))
+        with self._lock:
+            heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _try_grant(self, ticket: Ticket) -> float:
+        """ticketが先頭で予算があれば通す。戻り値は次に確認するまでの秒数(通したら0)。`_lock`を取得して呼ぶこと。"""
+        now = time.monotonic()
+        if self._waiting[0] is not ticket:
+            return _POLL_INTERVAL
+        wait = max(self._paused_until - now,
+                   self._requests.wait_time(1, now),
+                   self._tokens.wait_time(ticket.tokens, now))
+        if wait > 0:
+            return wait
+        self._requests.take(1, now)
+        self._tokens.take(ticket.tokens, now)
+        heapq.heappop(self._waiting)
+        # 次の待機者に順番が回ったことを知らせる
+        self._changed.notify_all()
+        return 0.0
+
+    def _leave(self, ticket: Ticket):
+        """待機をやめる (キャンセル時)。"""
+        with self._lock:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._changed.notify_all()
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL) -> Ticket:
+        """予算が空くまで待ってから、リクエスト1回分とトークン数を予約する。
+
+        Args:
+            tokens (int): 見積もったトークン数 (入力と出力の合計)
+            priority (int, optional): 優先度. Defaults to PRIORITY_NORMAL.
+
+        Returns:
+            Ticket: 予約. 応答を受け取ったら`settle`で精算する.
+        """
+        ticket = self._enter(tokens, priority)
+        try:
+            with self._lock:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if wait == 0:
+                        return ticket
+                    self._changed.wait(min(wait, _POLL_INTERVAL))
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    async def acquire_async(self, tokens: int, priority: int = PRIORITY_NORMAL) -> Ticket:
+        """`acquire`の非同期版。待機中はイベントループをブロックしない。"""
+        ticket = self._enter(tokens, priority)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_grant(ticket)
+                if wait == 0:
+                    return ticket
+                await asyncio.sleep(min(wait, _POLL_INTERVAL))
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    def settle(self, ticket: Ticket, used_tokens: int = None):
+        """予約したトークン数を、実際に使ったトークン数で精算する。
+
+        Args:
+            ticket (Ticket): 予約
+            used_tokens (int, optional): 応答の`usage.total_tokens`. 失敗して分からなければNone(予約分を全て戻す).
+        """
+        with self._lock:
+            self._tokens.give_back(ticket.tokens - (used_tokens or 0), time.monotonic())
+            self._changed.notify_all()
+
+    # --- 再試行 ---
+    @staticmethod
+    def _retry_after(error: Exception) -> float:
+        """エラーのレスポンスからRetry-Afterの秒数を取り出す。無ければNone。"""
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            value = headers.get(name)
+            if value is None:
+                continue
+            try:
+                return max(float(value) * scale, 0.0)
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """再試行する価値のあるエラーか"""
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS_CODES
+        return False
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        """失敗したリクエストを再試行するまでの秒数を返す。再試行しないならNone。
+
+        ジッター付きの指数バックオフ(full jitter)で、Retry-Afterがあればそれ以上待つ。
+        429の場合は、このスケジューラーを使う全リクエストをその間止める。
+
+        Args:
+            error (Exception): 発生したエラー
+            attempt (int): 何回目の再試行か (1始まり)
+
+        Returns:
+            float: 待機する秒数. 再試行しないならNone
+        """
+        if attempt > self.max_retries or not self.is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        if getattr(error, "status_code", None) == 429:
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self._logger.warning("LLMの呼び出しに失敗したため、%.1f秒後に再試行します (%d/%d): %s",
+                             delay, attempt, self.max_retries, error)
+        return delay
+
+def get_scheduler(model: str) -> LLMScheduler:
+    """モデルごとにプロセス内で共有されるスケジューラーを取得する。
+
+    Args:
+        model (str): モデル名
+
+    Returns:
+        LLMScheduler: 共有スケジューラー
+    """
+    with _SCHEDULERS_LOCK:
+        scheduler = _SCHEDULERS.get(model)
+        if scheduler is None:
+            scheduler = LLMScheduler()
+            _SCHEDULERS[model] = scheduler
+        return scheduler
+
+def configure_scheduler(model: str, **kwargs) -> LLMScheduler:
+    """モデルの共有スケジューラーを、指定した設定で作り直す。
+
+    Args:
+        model (str): モデル名
+        **kwargs: `LLMScheduler`の引数
+
+    Returns:
+        LLMScheduler: 新しい共有スケジューラー
+    """
+    with _SCHEDULERS_LOCK:
+        scheduler = LLMScheduler(**kwargs)
+        _SCHEDULERS[model] = scheduler
+        return scheduler
@@ -0,0 +1,74 @@
+"""ロガーの設定と、ジョブ専用のロガーの作成・破棄"""
+
+import logging
+import queue
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER = logging.getLogger(__name__)
+
+# ジョブ専用のロガーの親
+JOB_LOGGER_NAME = "arxiv_translator.jobs"
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# `setup_logging`が追加したハンドラーの目印
+_HANDLER_MARK = "_arxiv_translator_handler"
+
+def setup_logging(level: int = logging.INFO) -> logging.Logger:
+    """ルートロガーに標準エラー出力へのハンドラーを設定する。何度呼んでも1つしか追加しない。
+
+    ライブラリとして使う場合はハンドラーを追加しないので、CLIなどのエントリーポイントで1度だけ呼ぶ。
+
+    Args:
+        level (int, optional): ログレベル. Defaults to logging.INFO.
+
+    Returns:
+        logging.Logger: ルートロガー
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not any(getattr(handler, _HANDLER_MARK, False) for handler in root.handlers):
+        handler = logging.StreamHandler()
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        setattr(handler, _HANDLER_MARK, True)
+        root.addHandler(handler)
+    return root
+
+def _forget_logger(name: str):
+    """ロガーをloggingのレジストリから取り除く。以降同じ名前で取得すると新しいロガーになる。"""
+    with logging._lock:
+        logging.Logger.manager.loggerDict.pop(name, None)
+
+@contextmanager
+def job_logger(job_id: str, handler: logging.Handler, level: int = logging.INFO):
+    """ジョブ専用のロガーを作り、終わったら破棄する。
+
+    ロガーには`QueueHandler`だけを付け、`handler`(Redisへの送信など)は`QueueListener`のスレッドで実行するので、
+    ログの出力で翻訳の処理が止まらない。終了時はキューに残ったログを出し切ってからハンドラーを閉じ、
+    ロガーをレジストリから取り除く (長時間動くワーカーでジョブごとのロガーが溜まらないように)。
+
+    Args:
+        job_id (str): ジョブの識別子
+        handler (logging.Handler): ログの出力先
+        level (int, optional): ログレベル. Defaults to logging.INFO.
+
+    Yields:
+        logging.Logger: ジョブ専用のロガー
+    """
+    logger = logging.getLogger(JOB_LOGGER_NAME).getChild(job_id)
+    logger.setLevel(level)
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(queue_handler)
+    try:
+        yield logger
+    finally:
+        logger.removeHandler(queue_handler)
+        # キューに残ったログを出し切ってから止まる
+        listener.stop()
+        handler.close()
+        _forget_logger(logger.name)
@@ -0,0 +1,372 @@
+"""翻訳ジョブの計測"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+# `working_dir/reports`に残す計測レポートの数. 超えたら古いものから削除する
+MAX_REPORTS = 200
+
+# 全ワーカーのメトリクスを合算するRedisのハッシュのキー
+REDIS_METRICS_KEY = "arxiv_translator:metrics"
+# Redisに加算する値をまとめて送る間隔(秒)
+REDIS_FLUSH_INTERVAL = 5
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+class MetricsRegistry:
+    """プロセス全体で集計するメトリクス。Prometheusのテキスト形式で出力できる。
+
+    カウンタと、所要時間などの合計・件数(summary)だけを持つ簡易的な実装。
+    `attach_redis`すると加算した値をRedisのハッシュにも加算するので、
+    ジョブを実行しないプロセス(Webアプリ)でも`from_redis`で全ワーカーの合計を出力できる。
+    Redisへはバックグラウンドのスレッドが一定間隔でまとめて送るので、加算する側は待たされない。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict = {}
+        self._summaries: dict = {}
+        self._help: dict = {}
+        self._redis_conn = None
+        self._redis_key = None
+        # Redisにまだ送っていない加算. {ハッシュのフィールド: 値}
+        self._pending: dict = {}
+        self._pending_help: dict = {}
+        self._flush_thread = None
+        self._stop_flush = threading.Event()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((labels or {}).items()))
+
+    def attach_redis(self, redis_conn, key: str = REDIS_METRICS_KEY, flush_interval: float = REDIS_FLUSH_INTERVAL):
+        """以降に加算する値を、Redisのハッシュにも加算する。
+
+        加算した値は`flush_interval`秒ごとにバックグラウンドのスレッドから送る。
+        終了する前に`detach_redis`を呼ぶと、残っている値を送ってから止める。
+
+        Args:
+            redis_conn (redis.Redis): Redisの接続
+            key (str, optional): ハッシュのキー. Defaults to REDIS_METRICS_KEY.
+            flush_interval (float, optional): Redisに送る間隔(秒). Defaults to REDIS_FLUSH_INTERVAL.
+        """
+        self.detach_redis()
+        self._redis_conn = redis_conn
+        self._redis_key = key
+        self._stop_flush.clear()
+        self._flush_thread = threading.Thread(target=self._flush_loop, args=(flush_interval,),
+                                              name="metrics-redis-flush", daemon=True)
+        self._flush_thread.start()
+
+    def detach_redis(self):
+        """バックグラウンドのスレッドを止め、残っている値をRedisに送る。"""
+        if self._flush_thread is None:
+            return
+        self._stop_flush.set()
+        self._flush_thread.join()
+        self._flush_thread = None
+        self.flush()
+        self._redis_conn = None
+        self._redis_key = None
+
+    def _flush_loop(self, flush_interval: float):
+        while not self._stop_flush.wait(flush_interval):
+            self.flush()
+
+    def _push(self, name: str, increments: dict, labels: dict, help_text: str = None):
+        """Redisに送る値を溜めておく。呼び出し元では通信しない。"""
+        if self._redis_conn is None:
+            return
+        labels = sorted((labels or {}).items())
+        with self._lock:
+            for kind, value in increments.items():
+                field = json.dumps([kind, name, labels])
+                self._pending[field] = self._pending.get(field, 0) + value
+            if help_text:
+                self._pending_help.setdefault(name, help_text)
+
+    def flush(self):
+        """溜めておいた値をRedisのハッシュに加算する。失敗しても捨てずに次の回で送り直す。"""
+        if self._redis_conn is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            pending_help, self._pending_help = self._pending_help, {}
+        if not pending and not pending_help:
+            return
+        try:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for field, value in pending.items():
+                pipe.hincrbyfloat(self._redis_key, field, value)
+            for name, help_text in pending_help.items():
+                pipe.hsetnx(f"{self._redis_key}:help", name, help_text)
+            pipe.execute()
+        except Exception as e:
+            LOGGER.warning("メトリクスをRedisに送れませんでした: %s", e)
+            with self._lock:
+                for field, value in pending.items():
+                    self._pending[field] = self._pending.get(field, 0) + value
+                for name, help_text in pending_help.items():
+                    self._pending_help.setdefault(name, help_text)
+
+    @classmethod
+    def from_redis(cls, redis_conn, key: str = REDIS_METRICS_KEY) -> "MetricsRegistry":
+        """`attach_redis`した全プロセスの合計を読み込む。
+
+        Args:
+            redis_conn (redis.Redis): Redisの接続
+            key (str, optional): ハッシュのキー. Defaults to REDIS_METRICS_KEY.
+
+        Returns:
+            MetricsRegistry: 合計の値を持つMetricsRegistry
+        """
+        registry = cls()
+        for field, value in redis_conn.hgetall(key).items():
+            kind, name, labels = json.loads(_decode(field))
+            metric_key = registry._key(name, dict(labels))
+            value = float(_decode(value))
+            if kind == "counter":
+                registry._counters[metric_key] = value
+            else:
+                total, count = registry._summaries.get(metric_key, (0.0, 0))
+                registry._summaries[metric_key] = (value, count) if kind == "sum" else (total, int(value))
+        for name, help_text in redis_conn.hgetall(f"{key}:help").items():
+            registry._help[_decode(name)] = _decode(help_text)
+        return registry
+
+    def inc(self, name: str, value: float = 1, labels: dict = None, help_text: str = None):
+        """カウンタを加算する。"""
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help_text:
+                self._help.setdefault(name, help_text)
+        self._push(name, {"counter": value}, labels, help_text)
+
+    def observe(self, name: str, value: float, labels: dict = None, help_text: str = None):
+        """summaryに観測値を加える。"""
+        with self._lock:
+            key = self._key(name, labels)
+            total, count = self._summaries.get(key, (0.0, 0))
+            self._summaries[key] = (total + value, count + 1)
+            if help_text:
+                self._help.setdefault(name, help_text)
+        self._push(name, {"sum": value, "count": 1}, labels, help_text)
+
+    def render_prometheus(self) -> str:
+        """Prometheusのテキスト形式で出力する。"""
+        def _labels(items: tuple) -> str:
+            if not items:
+                return ""
+            body = ",".join(f'{k}="{str(v)}"' for k, v in items)
+            return "{" + body + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for (key_name, labels), value in sorted(self._counters.items()):
+                    if key_name == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self._summaries}):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} summary")
+                for (key_name, labels), (total, count) in sorted(self._summaries.items()):
+                    if key_name == name:
+                        lines.append(f"{name}_sum{_labels(labels)} {total}")
+                        lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+class JobMetrics:
+    """1つの翻訳ジョブの計測結果
+
+    ステージごとの所要時間・バイト数などと、LLM呼び出しごとのトークン数・再試行回数を記録する。
+    記録した値はプロセス全体の`REGISTRY`にも集計する。
+
+    Attributes:
+        arxiv_id (str): arxivのid
+        stages (list): ステージごとの記録 (dictのリスト)
+        llm_calls (list): LLM呼び出しごとの記録 (dictのリスト)
+    """
+
+    def __init__(self, arxiv_id: str, registry: MetricsRegistry = REGISTRY, logger: logging.Logger = LOGGER):
+        self.arxiv_id = arxiv_id
+        self.stages: list = []
+        self.llm_calls: list = []
+        self.status = "running"
+        self.started_at = time.time()
+        self.finished_at = None
+        self._registry = registry
+        self._logger = logger
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        """ステージの所要時間を計測する。
+
+        yieldされるdictに`bytes`や`retries`などを書き込むと、そのまま記録される。
+
+        Args:
+            name (str): ステージ名
+            **attributes: 記録に加える値
+
+        Yields:
+            dict: このステージの記録
+        """
+        record = {"stage": name, **attributes}
+        started = time.perf_counter()
+        try:
+            yield record
+            record["status"] = "ok"
+        except BaseException:
+            record["status"] = "error"
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            with self._lock:
+                self.stages.append(record)
+            labels = {"stage": name, "status": record["status"]}
+            self._registry.observe("arxiv_translator_stage_seconds", record["seconds"], labels,
+                                   help_text="Wall time of each pipeline stage.")
+            if "bytes" in record:
+                self._registry.inc("arxiv_translator_stage_bytes_total", record["bytes"], {"stage": name},
+                                   help_text="Bytes processed by each pipeline stage.")
+            if record.get("retries"):
+                self._registry.inc("arxiv_translator_stage_retries_total", record["retries"], {"stage": name},
+                                   help_text="Retries in each pipeline stage.")
+            self._logger.info("計測: %s %.2fs", name, record["seconds"])
+
+    def record_llm_call(self,
+                        model: str,
+                        seconds: float,
+                        prompt_tokens: int = None,
+                        completion_tokens: int = None,
+                        retries: int = 0,
+                        status: str = "ok"):
+        """LLM呼び出し1回分を記録する。トークン数はAPIの`usage`の値を渡す。
+
+        Args:
+            model (str): モデル名
+            seconds (float): 所要時間
+            prompt_tokens (int, optional): 入力トークン数
+            completion_tokens (int, optional): 出力トークン数
+            retries (int, optional): 再試行回数
+            status (str, optional): 結果
+        """
+        record = {
+            "model": model,
+            "seconds": seconds,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "retries": retries,
+            "status": status,
+        }
+        with self._lock:
+            self.llm_calls.append(record)
+        labels = {"model": model, "status": status}
+        self._registry.observe("arxiv_translator_llm_call_seconds", seconds, labels,
+                               help_text="Latency of each LLM call.")
+        if prompt_tokens:
+            self._registry.inc("arxiv_translator_llm_prompt_tokens_total", prompt_tokens, {"model": model},
+                               help_text="Prompt tokens reported by the API.")
+        if completion_tokens:
+            self._registry.inc("arxiv_translator_llm_completion_tokens_total", completion_tokens, {"model": model},
+                               help_text="Completion tokens reported by the API.")
+        if retries:
+            self._registry.inc("arxiv_translator_llm_retries_total", retries, {"model": model},
+                               help_text="Retries of LLM calls.")
+
+    def finish(self, status: str):
+        """ジョブの終了を記録する。
+
+        Args:
+            status (str): 結果 ("ok" や "error")
+        """
+        self.status = status
+        self.finished_at = time.time()
+        self._registry.inc("arxiv_translator_jobs_total", 1, {"status": status},
+                           help_text="Finished translation jobs.")
+        self._registry.observe("arxiv_translator_job_seconds", self.finished_at - self.started_at, {"status": status},
+                               help_text="Wall time of each translation job.")
+
+    def to_dict(self) -> dict:
+        """レポート用のdictを返す。"""
+        with self._lock:
+            llm_calls = list(self.llm_calls)
+            stages = list(self.stages)
+        return {
+            "arxiv_id": self.arxiv_id,
+            "status": self.status,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": (self.finished_at or time.time()) - self.started_at,
+            "stages": stages,
+            "llm": {
+                "calls": len(llm_calls),
+                "prompt_tokens": sum(call["prompt_tokens"] or 0 for call in llm_calls),
+                "completion_tokens": sum(call["completion_tokens"] or 0 for call in llm_calls),
+                "retries": sum(call["retries"] for call in llm_calls),
+                "seconds": sum(call["seconds"] for call in llm_calls),
+            },
+            "llm_calls": llm_calls,
+        }
+
+    def save(self, path: Path, keep_latest: int = None) -> Path:
+        """レポートをJSONで保存する。
+
+        Args:
+            path (Path): 保存先
+            keep_latest (int, optional): 指定すると、同じディレクトリのレポート(*.json)を新しいものからこの数だけ残して削除する.
+
+        Returns:
+            Path: 保存先
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+        self._logger.info("計測レポートを保存しました: %s", path)
+        if keep_latest is not None:
+            prune_reports(path.parent, keep_latest, logger=self._logger)
+        return path
+
+def prune_reports(report_dir: Path, keep_latest: int = MAX_REPORTS, logger: logging.Logger = LOGGER):
+    """ディレクトリのレポート(*.json)を、更新時刻の新しいものから`keep_latest`個だけ残して削除する。
+
+    Args:
+        report_dir (Path): レポートのディレクトリ
+        keep_latest (int, optional): 残す数. Defaults to MAX_REPORTS.
+    """
+    reports = []
+    for report_path in Path(report_dir).glob("*.json"):
+        try:
+            reports.append((report_path.stat().st_mtime, report_path))
+        except FileNotFoundError:
+            continue
+    reports.sort(reverse=True)
+    for _, report_path in reports[keep_latest:]:
+        report_path.unlink(missing_ok=True)
+    if len(reports) > keep_latest:
+        logger.info("古い計測レポートを %d 件削除しました: %s", len(reports) - keep_latest, report_dir)
+
+def directory_size(path: Path) -> int:
+    """ディレクトリ以下のファイルの合計バイト数を返す。
+
+    Args:
+        path (Path): ディレクトリ
+
+    Returns:
+        int: 合計バイト数
+    """
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
@@ -1,12 +1,36 @@
 """openaiのAPIを叩く"""
 import os
+import asyncio
+import threading
+import time
 import logging
+from concurrent.futures import Future
+from functools import lru_cache
+import httpx
 from jinja2 import Template, StrictUndefined
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 import tiktoken
+from .llm_scheduler import LLMScheduler, get_scheduler, PRIORITY_NORMAL
 
 LOGGER = logging.getLogger(__name__)
 
+# プロセス全体で共有するクライアントの同時接続数の上限
+MAX_CONNECTIONS = 256
+MAX_KEEPALIVE_CONNECTIONS = 64
+
+# ストリーミングで、次のトークンがこの秒数届かなければ接続が止まったとみなして再試行する
+STREAM_IDLE_TIMEOUT = 30.0
+# ストリーミングで、接続など読み込み以外のタイムアウト(秒)
+STREAM_TIMEOUT = 60.0
+# ストリーミングの進捗をログに出す間隔(%)
+STREAM_PROGRESS_STEP = 25
+
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS: dict = {}
+_ASYNC_CLIENTS: dict = {}
+_SHARED_LOOP: asyncio.AbstractEventLoop = None
+
 def mask_openai_key(text: str, reveal: int=4, max_size=10):
     reveal = int(reveal)
     max_size = int(max_size)
@@ -18,18 +42,175 @@ def mask_openai_key(text: str, reveal: int=4, max_size=10):
         text = text[:reveal] + "*" * min((len(text) - reveal), max_size)
     return text
 
+def _connection_limits() -> httpx.Limits:
+    """共有クライアントのコネクションプールの設定"""
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+
+def get_client(api_key: str, base_url: str = None) -> OpenAI:
+    """apiキーごとにプロセス内で共有される同期クライアントを取得する。
+
+    Args:
+        api_key (str): apiキー
+        base_url (str, optional): APIのURL. 互換サーバーを使う場合に指定する. 指定がなければ環境変数`OPENAI_BASE_URL`かOpenAI.
+
+    Returns:
+        OpenAI: 共有クライアント
+    """
+    key = api_key if base_url is None else (api_key, base_url)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            # 再試行は`LLMScheduler`が行うので、クライアント自身は再試行しない
+            client = OpenAI(api_key=api_key,
+                            base_url=base_url,
+                            max_retries=0,
+                            http_client=DefaultHttpxClient(limits=_connection_limits()))
+            _CLIENTS[key] = client
+        return client
+
+def get_shared_event_loop() -> asyncio.AbstractEventLoop:
+    """非同期クライアント用の、プロセス内で共有されるイベントループを取得する。
+
+    初回呼び出し時にデーモンスレッドでイベントループを起動する。
+    非同期クライアントのコネクションプールはこのループに紐づくので、
+    `AsyncOpenAIChat`のコルーチンはこのループ上で実行すること。
+
+    Returns:
+        asyncio.AbstractEventLoop: 共有イベントループ
+    """
+    global _SHARED_LOOP
+    with _CLIENTS_LOCK:
+        if _SHARED_LOOP is None or _SHARED_LOOP.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="openai-chat-loop", daemon=True)
+            thread.start()
+            _SHARED_LOOP = loop
+        return _SHARED_LOOP
+
+def submit_coroutine(coro) -> Future:
+    """コルーチンを共有イベントループに投入する。どのスレッドからでも呼び出せる。
+
+    Args:
+        coro: 実行するコルーチン
+
+    Returns:
+        Future: 実行結果を受け取るFuture
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_shared_event_loop())
+
+def run_coroutine(coro):
+    """コルーチンを共有イベントループで実行し、完了まで待って結果を返す。
+
+    Args:
+        coro: 実行するコルーチン
+
+    Returns:
+        コルーチンの戻り値
+    """
+    return submit_coroutine(coro).result()
+
+def get_async_client(api_key: str) -> AsyncOpenAI:
+    """apiキーごとにプロセス内で共有される非同期クライアントを取得する。
+
+    keep-aliveの接続プールを持つので、複数のジョブから共有することでTLSハンドシェイクを省ける。
+
+    Args:
+        api_key (str): apiキー
+
+    Returns:
+        AsyncOpenAI: 共有クライアント
+    """
+    with _CLIENTS_LOCK:
+        client = _ASYNC_CLIENTS.get(api_key)
+        if client is None:
+            client = AsyncOpenAI(api_key=api_key,
+                                 max_retries=0,
+                                 http_client=DefaultAsyncHttpxClient(limits=_connection_limits()))
+            _ASYNC_CLIENTS[api_key] = client
+        return client
+
+def _stream_error(error: httpx.TransportError, response: httpx.Response) -> openai.APIError:
+    """ストリーミングの途中で起きた通信エラーを、再試行の判定ができるopenaiの例外に変換する。"""
+    if isinstance(error, httpx.TimeoutException):
+        return openai.APITimeoutError(request=response.request)
+    return openai.APIConnectionError(message=f"ストリーミングが途中で切断されました: {error}", request=response.request)
+
+class _StreamCollector:
+    """ストリーミングで届いた差分を集め、進捗をログに出す。
+
+    Attributes:
+        expected_tokens (int): 出力のトークン数の見積もり (進捗の分母)
+        received_tokens (int): 受け取った差分の数 (おおよそのトークン数)
+        usage: 最後に届いたトークン数の集計 (`stream_options.include_usage`)
+    """
+
+    def __init__(self, expected_tokens: int, label: str = None, logger: logging.Logger = LOGGER):
+        self.expected_tokens = max(int(expected_tokens), 1)
+        self.received_tokens = 0
+        self.usage = None
+        self._label = label or "応答"
+        self._parts = []
+        self._next_percent = STREAM_PROGRESS_STEP
+        self._logger = logger
+
+    def feed(self, chunk):
+        """差分を1つ受け取る。"""
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return
+        self._parts.append(chunk.choices[0].delta.content)
+        self.received_tokens += 1
+        # 見積もりを超えても完了までは100%と出さない
+        percent = min(100 * self.received_tokens // self.expected_tokens, 99)
+        if percent >= self._next_percent:
+            self._logger.info(f"{self._label} を受信中 {self.received_tokens}/{self.expected_tokens} トークン ({percent}%)")
+            self._next_percent = (percent // STREAM_PROGRESS_STEP + 1) * STREAM_PROGRESS_STEP
+
+    @property
+    def text(self) -> str:
+        """受け取った文字列"""
+        return "".join(self._parts)
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """モデルに対応するtiktokenのエンコーダーを取得する。モデルごとに1度だけ解決される。
+
+    Args:
+        model (str): モデル名
+
+    Returns:
+        tiktoken.Encoding: エンコーダー
+    """
+    return tiktoken.encoding_for_model(model)
+
 class OpenAIChat:
-    """OpenAIのAPIを叩いて出力させるクラス"""
+    """OpenAIのAPIを叩いて出力させるクラス
+
+    API呼び出しは`LLMScheduler`(指定がなければモデルごとの共有スケジューラー)を通し、
+    レート制限の予算内で`priority`の順に送信する。失敗した場合は再試行する。
+
+    `stream`がTrueなら応答をストリーミングで受け取り、進捗をロガーに出す。
+    次のトークンが`stream_timeout`秒届かなければ、HTTPのタイムアウトを待たずに打ち切って再試行する。
+    """
 
     _api_key: str
     model: str
     _client: OpenAI
     _template: Template = Template("{{ prompt }}", undefined=StrictUndefined)
     _output_formatter: callable = lambda self, x: x
-    
+    metrics = None
+    priority: int = PRIORITY_NORMAL
+    _scheduler: LLMScheduler = None
+    stream: bool = False
+    stream_timeout: float = STREAM_IDLE_TIMEOUT
+
     _logger: logging.Logger = LOGGER
 
-    def __init__(self, model: str, api_key: str = None, template: Template = None, output_formatter: callable = None, logger: logging.Logger = LOGGER):
+    def __init__(self, model: str, api_key: str = None, template: Template = None, output_formatter: callable = None, logger: logging.Logger = LOGGER, metrics=None,
+                 scheduler: LLMScheduler = None, priority: int = PRIORITY_NORMAL,
+                 stream: bool = False, stream_timeout: float = STREAM_IDLE_TIMEOUT):
 
         self.api_key = api_key
         self.model = model
@@ -37,6 +218,12 @@ class OpenAIChat:
             self.template = template
         if output_formatter is not None:
             self.output_formatter = output_formatter
+        if metrics is not None:
+            self.metrics = metrics
+        self._scheduler = scheduler
+        self.priority = priority
+        self.stream = stream
+        self.stream_timeout = stream_timeout
 
         self._logger = logger
 
@@ -57,7 +244,19 @@ class OpenAIChat:
                 raise ValueError("環境変数`OPENAI_API_KEY`が設定されていません。")
             self._api_key = openai_api_key
 
-        self._client = OpenAI(api_key=self.api_key)
+        self._client = self._get_client(self._api_key)
+
+    @staticmethod
+    def _get_client(api_key: str) -> OpenAI:
+        """apiキーに対応するクライアントを返す。"""
+        return get_client(api_key)
+
+    @property
+    def scheduler(self) -> LLMScheduler:
+        """API呼び出しのスケジューラー. 指定がなければモデルごとの共有スケジューラー."""
+        if self._scheduler is None:
+            return get_scheduler(self.model)
+        return self._scheduler
 
     @property
     def template(self):
@@ -82,33 +281,129 @@ class OpenAIChat:
         """output_formatterのセッター"""
         self._output_formatter = value
 
-    def get_response(self, text_in: str) -> str:
+    def render_prompt(self, text_in: str) -> str:
+        """テンプレートを適用したプロンプトを返す。
+
+        Args:
+            text_in (str): 入力文
+
+        Returns:
+            str: APIに送るプロンプト
+        """
+        return self.template.render(prompt=text_in)
+
+    def _request_kwargs(self, prompt: str, temperature: float = None) -> dict:
+        """chat.completions.createに渡す引数"""
+        kwargs = {"messages": [{"role": "user", "content": prompt}],
+                  "model": self.model,
+                  "temperature": temperature or 0}
+        if self.stream:
+            kwargs.update(stream=True,
+                          stream_options={"include_usage": True},
+                          # 読み込みのタイムアウトがトークンの間隔の上限になる
+                          timeout=httpx.Timeout(STREAM_TIMEOUT, read=self.stream_timeout))
+        return kwargs
+
+    def _create_streaming(self, prompt: str, collector: _StreamCollector, temperature: float = None):
+        """ストリーミングで応答を受け取り、`collector`に集める。"""
+        stream = self._client.chat.completions.create(**self._request_kwargs(prompt, temperature))
+        with stream:
+            try:
+                for chunk in stream:
+                    collector.feed(chunk)
+            except httpx.TransportError as e:
+                raise _stream_error(e, stream.response) from e
+
+    def get_response(self, text_in: str, label: str = None, temperature: float = None) -> str:
         """textを受け取って、応答する。
 
         Args:
             text_in (str): 入力文
+            label (str, optional): ストリーミングの進捗のログに出す名前 (チャンク番号など). Defaults to None.
+            temperature (float, optional): 指定すればtemperatureを変える (翻訳し直す場合など). Defaults to None (0).
 
         Returns:
             str: 出力文
         """
 
-        prompt = self.template.render(prompt=text_in)
+        prompt = self.render_prompt(text_in)
+        estimated_tokens = self.estimate_tokens(text_in)
 
-        chat_completion = self._client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model=self.model,
-            temperature=0,
-        )
-
-        text_out = chat_completion.choices[0].message.content
+        started = time.perf_counter()
+        retries = 0
+        while True:
+            ticket = self.scheduler.acquire(estimated_tokens, self.priority)
+            try:
+                if self.stream:
+                    collector = _StreamCollector(self.count_text_tokens(text_in), label=label, logger=self._logger)
+                    self._create_streaming(prompt, collector, temperature)
+                    text_out, usage = collector.text, collector.usage
+                else:
+                    chat_completion = self._client.chat.completions.create(**self._request_kwargs(prompt, temperature))
+                    text_out, usage = chat_completion.choices[0].message.content, chat_completion.usage
+                break
+            except Exception as e:
+                self.scheduler.settle(ticket)
+                delay = self.scheduler.retry_delay(e, retries + 1)
+                if delay is None:
+                    self._record_call(started, None, retries=retries, status="error")
+                    raise
+                retries += 1
+                time.sleep(delay)
+        self.scheduler.settle(ticket, getattr(usage, "total_tokens", ticket.tokens))
+        self._record_call(started, usage, retries=retries)
 
         return self.output_formatter(text_out)
 
+    def _record_call(self, started: float, usage=None, retries: int = 0, status: str = "ok"):
+        """`metrics`が設定されていれば、API呼び出しの所要時間とトークン数を記録する。"""
+        if self.metrics is None:
+            return
+        self.metrics.record_llm_call(model=self.model,
+                                    seconds=time.perf_counter() - started,
+                                    prompt_tokens=getattr(usage, "prompt_tokens", None),
+                                    completion_tokens=getattr(usage, "completion_tokens", None),
+                                    retries=retries,
+                                    status=status)
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        """モデルに対応するエンコーダー"""
+        return get_encoding(self.model)
+
+    @property
+    def prompt_overhead_tokens(self) -> int:
+        """テンプレートの固定部分(本文を空にしたプロンプト)のトークン数。モデルとテンプレートごとに1度だけ数える。"""
+        cache_key = (self.model, self.template)
+        if getattr(self, "_prompt_overhead_cache", (None, None))[0] != cache_key:
+            self._prompt_overhead_cache = (cache_key, self.count_text_tokens(self.render_prompt("")))
+        return self._prompt_overhead_cache[1]
+
+    def count_text_tokens(self, text_in: str) -> int:
+        """テンプレートを適用せずに、テキストそのもののトークン数を計算する。
+
+        Args:
+            text_in (str): トークン数を計算するテキスト。
+
+        Returns:
+            int: テキストのトークン数。
+        """
+        return len(self.encoding.encode(text_in, disallowed_special=()))
+
+    def count_prompt_tokens(self, text_in: str) -> int:
+        """指定されたモデルのトークナイザーを使用して、テンプレート適用後のトークン数を計算する。
+        同期・非同期のどちらのクラスでも同期的に呼び出せる。
+
+        テンプレートの固定部分のトークン数は使い回すので、境界でのトークン結合の分だけ厳密な値とは数トークンずれることがある。
+
+        Args:
+            text_in (str): トークン数を計算するテキスト。
+
+        Returns:
+            int: テキストのトークン数。
+        """
+        return self.prompt_overhead_tokens + self.count_text_tokens(text_in)
+
     def count_tokens(self, text_in: str):
         """指定されたモデルのトークナイザーを使用してテキストのトークン数を計算する。
 
@@ -118,15 +413,104 @@ class OpenAIChat:
         Returns:
             int: テキストのトークン数。
         """
+        return self.count_prompt_tokens(text_in)
 
-        prompt = self.template.render(prompt=text_in)
-        encoding = tiktoken.encoding_for_model(self.model)
-        tokenized = encoding.encode(prompt)
-        return len(tokenized)
+    def estimate_tokens(self, text_in: str) -> int:
+        """1回の呼び出しで使うトークン数(入力と出力の合計)を見積もる。スケジューラーの予約に使う。
+
+        翻訳なので、出力は入力の本文と同じくらいのトークン数になるとみなす。
+
+        Args:
+            text_in (str): 入力文
+
+        Returns:
+            int: 見積もったトークン数
+        """
+        text_tokens = self.count_text_tokens(text_in)
+        return self.prompt_overhead_tokens + 2 * text_tokens
 
     def __call__(self, *args, **kwds):
         return self.get_response(*args, **kwds)
 
+class AsyncOpenAIChat(OpenAIChat):
+    """OpenAIChatの非同期版
+
+    プロセス内で共有される`AsyncOpenAI`クライアントを使うので、ジョブをまたいで接続が再利用される。
+    コルーチンは`get_shared_event_loop()`のループ上で実行すること (`run_coroutine`/`submit_coroutine`を参照)。
+    """
+
+    _client: AsyncOpenAI
+
+    @staticmethod
+    def _get_client(api_key: str) -> AsyncOpenAI:
+        """apiキーに対応する共有の非同期クライアントを返す。"""
+        return get_async_client(api_key)
+
+    async def _create_streaming(self, prompt: str, collector: _StreamCollector, temperature: float = None):
+        """ストリーミングで応答を受け取り、`collector`に集める。"""
+        stream = await self._client.chat.completions.create(**self._request_kwargs(prompt, temperature))
+        async with stream:
+            try:
+                async for chunk in stream:
+                    collector.feed(chunk)
+            except httpx.TransportError as e:
+                raise _stream_error(e, stream.response) from e
+
+    async def get_response(self, text_in: str, label: str = None, temperature: float = None) -> str:
+        """textを受け取って、応答する。
+
+        Args:
+            text_in (str): 入力文
+            label (str, optional): ストリーミングの進捗のログに出す名前 (チャンク番号など). Defaults to None.
+            temperature (float, optional): 指定すればtemperatureを変える (翻訳し直す場合など). Defaults to None (0).
+
+        Returns:
+            str: 出力文
+        """
+
+        prompt = self.render_prompt(text_in)
+        estimated_tokens = self.estimate_tokens(text_in)
+
+        started = time.perf_counter()
+        retries = 0
+        while True:
+            ticket = await self.scheduler.acquire_async(estimated_tokens, self.priority)
+            try:
+                if self.stream:
+                    collector = _StreamCollector(self.count_text_tokens(text_in), label=label, logger=self._logger)
+                    await self._create_streaming(prompt, collector, temperature)
+                    text_out, usage = collector.text, collector.usage
+                else:
+                    chat_completion = await self._client.chat.completions.create(**self._request_kwargs(prompt, temperature))
+                    text_out, usage = chat_completion.choices[0].message.content, chat_completion.usage
+                break
+            except Exception as e:
+                self.scheduler.settle(ticket)
+                delay = self.scheduler.retry_delay(e, retries + 1)
+                if delay is None:
+                    self._record_call(started, None, retries=retries, status="error")
+                    raise
+                retries += 1
+                await asyncio.sleep(delay)
+        self.scheduler.settle(ticket, getattr(usage, "total_tokens", ticket.tokens))
+        self._record_call(started, usage, retries=retries)
+
+        return self.output_formatter(text_out)
+
+    async def count_tokens(self, text_in: str):
+        """指定されたモデルのトークナイザーを使用してテキストのトークン数を計算する。
+
+        Args:
+            text_in (str): トークン数を計算するテキスト。
+
+        Returns:
+            int: テキストのトークン数。
+        """
+        return self.count_prompt_tokens(text_in)
+
+    async def __call__(self, *args, **kwds):
+        return await self.get_response(*args, **kwds)
+
 if __name__ == "__main__":
 
     openai_chat = OpenAIChat(
@@ -0,0 +1,187 @@
+"""展開したソースのファイル一覧. ジョブごとに1度だけ作り、以降の処理はこれに問い合わせる"""
+
+import hashlib
+import logging
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+# ファイルの役割
+ROLE_MAIN = "main"          # mainのtexファイル
+ROLE_INCLUDED = "included"  # mainから読み込まれるtexファイル
+ROLE_TEX = "tex"            # どこからも読み込まれないtexファイル (下書きなど)
+ROLE_BIB = "bib"
+ROLE_FIGURE = "figure"
+ROLE_STYLE = "style"
+ROLE_OTHER = "other"
+
+_ROLES_BY_SUFFIX = {
+    ".tex": ROLE_TEX,
+    ".bib": ROLE_BIB, ".bbl": ROLE_BIB,
+    ".png": ROLE_FIGURE, ".jpg": ROLE_FIGURE, ".jpeg": ROLE_FIGURE, ".pdf": ROLE_FIGURE, ".eps": ROLE_FIGURE,
+    ".ps": ROLE_FIGURE, ".svg": ROLE_FIGURE, ".gif": ROLE_FIGURE, ".tikz": ROLE_FIGURE, ".pgf": ROLE_FIGURE,
+    ".sty": ROLE_STYLE, ".cls": ROLE_STYLE, ".bst": ROLE_STYLE, ".clo": ROLE_STYLE, ".def": ROLE_STYLE, ".cfg": ROLE_STYLE,
+}
+
+# \documentclassを探すために読む先頭のバイト数
+PREAMBLE_SNIFF_BYTES = 64 * 1024
+
+# コメントアウトされていない\documentclass
+_DOCUMENTCLASS = re.compile(r"^[^%\n]*\\documentclass", re.MULTILINE)
+
+@dataclass
+class ProjectFile:
+    """ソースの1つのファイル
+
+    Attributes:
+        path (Path): ソースのディレクトリからの相対パス
+        size (int): バイト数
+        role (str): 役割 (`ROLE_*`)
+        preamble (str): texファイルの先頭 (`PREAMBLE_SNIFF_BYTES`まで). texファイル以外はNone
+        digest (str): 内容のSHA-256. 最初に`ProjectManifest.digest`を呼んだときに計算する
+    """
+    path: Path
+    size: int
+    role: str
+    preamble: str = None
+    digest: str = None
+
+    @property
+    def has_documentclass(self) -> bool:
+        """先頭にコメントアウトされていない`\\documentclass`があるか"""
+        return self.preamble is not None and _DOCUMENTCLASS.search(self.preamble) is not None
+
+class ProjectManifest:
+    """展開したソースのファイル一覧
+
+    ディレクトリを1度だけ走査してパス・サイズ・役割を記録し、texファイルは先頭だけを読んでおく。
+    コピーした作業ディレクトリでも相対パスは同じなので、`root`を差し替えてそのまま使える。
+
+    Attributes:
+        root (Path): ソースのディレクトリ
+        files (dict): {相対パス: ProjectFile} (パスの順)
+    """
+
+    def __init__(self, root: Path, files: dict, logger: logging.Logger = LOGGER):
+        self.root = Path(root)
+        self.files = files
+        self._logger = logger
+        self._resolved_root = self.root.resolve()
+
+    @classmethod
+    def build(cls, root: Path, logger: logging.Logger = LOGGER) -> "ProjectManifest":
+        """ディレクトリを走査して一覧を作る。
+
+        Args:
+            root (Path): ソースのディレクトリ
+
+        Returns:
+            ProjectManifest: ファイル一覧
+        """
+        root = Path(root)
+        files = {}
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                full_path = Path(dir_path) / file_name
+                if not full_path.is_file():
+                    continue
+                path = full_path.relative_to(root)
+                role = _ROLES_BY_SUFFIX.get(full_path.suffix.lower(), ROLE_OTHER)
+                preamble = None
+                if role == ROLE_TEX:
+                    with open(full_path, "rb") as file:
+                        preamble = file.read(PREAMBLE_SNIFF_BYTES).decode("utf-8", errors="replace")
+                files[path] = ProjectFile(path=path, size=full_path.stat().st_size, role=role, preamble=preamble)
+        logger.info("ソースのファイル一覧を作成しました: %d 個 (%d bytes)", len(files), sum(f.size for f in files.values()))
+        return cls(root, files, logger=logger)
+
+    def with_root(self, root: Path) -> "ProjectManifest":
+        """同じ内容を別のディレクトリ(コピー先など)のものとして扱う一覧を返す。"""
+        return ProjectManifest(root, {path: ProjectFile(**vars(file)) for path, file in self.files.items()}, logger=self._logger)
+
+    @property
+    def total_bytes(self) -> int:
+        """全ファイルの合計バイト数"""
+        return sum(file.size for file in self.files.values())
+
+    def relative(self, path: Path) -> Path:
+        """パスをソースのディレクトリからの相対パスにする。ディレクトリの外ならNone。"""
+        path = Path(path)
+        if not path.is_absolute():
+            return path
+        try:
+            return path.resolve().relative_to(self._resolved_root)
+        except ValueError:
+            return None
+
+    def get(self, path: Path) -> ProjectFile:
+        """パス(絶対パスまたは相対パス)のファイル. 一覧に無ければNone。"""
+        relative = self.relative(path)
+        return self.files.get(relative) if relative is not None else None
+
+    def contains(self, path: Path) -> bool:
+        """一覧にあるファイルか (ファイルシステムには問い合わせない)"""
+        return self.get(path) is not None
+
+    def paths(self, role: str = None) -> list:
+        """ファイルの絶対パスのリスト. roleを指定すればその役割のものだけ。"""
+        return [self.root / path for path, file in self.files.items() if role is None or file.role == role]
+
+    def find_main_tex(self) -> Path:
+        """mainのtexファイルを選び、役割を`ROLE_MAIN`にする。
+
+        先頭に`\\documentclass`があるtexファイルのうち、最も浅い階層のものを選ぶ (同じ階層ならパスの順)。
+
+        Raises:
+            ValueError: 適切なtexファイルが見つからなかった。
+
+        Returns:
+            Path: mainのtexファイルの絶対パス
+        """
+        candidates = [file for file in self.files.values() if file.role in (ROLE_TEX, ROLE_MAIN) and file.has_documentclass]
+        if not candidates:
+            raise ValueError(f"適切なtexファイルが見つかりませんでした。 {self.root}")
+        main = min(candidates, key=lambda file: (len(file.path.parts), file.path.as_posix()))
+        for file in self.files.values():
+            if file.role == ROLE_MAIN and file is not main:
+                file.role = ROLE_TEX
+        main.role = ROLE_MAIN
+        if len(candidates) > 1:
+            self._logger.info("\\documentclassを含むtexファイルが %d 個あるため、%s をmainにします。", len(candidates), main.path)
+        return self.root / main.path
+
+    def mark_included(self, paths: list):
+        """mainから読み込まれるtexファイルの役割を`ROLE_INCLUDED`にする。"""
+        for path in paths:
+            file = self.get(path)
+            if file is not None and file.role == ROLE_TEX:
+                file.role = ROLE_INCLUDED
+
+    def refresh(self, path: Path):
+        """書き換えたファイルのサイズ・先頭・ハッシュを更新する。"""
+        file = self.get(path)
+        if file is None:
+            return
+        full_path = self.root / file.path
+        file.size = full_path.stat().st_size
+        file.digest = None
+        if file.preamble is not None:
+            with open(full_path, "rb") as f:
+                file.preamble = f.read(PREAMBLE_SNIFF_BYTES).decode("utf-8", errors="replace")
+
+    def digest(self, path: Path) -> str:
+        """ファイルの内容のSHA-256. 1度計算したら記録しておく。"""
+        file = self.get(path)
+        if file is None:
+            raise ValueError(f"ソースの一覧にないファイルです: {path}")
+        if file.digest is None:
+            sha256 = hashlib.sha256()
+            with open(self.root / file.path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(block)
+            file.digest = sha256.hexdigest()
+        return file.digest
@@ -0,0 +1,209 @@
+"""Redisを使った分散セマフォ"""
+
+import logging
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# KEYS[1]: リース (zset: token -> 期限), KEYS[2]: 待ち行列 (list), KEYS[3]: 待機中のtoken (zset: token -> 期限)
+# ARGV[1]: token, ARGV[2]: 上限数, ARGV[3]: TTL(秒)
+# 戻り値: 取得できれば1, できなければ0
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+  return 1
+end
+if not redis.call('ZSCORE', KEYS[3], ARGV[1]) then
+  redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+redis.call('ZADD', KEYS[3], now + ttl, ARGV[1])
+while true do
+  local head = redis.call('LINDEX', KEYS[2], 0)
+  if not head then break end
+  local alive = redis.call('ZSCORE', KEYS[3], head)
+  if alive and tonumber(alive) > now then break end
+  redis.call('LPOP', KEYS[2])
+  redis.call('ZREM', KEYS[3], head)
+end
+if redis.call('LINDEX', KEYS[2], 0) == ARGV[1] and redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('LPOP', KEYS[2])
+  redis.call('ZREM', KEYS[3], ARGV[1])
+  redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+  return 1
+end
+return 0
+"""
+
+# KEYS[1]: リース, ARGV[1]: token, ARGV[2]: TTL(秒)
+# 戻り値: リースが残っていて延長できれば1, 失効していれば0
+_REFRESH_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[2]), ARGV[1])
+  return 1
+end
+return 0
+"""
+
+class Lease:
+    """セマフォから取得したリース
+
+    保持している間はバックグラウンドのスレッドがTTLの1/3ごとに期限を延長する(ハートビート)。
+    プロセスが落ちてハートビートが止まれば、TTL経過後に他のジョブがスロットを回収できる。
+
+    Attributes:
+        token (str): リースの識別子
+    """
+
+    def __init__(self, semaphore: "RedisSemaphore", token: str):
+        self.token = token
+        self._semaphore = semaphore
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name=f"lease-{token}", daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        interval = self._semaphore.lease_ttl / 3
+        while not self._stopped.wait(interval):
+            try:
+                if not self._semaphore._refresh(self.token):
+                    self._semaphore._logger.warning("リースが失効していました: %s", self.token)
+                    return
+            except Exception as e:
+                self._semaphore._logger.warning("リースの延長に失敗しました: %s (%s)", self.token, e)
+
+    def release(self):
+        """リースを返却する。"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._semaphore._release(self.token)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class RedisSemaphore:
+    """Redisを使った、複数プロセス・複数マシンで共有できるセマフォ
+
+    - 取得は待ち行列(list)の順に行う(FIFO)。
+    - 待機中はポーリングせず、先頭の順番が来たときの通知をBLPOPで待つ。
+    - 保持中のリースはTTL付きで、ハートビートが途絶えたものは自動的に回収される。
+
+    Attributes:
+        redis_conn (redis.Redis): Redis 接続オブジェクト
+        name (str): キーの接頭辞
+        limit (int): 同時に保持できるリースの上限
+        lease_ttl (float): リースと待機登録の有効期限(秒)
+    """
+
+    def __init__(self, redis_conn, name: str, limit: int, lease_ttl: float = 30, logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            redis_conn (redis.Redis): Redis 接続オブジェクト
+            name (str): キーの接頭辞
+            limit (int): 同時に保持できるリースの上限
+            lease_ttl (float, optional): リースと待機登録の有効期限(秒). Defaults to 30.
+        """
+        self.redis_conn = redis_conn
+        self.name = name
+        self.limit = int(limit)
+        self.lease_ttl = float(lease_ttl)
+        self._logger = logger
+        self._acquire_script = redis_conn.register_script(_ACQUIRE_SCRIPT)
+        self._refresh_script = redis_conn.register_script(_REFRESH_SCRIPT)
+
+    @property
+    def _keys(self) -> list:
+        return [f"{self.name}:leases", f"{self.name}:queue", f"{self.name}:waiters"]
+
+    def _notify_key(self, token: str) -> str:
+        return f"{self.name}:notify:{token}"
+
+    def _try_acquire(self, token: str) -> bool:
+        return bool(self._acquire_script(keys=self._keys, args=[token, self.limit, self.lease_ttl]))
+
+    def _refresh(self, token: str) -> bool:
+        return bool(self._refresh_script(keys=self._keys[:1], args=[token, self.lease_ttl]))
+
+    def _notify_head(self):
+        """待ち行列の先頭を起こす。"""
+        head = self.redis_conn.lindex(self._keys[1], 0)
+        if head is None:
+            return
+        if isinstance(head, bytes):
+            head = head.decode("utf-8")
+        notify_key = self._notify_key(head)
+        pipe = self.redis_conn.pipeline()
+        pipe.rpush(notify_key, 1)
+        pipe.expire(notify_key, int(self.lease_ttl) + 1)
+        pipe.execute()
+
+    def _release(self, token: str):
+        self.redis_conn.zrem(self._keys[0], token)
+        self._notify_head()
+
+    def current(self) -> int:
+        """現在保持されているリースの数(期限切れのものも含む)"""
+        return int(self.redis_conn.zcard(self._keys[0]))
+
+    def position(self, token: str) -> int:
+        """待ち行列での位置(0始まり). 並んでいなければNone"""
+        position = self.redis_conn.lpos(self._keys[1], token)
+        return None if position is None else int(position)
+
+    def acquire(self, token: str = None, timeout: float = None, on_wait: callable = None) -> Lease:
+        """リースを取得する。取得できるまでブロックする。
+
+        Args:
+            token (str, optional): リースの識別子. 指定がなければ生成する.
+            timeout (float, optional): 待機する最大秒数. 指定がなければ無制限.
+            on_wait (callable, optional): 待機するたびに呼ばれる関数. 引数は(待ち行列での位置, 現在の保持数).
+
+        Raises:
+            TimeoutError: timeoutまでに取得できなかった場合
+
+        Returns:
+            Lease: 取得したリース
+        """
+        token = token or str(uuid.uuid4())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # 待機登録の期限が切れないよう、TTLより短い間隔で起きて登録を更新する
+        wait_interval = max(self.lease_ttl / 3, 1)
+        while True:
+            if self._try_acquire(token):
+                self.redis_conn.delete(self._notify_key(token))
+                # まだ空きがあれば次の待機者も起こす
+                self._notify_head()
+                return Lease(self, token)
+
+            if on_wait is not None:
+                on_wait(self.position(token), self.current())
+
+            wait = wait_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._cancel(token)
+                    raise TimeoutError(f"セマフォを取得できませんでした: {self.name} ({token})")
+                wait = min(wait, remaining)
+            self.redis_conn.blpop([self._notify_key(token)], timeout=max(int(wait), 1))
+
+    def _cancel(self, token: str):
+        """待ち行列から抜ける。"""
+        pipe = self.redis_conn.pipeline()
+        pipe.lrem(self._keys[1], 0, token)
+        pipe.zrem(self._keys[2], token)
+        pipe.delete(self._notify_key(token))
+        pipe.execute()
+        self._notify_head()
@@ -0,0 +1,161 @@
+"""ダウンロードしたarXivのソースを保存しておくストア"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import requests
+from .file_utils import _TeeReader, _source_url
+
+LOGGER = logging.getLogger(__name__)
+
+class ArxivSourceStore:
+    """arXivのソースをarxiv_id(バージョン込み)ごとにディスクに保存するストア
+
+    - バージョン付きのID (例: 1234.56789v2) は内容が変わらないので、保存済みならネットワークにアクセスしない。
+    - バージョンなしのID は ETag / Last-Modified を使った条件付きリクエストで再検証する。
+    - 保存量が`max_bytes`を超えたら、最後に使われた時刻が古いものから削除する。
+
+    Attributes:
+        root (Path): 保存先のディレクトリ
+        max_bytes (int): 保存するソースの合計バイト数の上限
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 2 * 1024 * 1024 * 1024, logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            root (Path): 保存先のディレクトリ
+            max_bytes (int, optional): 保存するソースの合計バイト数の上限. Defaults to 2GiB.
+        """
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._logger = logger
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def is_versioned(arxiv_id: str) -> bool:
+        """バージョン付きのIDかどうか"""
+        return re.search(r'v\d+$', arxiv_id) is not None
+
+    def _paths(self, arxiv_id: str) -> tuple:
+        """(ソースのパス, メタデータのパス)"""
+        name = arxiv_id.replace("/", "_")
+        return self.root / f"{name}.src", self.root / f"{name}.json"
+
+    def _touch(self, data_path: Path):
+        """最後に使われた時刻を更新する。"""
+        os.utime(data_path, None)
+
+    def _load_meta(self, meta_path: Path) -> dict:
+        try:
+            return json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, meta_path: Path, meta: dict):
+        """メタデータを一時ファイルから置き換えて書き込む。"""
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.root, prefix=f"{meta_path.stem}.",
+                                         suffix=".part", delete=False) as f:
+            f.write(json.dumps(meta, ensure_ascii=False))
+        os.replace(f.name, meta_path)
+
+    @contextmanager
+    def open(self, arxiv_id: str):
+        """arxiv_idのソースを読み込むストリームを開く。
+
+        保存済みで新しければファイルを、そうでなければダウンロード中のレスポンスをそのまま返す。
+        ダウンロードした内容は読み込みながら保存し、最後まで読み終えたらストアに登録する。
+
+        Args:
+            arxiv_id (str): arxivのid
+
+        Raises:
+            ValueError: ダウンロードに失敗したらエラー.
+
+        Yields:
+            ソースのバイト列を読めるファイルライクオブジェクト
+        """
+        data_path, meta_path = self._paths(arxiv_id)
+
+        if data_path.exists() and self.is_versioned(arxiv_id):
+            self._logger.info("保存済みのソースを使います: %s", data_path)
+            self._touch(data_path)
+            with open(data_path, "rb") as f:
+                yield f
+            return
+
+        headers = {}
+        if data_path.exists():
+            meta = self._load_meta(meta_path)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        url = _source_url(arxiv_id)
+        with requests.get(url, headers=headers, stream=True, timeout=600) as response:
+            if response.status_code == 304 and data_path.exists():
+                self._logger.info("保存済みのソースは最新でした: %s", data_path)
+                self._touch(data_path)
+                with open(data_path, "rb") as f:
+                    yield f
+                return
+            if response.status_code != 200:
+                raise ValueError(f"ダウンロード失敗. URL: {url}, HTTP status code: {response.status_code}")
+            response.raw.decode_content = True
+
+            # 同じIDを同時にダウンロードしても互いに壊さないよう、一時ファイルの名前は毎回変える
+            sink = tempfile.NamedTemporaryFile(dir=self.root, prefix=f"{data_path.stem}.", suffix=".part", delete=False)
+            part_path = Path(sink.name)
+            try:
+                with sink:
+                    tee = _TeeReader(response.raw, sink)
+                    yield tee
+                    # 読み残しがあっても最後まで保存する
+                    while tee.read(1024 * 1024):
+                        pass
+                size = part_path.stat().st_size
+                os.replace(part_path, data_path)
+            finally:
+                part_path.unlink(missing_ok=True)
+
+            meta = {
+                "arxiv_id": arxiv_id,
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "size": size,
+            }
+            self._write_meta(meta_path, meta)
+            self._logger.info("ソースを保存しました: %s (%d bytes)", data_path, meta["size"])
+        self.evict(keep=data_path)
+
+    def evict(self, keep: Path = None):
+        """合計サイズが上限以下になるまで、最後に使われた時刻が古いものから削除する。
+
+        Args:
+            keep (Path, optional): 削除しないソースのパス
+        """
+        entries = []
+        for data_path in self.root.glob("*.src"):
+            try:
+                stat = data_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, data_path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, data_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and data_path == keep:
+                continue
+            data_path.unlink(missing_ok=True)
+            data_path.with_suffix(".json").unlink(missing_ok=True)
+            total -= size
+            self._logger.info("保存済みのソースを削除しました: %s", data_path)
@@ -1,46 +1,303 @@
 """texをコンパイルするための諸々"""
 
+import os
+import re
+import shutil
 import time
+import hashlib
 import logging
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from pathlib import Path
 import subprocess
+from .metrics import directory_size
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 LOGGER = logging.getLogger(__name__)
 
+# ジョブをまたいで使い回すビルドディレクトリの合計サイズの上限
+DEFAULT_BUILD_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# 再試行すれば成功する可能性のある(一時的な)エラーのパターン
+TRANSIENT_ERROR_PATTERNS = [
+    re.compile(r"I can't write on file", re.IGNORECASE),
+    re.compile(r"Resource temporarily unavailable", re.IGNORECASE),
+    re.compile(r"Interrupted system call", re.IGNORECASE),
+    re.compile(r"Cannot allocate memory", re.IGNORECASE),
+    re.compile(r"luaotfload.*(?:reload|database|names)", re.IGNORECASE),
+    re.compile(r"font .* not loadable", re.IGNORECASE),
+]
+
+# file:line: message 形式 (-file-line-error) のエラー行
+_FILE_LINE_ERROR = re.compile(r"^(?P<file>[^\s:][^:]*\.(?:tex|sty|cls|bbl|aux|toc|ltx|def|cfg|clo)):(?P<line>\d+): (?P<message>.*)$")
+# "! message" 形式のエラー行と、それに続く "l.123 ..." 行
+_BANG_ERROR = re.compile(r"^! (?P<message>.*)$")
+_LINE_NUMBER = re.compile(r"^l\.(?P<line>\d+) ")
+
+@dataclass
+class LatexError:
+    """LaTeXのログから抽出したエラー
+
+    Attributes:
+        message (str): エラーメッセージ
+        file (str): エラーが起きたファイル. 分からなければNone
+        line (int): エラーが起きた行番号. 分からなければNone
+    """
+    message: str
+    file: str = None
+    line: int = None
+
+    @property
+    def is_transient(self) -> bool:
+        """再試行で解消しうるエラーかどうか"""
+        return any(pattern.search(self.message) for pattern in TRANSIENT_ERROR_PATTERNS)
+
+@dataclass
+class CompileResult:
+    """コンパイル結果
+
+    Attributes:
+        success (bool): コンパイルに成功したか
+        pdf_path (Path): 出力されたPDFのパス. 無ければNone
+        log_path (Path): LaTeXのログファイルのパス
+        errors (list): ログから抽出したエラー (LatexErrorのリスト)
+        attempts (int): 試行回数
+        returncode (int): 最後の試行の終了コード
+    """
+    success: bool
+    pdf_path: Path = None
+    log_path: Path = None
+    errors: list = field(default_factory=list)
+    attempts: int = 0
+    returncode: int = None
+
+def preamble_hash(content: str) -> str:
+    r"""プリアンブル(\begin{document}より前)のハッシュを返す。
+
+    Args:
+        content (str): mainのtexファイルの中身
+
+    Returns:
+        str: sha256
+    """
+    preamble = content.split(r"\begin{document}", 1)[0]
+    return hashlib.sha256(preamble.encode("utf-8")).hexdigest()
+
+def parse_latex_log(log_text: str) -> list:
+    """LaTeXのログからエラーを抽出する。
+
+    `-file-line-error`形式の行と、`! ...`形式の行(直後の`l.123`から行番号を拾う)の両方に対応する。
+
+    Args:
+        log_text (str): ログの中身
+
+    Returns:
+        list: LatexErrorのリスト
+    """
+    errors = []
+    pending: LatexError = None
+    for line in log_text.splitlines():
+        match = _FILE_LINE_ERROR.match(line)
+        if match:
+            pending = None
+            errors.append(LatexError(message=match.group("message").strip(),
+                                     file=match.group("file"),
+                                     line=int(match.group("line"))))
+            continue
+        match = _BANG_ERROR.match(line)
+        if match:
+            pending = LatexError(message=match.group("message").strip())
+            errors.append(pending)
+            continue
+        match = _LINE_NUMBER.match(line)
+        if match and pending is not None and pending.line is None:
+            pending.line = int(match.group("line"))
+            pending = None
+    return errors
+
+def is_transient_failure(errors: list, returncode: int, output: str = None) -> bool:
+    """失敗が一時的なもので、再試行する価値があるかを判定する。
+
+    シグナルで終了した場合と、すべてのエラーが一時的なパターンに一致する場合だけを一時的とみなす。
+    ログからエラーを抽出できなかった場合(ファイルが無い・致命的なエラー・latexmkのルールのエラーなど)は、
+    latexmkの出力が一時的なパターンに一致するときだけ一時的とみなし、それ以外は再試行しても同じ結果になるとみなす。
+
+    Args:
+        errors (list): LatexErrorのリスト
+        returncode (int): 終了コード
+        output (str, optional): latexmkの標準出力と標準エラー出力. Defaults to None.
+
+    Returns:
+        bool: 再試行する価値があればTrue
+    """
+    if returncode is not None and returncode < 0:
+        return True
+    if not errors:
+        return bool(output) and any(pattern.search(output) for pattern in TRANSIENT_ERROR_PATTERNS)
+    return all(error.is_transient for error in errors)
+
+class BuildDirLock:
+    """ビルドディレクトリを複数のジョブが同時に使わないためのファイルロック
+
+    ロックを取るとディレクトリの更新時刻を今にする (`evict_build_dirs`が最後に使われた順に削除するため)。
+    """
+
+    def __init__(self, build_dir: Path, blocking: bool = True):
+        self._path = Path(build_dir) / ".lock"
+        self._blocking = blocking
+        self._file = None
+
+    def __enter__(self):
+        while True:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self._path, "w")
+            if fcntl is None:
+                break
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX if self._blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._file.close()
+                raise
+            # 待っている間にディレクトリごと削除されていたら、作り直してロックし直す
+            try:
+                if os.stat(self._path).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        os.utime(self._path.parent, None)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+def evict_build_dirs(root: Path,
+                     max_bytes: int = DEFAULT_BUILD_CACHE_MAX_BYTES,
+                     keep: Path = None,
+                     logger: logging.Logger = LOGGER):
+    """`root/{arxiv_id}/{プリアンブルのハッシュ}`のビルドディレクトリを、合計サイズが上限以下になるまで最後に使われた順に削除する。
+
+    使用中(ロックされている)のディレクトリは削除しない。
+
+    Args:
+        root (Path): ビルドディレクトリをまとめたディレクトリ
+        max_bytes (int, optional): 合計サイズの上限. Defaults to DEFAULT_BUILD_CACHE_MAX_BYTES.
+        keep (Path, optional): 削除しないビルドディレクトリ
+    """
+    root = Path(root)
+    entries = []
+    for build_dir in root.glob("*/*"):
+        if not build_dir.is_dir():
+            continue
+        try:
+            entries.append((build_dir.stat().st_mtime, directory_size(build_dir), build_dir))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    keep = Path(keep).resolve() if keep is not None else None
+    for _, size, build_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and build_dir.resolve() == keep:
+            continue
+        try:
+            with BuildDirLock(build_dir, blocking=False):
+                shutil.rmtree(build_dir, ignore_errors=True)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+        total -= size
+        logger.info("ビルドディレクトリを削除しました: %s", build_dir)
+        try:
+            build_dir.parent.rmdir()
+        except OSError:
+            pass
+
 def compile_tex(source_file_path: Path,
                 working_dir: Path = None,
                 max_attempts: int = 5,
                 delay: int = 2,
+                build_dir: Path = None,
+                texmf_var_dir: Path = None,
+                lock_build_dir: bool = True,
                 logger: logging.Logger = LOGGER,
-                ):
+                ) -> CompileResult:
     """texファイルをコンパイルする。
 
+    `build_dir`を指定すると、aux等の中間ファイルとPDFをそこに出力する。
+    同じ`build_dir`を使い回せば、latexmkが前回の結果を使って差分だけを処理する。
+    `texmf_var_dir`を指定すると、luaotfloadのフォントキャッシュをそこに保存してジョブ間で共有する。
+    失敗した場合はログを解析し、一時的なエラーのときだけ再試行する。
+
     Args:
         source_file_path (Path): コンパイルしたいtexファイルのパス
         working_dir (Path, optional): 作業ディレクトリ。指定がなければsource_file_pathの親ディレクトリになる。
-        max_attempts (int, optional): コンパイルの最大試行回数 (デフォルトは3回)
+        max_attempts (int, optional): コンパイルの最大試行回数 (デフォルトは5回)
         delay (int, optional): 失敗時の再試行までの待機秒数 (デフォルトは2秒)
+        build_dir (Path, optional): 中間ファイルとPDFの出力先。指定がなければworking_dirに出力する。
+        texmf_var_dir (Path, optional): TEXMFVARとして使うディレクトリ。指定がなければ環境の設定に従う。
+        lock_build_dir (bool, optional): Falseなら出力先をロックしない (呼び出し元が`BuildDirLock`でロックしている場合)。
+
+    Returns:
+        CompileResult: コンパイル結果
     """
+    source_file_path = Path(source_file_path)
     if working_dir is None:
         working_dir = source_file_path.parent
         logger.debug(f"working_dirが指定されなかったので、{working_dir} でコンパイル作業を行います.")
+    output_dir = Path(build_dir) if build_dir is not None else Path(working_dir)
 
-    command = ["latexmk", "-lualatex", "-interaction=nonstopmode", str(source_file_path)]
+    command = ["latexmk", "-lualatex", "-interaction=nonstopmode", "-file-line-error"]
+    if build_dir is not None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        command.append(f"-outdir={output_dir}")
+    command.append(str(source_file_path))
+
+    env = os.environ.copy()
+    if texmf_var_dir is not None:
+        Path(texmf_var_dir).mkdir(parents=True, exist_ok=True)
+        env["TEXMFVAR"] = str(texmf_var_dir)
+
+    pdf_path = output_dir / f"{source_file_path.stem}.pdf"
+    log_path = output_dir / f"{source_file_path.stem}.log"
+    result = CompileResult(success=False, log_path=log_path)
 
     logger.info("コンパイル中")
-    for attempt in range(1, max_attempts + 1):
-        try:
-            result = subprocess.run(command,
-                                    cwd=working_dir,
-                                    check=True,
-                                    text=True,
-                                    capture_output=True)
-            logger.info("コンパイル成功")
-            return result
-        except subprocess.CalledProcessError as e:
-            if attempt < max_attempts:
-                logger.warning("コンパイル再試行中 (%d / %d)): %s", attempt, max_attempts, e)
+    started_at = time.time()
+    with BuildDirLock(output_dir) if lock_build_dir else nullcontext():
+        for attempt in range(1, max_attempts + 1):
+            logger.info("コンパイル試行中 %d/%d", attempt, max_attempts)
+            process = subprocess.run(command,
+                                     cwd=working_dir,
+                                     env=env,
+                                     text=True,
+                                     capture_output=True)
+            result.attempts = attempt
+            result.returncode = process.returncode
+            if process.returncode == 0:
+                logger.info("コンパイル成功")
+                result.success = True
+                break
+
+            log_text = log_path.read_text("utf-8", errors="replace") if log_path.exists() else process.stdout
+            result.errors = parse_latex_log(log_text)
+            for error in result.errors[:10]:
+                logger.warning("LaTeXエラー: %s:%s: %s", error.file, error.line, error.message)
+
+            if attempt < max_attempts and is_transient_failure(result.errors, process.returncode,
+                                                               output=f"{process.stdout}\n{process.stderr}"):
+                logger.warning("一時的なエラーのため再試行します (%d / %d)", attempt, max_attempts)
                 time.sleep(delay)
             else:
-                logger.error("コンパイル失敗 (%d / %d)): %s", attempt, max_attempts, e)
-                return result
+                logger.error("コンパイル失敗 (%d / %d)): returncode=%d", attempt, max_attempts, process.returncode)
+                break
+
+    # 失敗時は、前回のビルドで残った古いPDFを結果として扱わない
+    if pdf_path.exists() and (result.success or pdf_path.stat().st_mtime >= started_at):
+        result.pdf_path = pdf_path
+    return result
@@ -0,0 +1,138 @@
+"""mainのtexファイルから`\\input`などをたどり、文書から実際に読み込まれるtexファイルを求める
+
+arXivのソースには、使われていない下書き・古い版・スタイルの例などのtexファイルが含まれていることが多い。
+それらを翻訳しないよう、mainのファイルから到達できるファイルだけを文書の順に並べる。
+"""
+
+import logging
+import re
+from pathlib import Path
+from .project_manifest import ProjectManifest
+from .tex_lexer import tokenize, TOKEN_COMMAND, TOKEN_TEXT, TOKEN_GROUP, TOKEN_NEWLINE
+
+LOGGER = logging.getLogger(__name__)
+
+# ファイルを読み込むコマンド
+INPUT_COMMANDS = (r"\input", r"\include", r"\subfile")
+# ディレクトリとファイル名を別々に受け取るコマンド (importパッケージ)
+IMPORT_COMMANDS = (r"\import", r"\subimport", r"\inputfrom", r"\subinputfrom", r"\includefrom", r"\subincludefrom")
+
+_BRACE_ARGUMENT = re.compile(r"\{([^{}]*)\}")
+
+def _arguments(tokens: list, index: int, count: int) -> list:
+    """コマンドの{…}の引数を`count`個まで集める。
+
+    コマンドの直後の引数はコマンドのトークンに含まれるが、`\\input {sec}`のように空白を挟むと
+    空白のTEXTと引数のGROUPが別のトークンになるので、空白と改行を読み飛ばして続くGROUPも引数とする。
+
+    Returns:
+        list: 引数のリスト
+    """
+    token = tokens[index]
+    arguments = [argument.strip() for argument in _BRACE_ARGUMENT.findall(token.text[len(token.name):])]
+    position = index + 1
+    while len(arguments) < count:
+        following = position
+        while following < len(tokens) and (tokens[following].kind == TOKEN_NEWLINE or
+                                           (tokens[following].kind == TOKEN_TEXT and tokens[following].text.isspace())):
+            following += 1
+        if following >= len(tokens) or tokens[following].kind != TOKEN_GROUP or not tokens[following].text.startswith("{"):
+            break
+        arguments.append(tokens[following].text[1:-1].strip())
+        position = following + 1
+    return arguments
+
+def _candidates(name: str, always_tex: bool = False) -> list:
+    """TeXと同じく、拡張子の無い名前には`.tex`を補った候補を先に試す。"""
+    if always_tex:
+        return [name + ".tex"]
+    if name.endswith(".tex"):
+        return [name]
+    return [name + ".tex", name]
+
+def _resolve(name: str, search_dirs: list, root_dir: Path, manifest: ProjectManifest = None, always_tex: bool = False) -> Path:
+    """読み込むファイル名を実際のパスにする。見つからない、またはroot_dirの外ならNone。"""
+    for search_dir in search_dirs:
+        for candidate in _candidates(name, always_tex=always_tex):
+            path = (search_dir / candidate).resolve()
+            if root_dir not in path.parents:
+                continue
+            if manifest.contains(path) if manifest is not None else path.is_file():
+                return path
+    return None
+
+def resolve_tex_files(main_tex_path: Path,
+                      root_dir: Path = None,
+                      manifest: ProjectManifest = None,
+                      logger: logging.Logger = LOGGER) -> dict:
+    """mainのtexファイルから`\\input`・`\\include`・`\\subfile`・`\\import`などをたどり、読み込まれるtexファイルを返す。
+
+    - 読み込む位置で深さ優先にたどるので、結果は文書に現れる順になる。同じファイルは最初の1回だけ数える。
+    - 拡張子の無い名前は`.tex`を補う (`\\include`は常に補う)。
+    - `\\input`などはmainのディレクトリ(`\\import`した先ではそのディレクトリ)から探し、無ければ読み込み元のディレクトリから探す。
+    - `\\includeonly`があれば、そこに無い`\\include`は読み込まない。
+    - コメントやverbatimの中のコマンドは無視する。引数にマクロを使っているなど解決できないものは警告だけ出す。
+
+    Args:
+        main_tex_path (Path): mainのtexファイル
+        root_dir (Path, optional): ソースのディレクトリ. この外のファイルはたどらない. 指定がなければmainのディレクトリ.
+        manifest (ProjectManifest, optional): ソースのファイル一覧. 指定すればファイルの有無をファイルシステムに問い合わせない.
+        logger (logging.Logger, optional): ロガー. Defaults to LOGGER.
+
+    Returns:
+        dict: {texファイルのパス: そのファイルのTokenのリスト} (文書の順)
+    """
+    main_tex_path = Path(main_tex_path).resolve()
+    root_dir = Path(root_dir).resolve() if root_dir is not None else main_tex_path.parent
+    files = {}
+    include_only = None
+
+    def _visit(file_path: Path, base_dir: Path):
+        nonlocal include_only
+        tokens = tokenize(file_path.read_text("utf-8"))
+        files[file_path] = tokens
+        for index, token in enumerate(tokens):
+            if token.kind != TOKEN_COMMAND:
+                continue
+            if token.name not in INPUT_COMMANDS and token.name not in IMPORT_COMMANDS and token.name != r"\includeonly":
+                continue
+            arguments = _arguments(tokens, index, 2 if token.name in IMPORT_COMMANDS else 1)
+            target = None
+            if token.name == r"\includeonly":
+                if arguments:
+                    include_only = {name.strip() for name in arguments[0].split(",") if name.strip()}
+                continue
+            if token.name in INPUT_COMMANDS:
+                if arguments:
+                    name = arguments[0]
+                elif token.name == r"\input" and index + 1 < len(tokens) and tokens[index + 1].kind == TOKEN_TEXT \
+                        and tokens[index + 1].text[:1].isspace() and tokens[index + 1].text.split():
+                    # `\input intro` の形 (ファイル名は空白まで)
+                    name = tokens[index + 1].text.split()[0]
+                else:
+                    logger.warning("読み込むファイルを解決できません: %s (%s)", token.text, file_path.name)
+                    continue
+                if token.name == r"\include" and include_only is not None and name not in include_only:
+                    continue
+                target = _resolve(name, [base_dir, file_path.parent], root_dir, manifest=manifest,
+                                  always_tex=token.name == r"\include")
+                target_base = base_dir
+            elif token.name in IMPORT_COMMANDS:
+                if len(arguments) < 2:
+                    logger.warning("読み込むファイルを解決できません: %s (%s)", token.text, file_path.name)
+                    continue
+                directory, name = arguments[0], arguments[1]
+                # sub〜は読み込み元からの相対パス、それ以外はmainのディレクトリからのパス
+                import_dir = (file_path.parent if token.name.startswith(r"\sub") else root_dir) / directory
+                target = _resolve(name, [import_dir], root_dir, manifest=manifest)
+                target_base = import_dir
+            else:
+                continue
+
+            if target is None:
+                logger.warning("読み込まれるファイルが見つかりません: %s (%s)", token.text, file_path.name)
+            elif target not in files:
+                _visit(target, target_base.resolve())
+
+    _visit(main_tex_path, main_tex_path.parent)
+    return files
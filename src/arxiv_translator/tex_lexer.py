@@ -0,0 +1,210 @@
+"""texを1回の走査でトークンに分ける字句解析
+
+コメントの除去・空行の整理・コマンドだけのファイルの判定・セクションでの分割は、
+どれもこのモジュールのトークン列の上で行う (ファイルごとに字句解析は1度だけ)。
+LaTeXを展開するわけではなく、コマンド・括弧・環境・コメント・テキストの境界だけを見る。
+"""
+
+import re
+from typing import NamedTuple
+
+# トークンの種類
+TOKEN_COMMAND = "command"            # \section, \%, \\ など (直後の単純な引数を含む)
+TOKEN_BEGIN_ENV = "begin_env"        # \begin{名前}
+TOKEN_END_ENV = "end_env"            # \end{名前}
+TOKEN_VERBATIM = "verbatim"          # verbatim系の環境・\verb (中身は解釈しない)
+TOKEN_GROUP = "group"                # 入れ子もコマンドも含まない {…} または […]
+TOKEN_BEGIN_GROUP = "begin_group"    # それ以外の {
+TOKEN_END_GROUP = "end_group"        # }
+TOKEN_BEGIN_OPTION = "begin_option"  # [
+TOKEN_END_OPTION = "end_option"      # ]
+TOKEN_COMMENT = "comment"            # %から行末まで (改行は含まない)
+TOKEN_NEWLINE = "newline"
+TOKEN_TEXT = "text"                  # 上記以外の文字列 (空白を含む)
+
+# 中身をそのまま残す(コメントやコマンドとして解釈しない)環境
+VERBATIM_ENVIRONMENTS = ("verbatim", "verbatim*", "Verbatim", "Verbatim*", "lstlisting", "minted", "alltt")
+
+# チャンク分けの境界にするセクションのコマンド
+SECTION_COMMANDS = (r"\section", r"\subsection", r"\subsubsection")
+
+# 入れ子もコマンドも含まない引数. コマンドと一緒に1つのトークンにして、トークンの数を減らす
+_SIMPLE_ARGUMENT = r"(?:\{[^\\%{}\[\]\r\n]*\}|\[[^\\%{}\[\]\r\n]*\])"
+
+_TOKEN_PATTERN = re.compile(
+    r"(?P<verbatim>\\begin\s*\{(?P<verbatim_name>" + "|".join(re.escape(name) for name in VERBATIM_ENVIRONMENTS) + r")\}"
+    r"(?s:.*?)\\end\s*\{(?P=verbatim_name)\}"
+    r"|\\verb\*?(?P<verb_delimiter>[^A-Za-z\s*])[^\r\n]*?(?P=verb_delimiter))"
+    r"|(?P<begin_env>\\begin\s*\{\s*(?P<begin_name>[^{}]*?)\s*\})"
+    r"|(?P<end_env>\\end\s*\{\s*(?P<end_name>[^{}]*?)\s*\})"
+    r"|(?P<command>(?P<command_name>\\(?:[A-Za-z]+|[^\r\n])?)\*?" + _SIMPLE_ARGUMENT + "*)"
+    r"|(?P<comment>%[^\r\n]*)"
+    r"|(?P<newline>\r\n|\r|\n)"
+    r"|(?P<group>" + _SIMPLE_ARGUMENT + ")"
+    r"|(?P<begin_group>\{)"
+    r"|(?P<end_group>\})"
+    r"|(?P<begin_option>\[)"
+    r"|(?P<end_option>\])"
+    r"|(?P<text>[^\\%{}\[\]\r\n]+)"
+)
+
+class Token(NamedTuple):
+    """字句解析のトークン
+
+    Attributes:
+        kind (str): トークンの種類 (`TOKEN_*`)
+        text (str): トークンの文字列. 全トークンの`text`を連結すると元のテキストに戻る
+        start (int): テキスト中の開始位置
+        end (int): テキスト中の終了位置
+        name (str): コマンドならコマンド名(`\\section`など. `*`と引数は含まない), 環境なら環境名. それ以外はNone
+    """
+    kind: str
+    text: str
+    start: int
+    end: int
+    name: str = None
+
+# 種類ごとの、名前を取り出すグループ
+_NAME_GROUPS = {TOKEN_COMMAND: "command_name", TOKEN_BEGIN_ENV: "begin_name", TOKEN_END_ENV: "end_name",
+                TOKEN_VERBATIM: "verbatim_name"}
+
+def tokenize(content: str) -> list:
+    """texのテキストをトークンに分ける。テキストの長さに対して線形時間で終わる。
+
+    Args:
+        content (str): texのテキスト
+
+    Returns:
+        list: Tokenのリスト
+    """
+    tokens = []
+    append = tokens.append
+    # トークンの数だけ呼ばれるので、Tokenのコンストラクタを経由せずにタプルを作る
+    new_token = tuple.__new__
+    name_group_of = _NAME_GROUPS.get
+    for match in _TOKEN_PATTERN.finditer(content):
+        # 外側のグループが最後に閉じるので、lastgroupがそのまま種類になる
+        kind = match.lastgroup
+        name_group = name_group_of(kind)
+        append(new_token(Token, (kind, match.group(), match.start(), match.end(),
+                                 match.group(name_group) if name_group else None)))
+    return tokens
+
+def join_tokens(tokens: list) -> str:
+    """トークンを連結してテキストに戻す。"""
+    return "".join(token.text for token in tokens)
+
+def clean_tokens(tokens: list, remove_comments: bool = True, reduce_newlines: bool = True) -> list:
+    """コメントの除去と空行の整理を1回の走査で行う。
+
+    - コメントだけの行は、改行ごと取り除く (空行として残すと段落が区切られてしまうため)。
+    - 行末のコメントは取り除き、行の残りは残す。
+    - 空白だけの行は空行にし、連続する空行は1行にまとめる。
+    - 改行は`\\n`にそろえ、末尾の改行は残さない。
+
+    Args:
+        tokens (list): `tokenize`の結果
+        remove_comments (bool, optional): コメントを取り除くか. Defaults to True.
+        reduce_newlines (bool, optional): 連続する空行を1行にまとめるか. Defaults to True.
+
+    Returns:
+        list: 残したTokenのリスト (位置は元のテキストでの位置のまま)
+    """
+    cleaned = []
+    line = []
+    blank = True          # 今の行が空白だけか
+    has_comment = False   # 今の行にコメントがあったか
+    prev_blank = False    # 直前に残した行が空行か
+    emitted = False       # 行を1つでも残したか
+    newline = None        # 直前に残した行の終わりの改行. 次の行を残すときに出力する
+    for token in tokens + [None]:
+        kind = token.kind if token is not None else None
+        if kind == TOKEN_COMMENT and remove_comments:
+            has_comment = True
+            continue
+        if token is not None and kind != TOKEN_NEWLINE:
+            line.append(token)
+            if blank and not (kind == TOKEN_TEXT and token.text.isspace()):
+                blank = False
+            continue
+
+        # 行の終わり
+        if token is None and not line and not has_comment:
+            break
+        if blank and has_comment:
+            # コメントだけの行は無かったことにする
+            pass
+        elif blank and reduce_newlines and prev_blank:
+            pass
+        else:
+            if emitted:
+                cleaned.append(newline if newline.text == "\n" else newline._replace(text="\n"))
+            if not (blank and reduce_newlines):
+                cleaned += line
+            emitted = True
+            prev_blank = blank
+            newline = token
+        line = []
+        blank = True
+        has_comment = False
+    return cleaned
+
+def split_tokens(tokens: list, is_boundary: callable) -> list:
+    """`is_boundary`を満たすトークンの直前で分割する。最初の部分は空でも必ず含める。
+
+    Args:
+        tokens (list): Tokenのリスト
+        is_boundary (callable): Tokenを受け取り、その直前で区切るならTrueを返す関数
+
+    Returns:
+        list: Tokenのリストのリスト
+    """
+    parts = [[]]
+    for token in tokens:
+        if is_boundary(token):
+            parts.append([])
+        parts[-1].append(token)
+    return parts
+
+def is_section_command(token: Token) -> bool:
+    """`\\section`・`\\subsection`・`\\subsubsection`のトークンか (`\\sectionmark`などは含まない)"""
+    return token.kind == TOKEN_COMMAND and token.name in SECTION_COMMANDS
+
+def find_environment(tokens: list, name: str) -> int:
+    """`\\begin{name}`のトークンの位置(リストのインデックス)を返す。無ければNone。"""
+    for index, token in enumerate(tokens):
+        if token.kind == TOKEN_BEGIN_ENV and token.name == name:
+            return index
+    return None
+
+def is_only_commands(tokens: list) -> bool:
+    """コメントと空白を除いて、コマンドとその引数({…}や[…]の中身)だけでできているか。
+
+    括弧の外にテキストがある、または括弧の対応が取れていなければFalse。
+
+    Args:
+        tokens (list): Tokenのリスト
+
+    Returns:
+        bool: コマンドだけならTrue
+    """
+    group_depth = 0
+    option_depth = 0
+    for token in tokens:
+        kind = token.kind
+        if kind == TOKEN_BEGIN_GROUP:
+            group_depth += 1
+        elif kind == TOKEN_END_GROUP:
+            group_depth -= 1
+            if group_depth < 0:
+                return False
+        elif kind == TOKEN_BEGIN_OPTION:
+            option_depth += 1
+        elif kind == TOKEN_END_OPTION:
+            option_depth -= 1
+            if option_depth < 0:
+                return False
+        elif kind == TOKEN_VERBATIM or (kind == TOKEN_TEXT and not token.text.isspace()):
+            if group_depth == 0 and option_depth == 0:
+                return False
+    return group_depth == 0 and option_depth == 0
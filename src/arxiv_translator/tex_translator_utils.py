@@ -2,6 +2,8 @@
 import re
 import logging
 from jinja2 import Template, StrictUndefined
+from . import tex_lexer
+from .tex_lexer import tokenize, join_tokens, clean_tokens, split_tokens, is_section_command, find_environment
 
 LOGGER = logging.getLogger(__name__)
 
@@ -55,87 +57,248 @@ def parse_code_blocks(text: str) -> list:
         })
     return code_blocks
 
-def split_tex_contents(content: str, flag=r"\section") -> list:
+def split_tex_contents(content: str, flag=r"\section", tokens: list = None) -> list:
     """受け取ったcontentsをflagで分割, 前にくっつける.
 
+    flagはコマンドまたは`\\begin{環境名}`で、トークン単位で比べる (`\\section`で`\\sectionmark`は分割しない)。
+
     Args:
         contents (str): 入力テキスト
-        flag (regexp, optional): 分割フラグ. Defaults to r"\\section".
+        flag (str, optional): 分割フラグ. Defaults to r"\\section".
+        tokens (list, optional): contentsを`tokenize`した結果. 無ければここで字句解析する.
 
     Returns:
         list: 分割されたテキスト
     """
+    tokens = tokens if tokens is not None else tokenize(content)
+    flag_token = tokenize(flag)[0]
+    parts = split_tokens(tokens, lambda token: token.kind == flag_token.kind and token.name == flag_token.name)
+    return [join_tokens(part) for part in parts]
 
-    parts: list = content.split(flag)
-    results: list=[parts[0]]
-    for part in parts[1:]:
-        results.append(flag+part)
-    return results
+def _split_subsubsections(tokens: list) -> list:
+    # section, subsection, subsubsectionのどれかの直前で区切ればsubsubsectionになる
+    return split_tokens(tokens, is_section_command)
 
-def split_tex_into_subsubsections(contents: str) -> list:
+def split_tex_into_subsubsections(contents: str, tokens: list = None) -> list:
     """texのコンテンツをsubsubsectionに分割してリストにする.
 
     Args:
         contents (str): texファイルの中身
+        tokens (list, optional): contentsを`tokenize`した結果. 無ければここで字句解析する.
 
     Returns:
         list: subsubsectionのリスト
     """
+    tokens = tokens if tokens is not None else tokenize(contents)
+    return [join_tokens(part) for part in _split_subsubsections(tokens)]
+
+def _split_blocks(tokens: list) -> list:
+    blocks: list = []
+    block: list = []
+    line: list = []
+    depth = 0
+    starts_env = False
+    ends_env = False
+    for index, token in enumerate(tokens):
+        line.append(token)
+        if token.kind in (tex_lexer.TOKEN_BEGIN_ENV, tex_lexer.TOKEN_END_ENV) and token.name != "document":
+            if token.kind == tex_lexer.TOKEN_BEGIN_ENV:
+                starts_env = starts_env or depth == 0
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+                ends_env = ends_env or depth == 0
+        if token.kind != tex_lexer.TOKEN_NEWLINE and index < len(tokens) - 1:
+            continue
+
+        # トップレベルの環境の直前で区切る
+        if starts_env and block:
+            blocks.append(block)
+            block = []
+        block += line
+        # トップレベルの空行、環境の終わりで区切る
+        blank = all(item.text.isspace() for item in line)
+        if depth == 0 and (ends_env or blank):
+            blocks.append(block)
+            block = []
+        line = []
+        starts_env = False
+        ends_env = False
+
+    if block:
+        blocks.append(block)
+    return blocks
+
+def split_tex_into_blocks(content: str, tokens: list = None) -> list:
+    """texのコンテンツを、段落(空行)と環境(\begin～\end)の境界で分割する。
+
+    環境の内側では分割しない(`document`環境は除く)。分割結果を連結すると元のテキストに戻る。
 
-    sections = split_tex_contents(content=contents, flag=r"\section")
+    Args:
+        content (str): texのコンテンツ
+        tokens (list, optional): contentを`tokenize`した結果. 無ければここで字句解析する.
 
-    subsections = []
-    for section in sections:
-        subsections += split_tex_contents(content=section, flag=r"\subsection")
+    Returns:
+        list: ブロックのリスト
+    """
+    tokens = tokens if tokens is not None else tokenize(content)
+    return [join_tokens(block) for block in _split_blocks(tokens)]
+
+def _count_chunks(counts: list, capacity: int) -> int:
+    """順序を保ったまま、各チャンクの合計がcapacity以下になるよう詰めたときのチャンク数を返す。"""
+    n_chunks = 0
+    total = None
+    for count in counts:
+        if total is None or total + count > capacity:
+            n_chunks += 1
+            total = count
+        else:
+            total += count
+    return n_chunks
+
+def _suffix_chunk_counts(counts: list, prefix: list, capacity: int) -> list:
+    """各位置から末尾までを`_count_chunks`と同じく貪欲に詰めたときのチャンク数を、右から順に1度で求める。
+
+    Returns:
+        list: i番目が`_count_chunks(counts[i:], capacity)`のリスト (長さは`len(counts) + 1`)
+    """
+    suffix_counts = [0] * (len(counts) + 1)
+    end = len(counts)
+    for start in range(len(counts) - 1, -1, -1):
+        # startからのチャンクはendの手前まで. 次のチャンクはendから始まる
+        while prefix[end] - prefix[start] > capacity:
+            end -= 1
+        suffix_counts[start] = 1 + suffix_counts[end]
+    return suffix_counts
+
+def balanced_partition(counts: list, capacity: int) -> list:
+    """順序を保ったまま、要素を最小のチャンク数に分け、かつ各チャンクの合計をなるべく揃える。
+
+    1. 貪欲法で、合計がcapacity以下になる最小のチャンク数kを求める。
+    2. k個に分けたときの最大値の最小値を二分探索で求める。
+    3. その上限のもとで、各境界を累積和が均等割りの位置に最も近くなるように決める。
 
-    subsubsections = []
-    for subsection in subsections:
-        subsubsections += split_tex_contents(content=subsection, flag=r"\subsubsection")
+    Args:
+        counts (list): 各要素のトークン数
+        capacity (int): 1チャンクのトークン数の上限 (各要素はcapacity以下であること)
 
-    return subsubsections
+    Returns:
+        list: 各チャンクの(開始, 終了)のインデックスのリスト
+    """
+    if not counts:
+        return []
+    n_chunks = _count_chunks(counts, capacity)
+
+    # k個に分けられる最小の上限を二分探索
+    low, high = max(counts), min(capacity, sum(counts))
+    while low < high:
+        middle = (low + high) // 2
+        if _count_chunks(counts, middle) <= n_chunks:
+            high = middle
+        else:
+            low = middle + 1
+    limit = low
+
+    prefix = [0]
+    for count in counts:
+        prefix.append(prefix[-1] + count)
+    total = prefix[-1]
+    suffix_counts = _suffix_chunk_counts(counts, prefix, limit)
+
+    bounds = []
+    start = 0
+    for i in range(1, n_chunks):
+        target = total * i / n_chunks
+        best = None
+        for end in range(start + 1, len(counts)):
+            if prefix[end] - prefix[start] > limit:
+                break
+            # 残りを上限以内で詰め切れる境界だけを候補にする
+            if suffix_counts[end] > n_chunks - i:
+                continue
+            if best is None or abs(prefix[end] - target) < abs(prefix[best] - target):
+                best = end
+        if best is None:
+            break
+        bounds.append((start, best))
+        start = best
+    bounds.append((start, len(counts)))
+    return bounds
 
 def split_tex_to_chunks(content: str,
                         token_counter: callable = len,
                         chunk_size: int = 2048,
+                        overhead_tokens: int = 0,
+                        tokens: list = None,
                         logger: logging.Logger = LOGGER,
                         ) -> list:
     """texファイルを翻訳のためにチャンク分けする。
 
+    各subsubsectionのトークン数は1度だけ数え、チャンクのトークン数はその合計で見積もる。
+    チャンクの大きさは、文書の順序を保ったまま`balanced_partition`で揃える。
+    chunk_sizeを超えるsubsubsectionは、段落や環境の境界でさらに分割する。
+
     Args:
         contents (str): 元ファイルのテキスト
+        token_counter (callable, optional): テキストのトークン数を数える関数. Defaults to len.
         chunk_size (int): 分けるチャンクのサイズ
+        overhead_tokens (int, optional): チャンクごとに加わるプロンプトの固定部分のトークン数. Defaults to 0.
+        tokens (list, optional): contentを`tokenize`した結果. 無ければここで字句解析する.
 
     Returns:
         list: チャンクのリスト
     """
 
     chunks: list = []
+    tokens = tokens if tokens is not None else tokenize(content)
 
-    if r"\begin{document}" in content:
+    document_index = find_environment(tokens, "document")
+    if document_index is not None:
         logger.info(r"\begin{document}が含まれていたので、この箇所でチャンクを区切ります。")
-        contents = split_tex_contents(content, r"\begin{document}")
-        chunks.append(f"% skip start\n{contents.pop(0)}\n% skip end\n")
-        content = "".join(contents)
+        chunks.append(f"% skip start\n{join_tokens(tokens[:document_index])}\n% skip end\n")
+        tokens = tokens[document_index:]
 
-    subsubsections = split_tex_into_subsubsections(content)
+    subsubsection_tokens = _split_subsubsections(tokens)
+    subsubsections = [join_tokens(part) for part in subsubsection_tokens]
+    token_counts = [token_counter(subsubsection) for subsubsection in subsubsections]
 
-    max_size = max([token_counter(subsubsection) for subsubsection in subsubsections])
+    max_size = overhead_tokens + max(token_counts)
     logger.info("最大チャンクサイズ: %s", chunk_size)
     logger.info("subsubsectionの最大トークン数: %s", max_size)
     if chunk_size is None:
         chunk_size = max_size
-    elif max_size > chunk_size:
-        logger.warning("既定した最大chunk_sizeを超えるサイズのsubsubsectionがあります. chunk_size: %d, max_size: %d", chunk_size, max_size)
-
-    chunk = ""
-    for subsubsection in subsubsections:
-        if token_counter(chunk + subsubsection) > chunk_size:
-            chunks.append(chunk)
-            chunk = subsubsection
-        else:
-            chunk += subsubsection
+    capacity = max(chunk_size - overhead_tokens, 1)
+
+    # 大きすぎるsubsubsectionは段落・環境の境界で分割する
+    pieces: list = []
+    piece_counts: list = []
+    for subsubsection, part, n_tokens in zip(subsubsections, subsubsection_tokens, token_counts):
+        if n_tokens <= capacity:
+            pieces.append(subsubsection)
+            piece_counts.append(n_tokens)
+            continue
+        blocks = [join_tokens(block) for block in _split_blocks(part)]
+        block_counts = [token_counter(block) for block in blocks]
+        logger.info("chunk_sizeを超えるsubsubsectionを %d 個のブロックに分割しました。(%d tokens)", len(blocks), n_tokens)
+        for block, block_tokens in zip(blocks, block_counts):
+            if block_tokens > capacity:
+                logger.warning("これ以上分割できないブロックがchunk_sizeを超えています. chunk_size: %d, size: %d",
+                               chunk_size, overhead_tokens + block_tokens)
+        pieces += blocks
+        piece_counts += block_counts
+
+    # chunk_sizeを超えるブロックは単独のチャンクにし、その間をバランスよく分割する
+    segment_start = 0
+    for i in range(len(pieces) + 1):
+        if i < len(pieces) and piece_counts[i] <= capacity:
+            continue
+        segment = piece_counts[segment_start:i]
+        for start, end in balanced_partition(segment, capacity):
+            chunks.append("".join(pieces[segment_start + start:segment_start + end]))
+        if i < len(pieces):
+            chunks.append(pieces[i])
+        segment_start = i + 1
 
-    chunks.append(chunk)
     logger.info("総チャンク数: %s", len(chunks))
     return chunks
 
@@ -166,36 +329,36 @@ def insert_text_after_documentclass(content: str, template: Template, logger: lo
         content=rest
     )
 
+def preprocess_tex(tex_content: str, tokens: list = None, logger: logging.Logger = LOGGER) -> tuple:
+    """コメントの除去と空行の整理を、1回の字句解析で行う。
+
+    `remove_comments`と`reduce_newlines`を続けて呼ぶのと同じ結果に、整理後のトークンを添えて返す。
+    トークンは`is_only_commands`や`split_tex_to_chunks`にそのまま渡せる。
+
+    Args:
+        tex_content (str): texのテキスト
+        tokens (list, optional): tex_contentを`tokenize`した結果. 無ければここで字句解析する.
+
+    Returns:
+        tuple: (整理後のテキスト, 整理後のTokenのリスト)
+    """
+    tokens = clean_tokens(tokens if tokens is not None else tokenize(tex_content))
+    output_content = join_tokens(tokens)
+    logger.info(f"コメントの削減: {len(tex_content)} -> {len(output_content)}")
+    return output_content, tokens
+
 def remove_comments(tex_content: str, logger: logging.Logger = LOGGER) -> str:
     """
     与えられた文字列（複数行）から LaTeX のコメントを削除して返す関数。
     
     ・LaTeX のルール:
        直前に連続するバックスラッシュ数が偶数個の場合のみ
-       '%' はコメント開始とみなし、残りを削除する。
-    ・行単位でコメント除去を行い、処理後の行を改行で連結して返す。
+       '%' はコメント開始とみなし、残りを削除する。(字句解析で`\\%`はコマンドになる)
+    ・コメントだけの行は改行ごと削除し、処理後の行を改行で連結して返す。
+    ・verbatim系の環境と`\\verb`の中の'%'はコメントとみなさない。
     """
-
-    unprocessed_lines = tex_content.splitlines()
-    processed_lines = []
-
-    # テキストを改行で分割し、各行についてコメント削除
-    for line in unprocessed_lines:
-        new_line_chars = []
-        backslash_count = 0
-        for ch in line:
-            if ch == '%' and backslash_count % 2 == 0:
-                break
-            backslash_count = backslash_count + 1 if ch == '\\' else 0
-            new_line_chars.append(ch)
-        # 結果
-        processed_lines.append("".join(new_line_chars))
-    
-    output_content = "\n".join(processed_lines)
-    
-    logging.info(f"コメントの削減: {len(tex_content)} -> {len(output_content)}")
-
-    # 処理後の行を改行でつないで返す
+    output_content = join_tokens(clean_tokens(tokenize(tex_content), reduce_newlines=False))
+    logger.info(f"コメントの削減: {len(tex_content)} -> {len(output_content)}")
     return output_content
 
 def reduce_newlines(text: str) -> str:
@@ -207,46 +370,20 @@ def reduce_newlines(text: str) -> str:
     Returns:
         str: 空行がまとめられたテキスト
     """
-    lines = text.splitlines()
-    reduced_lines = []
-    prev_empty = False
-
-    for line in lines:
-        # 半角スペースだけの行も空行とみなす
-        if line.strip() == "":
-            if not prev_empty:
-                reduced_lines.append("")
-            prev_empty = True
-        else:
-            reduced_lines.append(line)
-            prev_empty = False
+    # 半角スペースだけの行も空行とみなす
+    return join_tokens(clean_tokens(tokenize(text), remove_comments=False))
 
-    return "\n".join(reduced_lines)
 
-
-def is_only_commands(content: str) -> bool:
+def is_only_commands(content: str, tokens: list = None) -> bool:
     """コメント除去後の文字列が、空白を除いて「コマンド（スラッシュで始まるもの）とその引数ブロック（{…} または […]）
     のみ」で構成されているかをチェックする。
     
-    アプローチ：
-      1. 余分な空白を除去
-      2. 角括弧ブロック（入れ子はしないので単純な [^][]*）を除去
-      3. 中括弧ブロックは入れ子対応のため、最も内側の {…} （中に { や } を含まない部分）を繰り返し除去
-      4. 最後に、スラッシュで始まるコマンド（アルファベット連続または1文字）を除去
-      5. すべて除去できれば、元はコマンド（＋ブロック・空白）のみということになる
-    """
-
-    text = remove_comments(content)
-    # 余白（空白文字、改行など）を除去
-    s = re.sub(r'\s+', '', text)
-    # 角括弧 [...] ブロックは入れ子を考えなくてもよいので一括除去
-    s = re.sub(r'\[[^\[\]]*\]', '', s)
-    # 中括弧 {…} ブロックについては、入れ子対応のため「最も内側」のブロックを繰り返し除去
-    old = None
-    while s != old:
-        old = s
-        s = re.sub(r'\{[^{}]*\}', '', s)
-    # コマンドは、\ の後に英字が続く場合は連続英字、そうでなければ1文字コマンドとする
-    s = re.sub(r'\\(?:[A-Za-z]+|.)', '', s)
-    # すべてが消えていれば有効（空文字列になっているはず）
-    return s == ''
+    トークンを1度走査し、括弧の外にテキストが現れたらFalseにする (括弧の対応が取れていない場合もFalse)。
+    コメントはトークンとして読み飛ばすので、事前に除去しておく必要はない。
+
+    Args:
+        content (str): texのテキスト
+        tokens (list, optional): contentを`tokenize`した結果. 無ければここで字句解析する.
+    """
+    tokens = tokens if tokens is not None else tokenize(content)
+    return tex_lexer.is_only_commands(tokens)
@@ -0,0 +1,142 @@
+"""翻訳したチャンクの構造を原文と比べて検証する
+
+コンパイルする前に、プロンプトで求めている条件(コマンド・ラベル・行数を変えない)が守られているかを確かめる。
+LaTeXの文法を解釈するわけではなく、原文と翻訳で変わってはいけないものが一致しているかだけを見る。
+"""
+
+import re
+from collections import Counter
+
+# 翻訳で引数(キー)が変わってはいけないコマンド
+KEY_COMMANDS = ("label", "ref", "eqref", "autoref", "cref", "Cref", "pageref", "nameref",
+                "cite", "citep", "citet", "citealp", "citealt", "citeauthor", "citeyear", "nocite")
+
+_COMMAND = re.compile(r"\\(?:[A-Za-z]+|.)")
+_ESCAPED = re.compile(r"\\[\\{}\[\]%]")
+_ENVIRONMENT = re.compile(r"\\(begin|end)\s*\{([^}]*)\}")
+_KEY_COMMAND = re.compile(r"\\(" + "|".join(KEY_COMMANDS) + r")\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}")
+
+# エラーメッセージに並べる差分の数
+_MAX_REPORTED = 5
+
+class TranslationValidationError(ValueError):
+    """翻訳したチャンクの構造が原文と一致しない
+
+    Attributes:
+        issues (list): 見つかった問題のリスト
+    """
+
+    def __init__(self, issues: list):
+        self.issues = list(issues)
+        super().__init__("; ".join(self.issues))
+
+def _line_count(text: str) -> int:
+    # コードブロックの抽出で前後の空行は落ちるので、数えない
+    return text.strip("\n").count("\n") + 1
+
+def _balance(text: str, open_char: str, close_char: str) -> tuple:
+    """(開き括弧と閉じ括弧の差, 途中で最も深く閉じた位置) を返す。エスケープされた括弧は数えない。"""
+    depth = 0
+    lowest = 0
+    for char in _ESCAPED.sub("", text):
+        if char == open_char:
+            depth += 1
+        elif char == close_char:
+            depth -= 1
+            lowest = min(lowest, depth)
+    return depth, lowest
+
+def _keys(text: str) -> Counter:
+    """{(コマンド, キー): 出現回数}"""
+    keys = Counter()
+    for match in _KEY_COMMAND.finditer(text):
+        for key in match.group(2).split(","):
+            keys[(match.group(1), key.strip())] += 1
+    return keys
+
+def _describe(counter: Counter) -> str:
+    items = sorted(counter.elements())
+    text = ", ".join(str(item) for item in items[:_MAX_REPORTED])
+    return text + (" ..." if len(items) > _MAX_REPORTED else "")
+
+def validate_translation(source: str, translated: str) -> list:
+    """翻訳したチャンクの構造を原文と比べ、問題のリストを返す。
+
+    次のものが原文と一致するかを確かめる。
+    - 行数 (前後の空行を除く)
+    - 中括弧・角括弧の釣り合い
+    - `\\begin`/`\\end`の並び
+    - `\\label`/`\\ref`/`\\cite`などのキー
+    - コマンドの種類と個数
+
+    Args:
+        source (str): 原文のチャンク
+        translated (str): 翻訳したチャンク
+
+    Returns:
+        list: 見つかった問題 (無ければ空)
+    """
+    issues = []
+
+    source_lines, translated_lines = _line_count(source), _line_count(translated)
+    if source_lines != translated_lines:
+        issues.append(f"行数が変わりました ({source_lines} -> {translated_lines})")
+
+    for open_char, close_char in (("{", "}"), ("[", "]")):
+        source_balance = _balance(source, open_char, close_char)
+        translated_balance = _balance(translated, open_char, close_char)
+        if source_balance != translated_balance:
+            issues.append(f"括弧{open_char}{close_char}の釣り合いが変わりました ({source_balance[0]} -> {translated_balance[0]})")
+
+    source_environments = _ENVIRONMENT.findall(source)
+    translated_environments = _ENVIRONMENT.findall(translated)
+    if source_environments != translated_environments:
+        issues.append("環境の\\begin/\\endの並びが変わりました ("
+                      f"{_describe(Counter(source_environments) - Counter(translated_environments)) or '-'} -> "
+                      f"{_describe(Counter(translated_environments) - Counter(source_environments)) or '-'})")
+
+    source_keys, translated_keys = _keys(source), _keys(translated)
+    if source_keys != translated_keys:
+        issues.append(f"ラベル・参照のキーが変わりました (消えたもの: {_describe(source_keys - translated_keys) or '-'}, "
+                      f"増えたもの: {_describe(translated_keys - source_keys) or '-'})")
+
+    source_commands = Counter(_COMMAND.findall(source))
+    translated_commands = Counter(_COMMAND.findall(translated))
+    if source_commands != translated_commands:
+        issues.append(f"コマンドが変わりました (消えたもの: {_describe(source_commands - translated_commands) or '-'}, "
+                      f"増えたもの: {_describe(translated_commands - source_commands) or '-'})")
+
+    return issues
+
+def check_translation(source: str, translated: str):
+    """翻訳したチャンクの構造を原文と比べ、問題があれば例外を送出する。
+
+    Args:
+        source (str): 原文のチャンク
+        translated (str): 翻訳したチャンク
+
+    Raises:
+        TranslationValidationError: 問題が見つかった場合
+    """
+    issues = validate_translation(source, translated)
+    if issues:
+        raise TranslationValidationError(issues)
+
+def align_surrounding_newlines(source: str, translated: str) -> str:
+    """翻訳したチャンクの前後の改行を原文に揃える。
+
+    コードブロックの抽出で前後の改行が落ちるため、そのまま連結すると前後のチャンクと行がつながってしまう。
+
+    Args:
+        source (str): 原文のチャンク
+        translated (str): 翻訳したチャンク
+
+    Returns:
+        str: 前後の改行を原文に揃えたチャンク
+    """
+    body = translated.strip("\n")
+    if not source.strip("\n"):
+        return source
+    leading = source[:len(source) - len(source.lstrip("\n"))]
+    trailing = source[len(source.rstrip("\n")):]
+    return leading + body + trailing
@@ -0,0 +1,214 @@
+"""翻訳結果のキャッシュ"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+# 参照時刻をこの秒数より新しく記録済みのエントリは、参照しても時刻を更新しない (LRUにはこの精度で十分)
+ACCESS_UPDATE_INTERVAL = 10 * 60
+# 参照時刻とカウンタの更新をまとめて書き込む件数と間隔(秒)
+ACCESS_FLUSH_SIZE = 256
+ACCESS_FLUSH_SECONDS = 60
+# 保存している翻訳結果の合計バイト数を記録するstatsの行
+TOTAL_BYTES_STAT = "total_bytes"
+# 保存している翻訳結果の件数を記録するstatsの行
+ENTRY_COUNT_STAT = "entry_count"
+
+class TranslationCache:
+    """チャンクの翻訳結果をSQLiteに保存するキャッシュ
+
+    キーは(モデル名, テンプレート適用後のプロンプト)のハッシュで、プロンプトにはチャンクの本文が含まれる。
+    保存量が`max_bytes`を超えたら、最後に参照された時刻が古いものから削除する(LRU)。
+
+    参照(`get`)では書き込みをしない。参照時刻は`ACCESS_UPDATE_INTERVAL`より古いものだけを記録し、
+    ヒット・ミスのカウンタとともにメモリに溜めて、`put`のときか一定の件数・間隔ごとにまとめて書き込む。
+    合計サイズはstatsの行で管理し、保存のたびに全体を集計しない。
+
+    Attributes:
+        path (Path): SQLiteのファイルパス
+        max_bytes (int): 保存する翻訳結果の合計バイト数の上限
+        hits (int): このインスタンスでのキャッシュヒット数
+        misses (int): このインスタンスでのキャッシュミス数
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 512 * 1024 * 1024, logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            path (Path): SQLiteのファイルパス
+            max_bytes (int, optional): 保存する翻訳結果の合計バイト数の上限. Defaults to 512MiB.
+        """
+        self.path = Path(path)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._logger = logger
+        self._lock = threading.Lock()
+        # まだ書き込んでいない参照時刻 {キー: 時刻} とカウンタ {名前: 加算する値}
+        self._pending_access: dict = {}
+        self._pending_stats: dict = {}
+        self._last_flush = time.monotonic()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # 合計サイズと件数の行が無ければ(古いキャッシュなら)、1度だけ集計して作る
+            self._conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) SELECT ?, COALESCE(SUM(size), 0) FROM entries",
+                (TOTAL_BYTES_STAT,),
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) SELECT ?, COUNT(*) FROM entries",
+                (ENTRY_COUNT_STAT,),
+            )
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        """キャッシュのキーを作成する。
+
+        Args:
+            model (str): モデル名
+            prompt (str): テンプレート適用後のプロンプト
+
+        Returns:
+            str: キー (sha256)
+        """
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(prompt.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str:
+        """キャッシュから翻訳結果を取得する。
+
+        Args:
+            key (str): キー
+
+        Returns:
+            str: 翻訳結果. 見つからなければNone
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._pending_stats["misses"] = self._pending_stats.get("misses", 0) + 1
+            else:
+                self.hits += 1
+                self._pending_stats["hits"] = self._pending_stats.get("hits", 0) + 1
+                now = time.time()
+                if now - row[1] > ACCESS_UPDATE_INTERVAL:
+                    self._pending_access[key] = now
+            if len(self._pending_access) >= ACCESS_FLUSH_SIZE or time.monotonic() - self._last_flush >= ACCESS_FLUSH_SECONDS:
+                with self._conn:
+                    self._flush()
+            return row[0] if row is not None else None
+
+    def put(self, key: str, value: str):
+        """翻訳結果をキャッシュに保存し、上限を超えていれば古いものから削除する。
+
+        Args:
+            key (str): キー
+            value (str): 翻訳結果
+        """
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            self._logger.warning("キャッシュの上限を超えるサイズなので保存しません: %d bytes", size)
+            return
+        with self._lock, self._conn:
+            # 置き換える前のサイズを読んでから書き込むまでの間に、他のプロセスが書き込まないようにする
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._flush()
+            row = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._increment_stat(TOTAL_BYTES_STAT, size - (row[0] if row is not None else 0))
+            if row is None:
+                self._increment_stat(ENTRY_COUNT_STAT)
+            self._evict()
+
+    def _flush(self):
+        """溜めておいた参照時刻とカウンタを書き込む。ロックを取り、トランザクションの中で呼ぶこと。"""
+        if self._pending_access:
+            # 他のプロセスがより新しい時刻を書いていれば戻さない
+            self._conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE key = ? AND last_access < ?",
+                [(accessed_at, key, accessed_at) for key, accessed_at in self._pending_access.items()],
+            )
+        for name, value in self._pending_stats.items():
+            self._increment_stat(name, value)
+        self._pending_access = {}
+        self._pending_stats = {}
+        self._last_flush = time.monotonic()
+
+    def _evict(self):
+        """合計サイズが上限以下になるまで、参照が古いものから削除する。ロックを取った状態で呼ぶこと。"""
+        total = self._conn.execute("SELECT value FROM stats WHERE name = ?", (TOTAL_BYTES_STAT,)).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        freed = 0
+        rows = self._conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall()
+        for key, size in rows:
+            if total - freed <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            freed += size
+            evicted += 1
+        self._increment_stat(TOTAL_BYTES_STAT, -freed)
+        self._increment_stat(ENTRY_COUNT_STAT, -evicted)
+        self._increment_stat("evictions", evicted)
+        self._logger.info("翻訳キャッシュから %d 件を削除しました。(合計 %d bytes)", evicted, total - freed)
+
+    def _increment_stat(self, name: str, value: int = 1):
+        """永続化しているカウンタを加算する。ロックを取った状態で呼ぶこと。"""
+        self._conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+    def stats(self) -> dict:
+        """キャッシュの統計情報を返す。
+
+        Returns:
+            dict: このインスタンスでのhits/missesと、累計のカウンタ、件数、合計サイズ
+        """
+        with self._lock:
+            with self._conn:
+                self._flush()
+            # 件数と合計サイズは書き込みのたびに更新しているstatsの行から読む (エントリ全体を走査しない)
+            totals = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": totals.get("hits", 0),
+            "total_misses": totals.get("misses", 0),
+            "total_evictions": totals.get("evictions", 0),
+            "entries": totals.get(ENTRY_COUNT_STAT, 0),
+            "bytes": totals.get(TOTAL_BYTES_STAT, 0),
+        }
+
+    def close(self):
+        """溜めておいた更新を書き込んで、接続を閉じる。"""
+        with self._lock:
+            with self._conn:
+                self._flush()
+            self._conn.close()
@@ -1,29 +1,467 @@
 """メイン"""
 
+import asyncio
 import logging
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import sys
 from tqdm import tqdm
 from jinja2 import Environment, FileSystemLoader
-from .file_utils import download_arxiv_source, unfreeze_targz, copy_item, find_files_by_ext, find_main_tex, extract_arxiv_id
-from .openai_chat import OpenAIChat
-from .tex_compiler import compile_tex
-from .tex_translator_utils import split_tex_to_chunks, insert_text_after_documentclass, remove_comments, reduce_newlines, is_only_commands, parse_code_blocks
+from .file_utils import download_and_extract_arxiv_source, copy_item, extract_arxiv_id
+from .openai_chat import OpenAIChat, AsyncOpenAIChat, run_coroutine
+from .tex_compiler import compile_tex, preamble_hash, BuildDirLock, evict_build_dirs, DEFAULT_BUILD_CACHE_MAX_BYTES
+from .project_manifest import ProjectManifest, ROLE_TEX
+from .tex_dependencies import resolve_tex_files
+from .tex_lexer import join_tokens
+from .tex_translator_utils import split_tex_to_chunks, insert_text_after_documentclass, preprocess_tex, is_only_commands, parse_code_blocks
+from .tex_validator import TranslationValidationError, check_translation, validate_translation, align_surrounding_newlines
 from .config import TranslatorConfig
+from .translation_cache import TranslationCache
+from .source_store import ArxivSourceStore
+from .metrics import JobMetrics, MAX_REPORTS
+from .workspace import Workspace, WorkspaceManager
+from .compile_repair import CompileRepairer
+from .llm_scheduler import PRIORITY_INTERACTIVE, PRIORITY_NORMAL
 
-def setup_logger():
-    """ロガーのセットアップ"""
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+LOGGER = logging.getLogger(__name__)
 
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
+# チャンク数がこれ以下の小さなジョブは、LLMの呼び出しを優先する
+INTERACTIVE_MAX_CHUNKS = 16
 
-    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-    ch.setFormatter(formatter)
+# 構造の検証に失敗したチャンクを翻訳し直す回数
+MAX_VALIDATION_RETRIES = 2
+# 翻訳し直すときのtemperature (同じ応答が返ってこないように少し上げる)
+RETRY_TEMPERATURE = 0.3
 
-    logger.addHandler(ch)
-    return logger
+def is_skip_chunk(tex_chunk: str) -> bool:
+    """翻訳せずにそのまま残すチャンク(`% skip start`で始まるもの)かどうかを判定する。
+
+    Args:
+        tex_chunk (str): チャンク
+
+    Returns:
+        bool: 翻訳をスキップするならTrue
+    """
+    return "% skip start\n" in tex_chunk
+
+def extract_translation(tex_chunk: str, response: str) -> str:
+    """応答からコードブロックの中身を取り出し、原文と構造が一致するか検証する。
+
+    Args:
+        tex_chunk (str): 原文のチャンク
+        response (str): LLMの応答
+
+    Raises:
+        TranslationValidationError: コードブロックが無いか、構造が原文と一致しない場合
+
+    Returns:
+        str: 翻訳済みのチャンク (前後の改行は原文に揃える)
+    """
+    code_blocks = parse_code_blocks(response)
+    if not code_blocks:
+        raise TranslationValidationError(["応答にコードブロックがありません"])
+    translated_chunk = align_surrounding_newlines(tex_chunk, code_blocks[0]["code"])
+    check_translation(tex_chunk, translated_chunk)
+    return translated_chunk
+
+def translate_chunk(tex_chunk: str,
+                    translator: OpenAIChat,
+                    label: str = None,
+                    max_retries: int = MAX_VALIDATION_RETRIES,
+                    logger: logging.Logger = LOGGER,
+                    ) -> str:
+    """チャンクを1つ翻訳し、コードブロックの中身を取り出す。
+
+    構造の検証(`extract_translation`)に失敗したら、temperatureを上げて`max_retries`回まで翻訳し直す。
+
+    Args:
+        tex_chunk (str): 翻訳するチャンク
+        translator (OpenAIChat): 翻訳用のLLM
+        label (str, optional): ストリーミングの進捗のログに出す名前. Defaults to None.
+        max_retries (int, optional): 検証に失敗したときに翻訳し直す回数. Defaults to MAX_VALIDATION_RETRIES.
+
+    Raises:
+        TranslationValidationError: 翻訳し直しても検証に失敗した場合
+
+    Returns:
+        str: 翻訳済みのチャンク
+    """
+    if is_skip_chunk(tex_chunk):
+        return tex_chunk
+    for attempt in range(max_retries + 1):
+        response = translator(tex_chunk, label=label, temperature=RETRY_TEMPERATURE if attempt else None)
+        try:
+            return extract_translation(tex_chunk, response)
+        except TranslationValidationError as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f"{label or 'チャンク'} の翻訳の検証に失敗したため翻訳し直します ({attempt + 1}/{max_retries}): {e}")
+
+async def translate_chunk_async(tex_chunk: str,
+                                translator: AsyncOpenAIChat,
+                                label: str = None,
+                                max_retries: int = MAX_VALIDATION_RETRIES,
+                                logger: logging.Logger = LOGGER,
+                                ) -> str:
+    """チャンクを1つ非同期に翻訳し、コードブロックの中身を取り出す。`translate_chunk`の非同期版。
+
+    Args:
+        tex_chunk (str): 翻訳するチャンク
+        translator (AsyncOpenAIChat): 翻訳用のLLM
+        label (str, optional): ストリーミングの進捗のログに出す名前. Defaults to None.
+        max_retries (int, optional): 検証に失敗したときに翻訳し直す回数. Defaults to MAX_VALIDATION_RETRIES.
+
+    Raises:
+        TranslationValidationError: 翻訳し直しても検証に失敗した場合
+
+    Returns:
+        str: 翻訳済みのチャンク
+    """
+    if is_skip_chunk(tex_chunk):
+        return tex_chunk
+    for attempt in range(max_retries + 1):
+        response = await translator(tex_chunk, label=label, temperature=RETRY_TEMPERATURE if attempt else None)
+        try:
+            return extract_translation(tex_chunk, response)
+        except TranslationValidationError as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f"{label or 'チャンク'} の翻訳の検証に失敗したため翻訳し直します ({attempt + 1}/{max_retries}): {e}")
+
+def _lookup_cache(tex_chunks: list,
+                  translator: OpenAIChat,
+                  cache: TranslationCache = None,
+                  logger: logging.Logger = LOGGER,
+                  ) -> tuple:
+    """翻訳が必要なチャンクを洗い出し、キャッシュにあるものは埋めておく。
+
+    Args:
+        tex_chunks (list): 翻訳するチャンクのリスト
+        translator (OpenAIChat): 翻訳用のLLM
+        cache (TranslationCache, optional): 翻訳結果のキャッシュ
+
+    Returns:
+        tuple: (翻訳済みのチャンクのリスト(未翻訳のものは原文のまま), APIで翻訳するチャンクの番号のリスト, {番号: キャッシュのキー})
+    """
+    translated_chunks = list(tex_chunks)
+    targets = [j for j, tex_chunk in enumerate(tex_chunks) if not is_skip_chunk(tex_chunk)]
+    keys = {}
+    if cache is None:
+        return translated_chunks, targets, keys
+
+    misses = []
+    for j in targets:
+        keys[j] = cache.make_key(translator.model, translator.render_prompt(tex_chunks[j]))
+        cached = cache.get(keys[j])
+        # 検証を導入する前に保存されたものもあるので、キャッシュも検証する
+        if cached is None or validate_translation(tex_chunks[j], cached):
+            misses.append(j)
+        else:
+            translated_chunks[j] = cached
+    logger.info(f"翻訳キャッシュ: ヒット {len(targets) - len(misses)} 件, ミス {len(misses)} 件")
+    return translated_chunks, misses, keys
+
+def _store_translation(j: int,
+                       tex_chunks: list,
+                       translated_chunks: list,
+                       translated_chunk,
+                       cache: TranslationCache,
+                       keys: dict,
+                       logger: logging.Logger):
+    """翻訳結果を書き込み、キャッシュに保存する。検証に失敗したもの(例外)は原文のまま残し、キャッシュしない。"""
+    if isinstance(translated_chunk, TranslationValidationError):
+        translated_chunks[j] = tex_chunks[j]
+        logger.warning(f"チャンク {j + 1} は翻訳の検証に失敗したため原文のまま残します: {translated_chunk}")
+        return
+    translated_chunks[j] = translated_chunk
+    if cache is not None:
+        cache.put(keys[j], translated_chunk)
+
+async def translate_chunks_async(tex_chunks: list,
+                                 translator: AsyncOpenAIChat,
+                                 max_workers: int = 8,
+                                 cache: TranslationCache = None,
+                                 logger: logging.Logger = LOGGER,
+                                 ) -> list:
+    """チャンクのリストを非同期に並列翻訳する。`translate_chunks`の非同期版。
+
+    Args:
+        tex_chunks (list): 翻訳するチャンクのリスト
+        translator (AsyncOpenAIChat): 翻訳用のLLM
+        max_workers (int, optional): 同時に実行する翻訳リクエストの上限. Defaults to 8.
+        cache (TranslationCache, optional): 翻訳結果のキャッシュ. Defaults to None.
+
+    Returns:
+        list: 翻訳済みのチャンクのリスト
+    """
+    translated_chunks, targets, keys = _lookup_cache(tex_chunks, translator, cache, logger)
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def _translate(j: int):
+        async with semaphore:
+            try:
+                return j, await translate_chunk_async(tex_chunks[j], translator, label=f"チャンク {j + 1}", logger=logger)
+            except TranslationValidationError as e:
+                return j, e
+
+    tasks = [_translate(j) for j in targets]
+    for done, task in enumerate(tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="翻訳中..."), start=1):
+        j, translated_chunk = await task
+        _store_translation(j, tex_chunks, translated_chunks, translated_chunk, cache, keys, logger)
+        logger.info(f"翻訳中 {done}/{len(tasks)} (チャンク {j + 1} が完了)")
+
+    return translated_chunks
+
+def translate_chunks(tex_chunks: list,
+                     translator: OpenAIChat,
+                     max_workers: int = 8,
+                     cache: TranslationCache = None,
+                     logger: logging.Logger = LOGGER,
+                     ) -> list:
+    """チャンクのリストを並列に翻訳する。
+
+    同時にAPIへ投げるリクエスト数は`max_workers`で制限する。
+    戻り値の順序は入力の順序と同じ。
+    `cache`が指定されていれば、APIを呼ぶ前にキャッシュを引き、翻訳できたものは保存する。
+
+    Args:
+        tex_chunks (list): 翻訳するチャンクのリスト
+        translator (OpenAIChat): 翻訳用のLLM
+        max_workers (int, optional): 同時に実行する翻訳リクエストの上限. Defaults to 8.
+        cache (TranslationCache, optional): 翻訳結果のキャッシュ. Defaults to None.
+
+    Returns:
+        list: 翻訳済みのチャンクのリスト
+    """
+    if isinstance(translator, AsyncOpenAIChat):
+        # 共有イベントループ上で実行し、プロセス内の接続プールを使い回す
+        return run_coroutine(translate_chunks_async(tex_chunks, translator,
+                                                    max_workers=max_workers, cache=cache, logger=logger))
+
+    translated_chunks, targets, keys = _lookup_cache(tex_chunks, translator, cache, logger)
+    if not targets:
+        return translated_chunks
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as executor:
+        futures = {executor.submit(translate_chunk, tex_chunks[j], translator, f"チャンク {j + 1}", logger=logger): j
+                   for j in targets}
+        for done, future in enumerate(tqdm(as_completed(futures), total=len(futures), desc="翻訳中..."), start=1):
+            j = futures[future]
+            try:
+                translated_chunk = future.result()
+            except TranslationValidationError as e:
+                translated_chunk = e
+            _store_translation(j, tex_chunks, translated_chunks, translated_chunk, cache, keys, logger)
+            logger.info(f"翻訳中 {done}/{len(futures)} (チャンク {j + 1} が完了)")
+
+    return translated_chunks
+
+def prepare_source(arxiv_id: str,
+                   config: TranslatorConfig,
+                   jinja_env: Environment,
+                   keep_archive: bool = False,
+                   source_store: ArxivSourceStore = None,
+                   workspace: Workspace = None,
+                   metrics: JobMetrics = None,
+                   logger: logging.Logger = LOGGER,
+                   ) -> tuple:
+    """ソースをダウンロード・解凍し、翻訳用の作業ディレクトリに日本語化パッケージを差し込む。
+
+    Args:
+        arxiv_id (str): arxivのid (extract_arxiv_id済みのもの)
+        config (TranslatorConfig): 設定
+        jinja_env (Environment): テンプレートを読み込む環境
+        keep_archive (bool, optional): Trueならダウンロードしたアーカイブも保存する. Defaults to False.
+        source_store (ArxivSourceStore, optional): ソースのストア. Defaults to None.
+        workspace (Workspace, optional): ジョブの作業ディレクトリ. 指定すればその中に展開し、容量の上限を守る.
+            指定がなければ`config.working_dir`に展開する. Defaults to None.
+        metrics (JobMetrics, optional): 計測結果の記録先. Defaults to None.
+
+    Returns:
+        tuple: (翻訳用の作業ディレクトリ, mainのtexファイルのパス, 差し込み後のmainのtexファイルの中身,
+                作業ディレクトリのファイル一覧(ProjectManifest))
+    """
+    metrics = metrics if metrics is not None else JobMetrics(arxiv_id, logger=logger)
+
+    ## ダウンロードしながら解凍
+    with metrics.stage("download") as record:
+        raw_data_path = download_and_extract_arxiv_source(arxiv_id=arxiv_id,
+                                                          output_dir=workspace.path if workspace else config.working_dir,
+                                                          keep_archive=keep_archive,
+                                                          store=source_store,
+                                                          # 展開したソースは翻訳用にもう1つコピーするので、上限の半分まで
+                                                          max_bytes=workspace.remaining_bytes() // 2 if workspace else None,
+                                                          archive_dir=config.working_dir,
+                                                          logger=logger)
+        # ソースの走査はここで1度だけ行い、以降はファイル一覧に問い合わせる
+        manifest = ProjectManifest.build(raw_data_path, logger=logger)
+        record["bytes"] = manifest.total_bytes
+
+    ## 作業場所へのコピー
+    with metrics.stage("copy") as record:
+        tex_dir = raw_data_path.parent/(raw_data_path.name+"-translated")
+        copy_item(src=raw_data_path, dst=tex_dir, overwrite=True, logger=logger)
+        # コピー先も相対パスと内容は同じ
+        manifest = manifest.with_root(tex_dir)
+        record["bytes"] = manifest.total_bytes
+        if workspace is not None:
+            workspace.check_quota("copy")
+
+    ## 日本語パッケージの追加
+    with metrics.stage("preamble"):
+        main_tex_path = manifest.find_main_tex()
+        main_tex_contents = main_tex_path.read_text('utf-8')
+        template = jinja_env.get_template('tex_style_ja.j2')
+        main_tex_contents = insert_text_after_documentclass(content=main_tex_contents,
+                                                            template=template,
+                                                            logger=logger,
+                                                            )
+        main_tex_path.write_text(main_tex_contents, encoding='utf-8')
+        manifest.refresh(main_tex_path)
+    logger.info("日本語化パッケージの差し込みが完了しました。")
+    return tex_dir, main_tex_path, main_tex_contents, manifest
+
+def split_tex_dir(tex_dir: Path,
+                  translator: OpenAIChat,
+                  metrics: JobMetrics = None,
+                  main_tex_path: Path = None,
+                  manifest: ProjectManifest = None,
+                  logger: logging.Logger = LOGGER,
+                  ) -> dict:
+    """mainのtexファイルから読み込まれるtexファイルを文書の順に読み込み、ファイルごとにチャンク分けする。
+
+    どこからも読み込まれないtexファイル(下書きや古い版など)は翻訳しない。
+
+    Args:
+        tex_dir (Path): 翻訳用の作業ディレクトリ
+        translator (OpenAIChat): 翻訳用のLLM (トークン数の計算に使う)
+        metrics (JobMetrics, optional): 計測結果の記録先. Defaults to None.
+        main_tex_path (Path, optional): mainのtexファイル. 指定がなければファイル一覧から選ぶ.
+        manifest (ProjectManifest, optional): 作業ディレクトリのファイル一覧. 指定がなければここで作る.
+
+    Returns:
+        dict: {texファイルのパス: チャンクのリスト}
+    """
+    metrics = metrics if metrics is not None else JobMetrics(str(tex_dir), logger=logger)
+    manifest = manifest if manifest is not None else ProjectManifest.build(tex_dir, logger=logger)
+    main_tex_path = main_tex_path if main_tex_path is not None else manifest.find_main_tex()
+    # 読み込みをたどるときの字句解析の結果を、そのままチャンク分けに使う
+    tokens_by_file = resolve_tex_files(main_tex_path, root_dir=tex_dir, manifest=manifest, logger=logger)
+    tex_file_paths = list(tokens_by_file)
+    manifest.mark_included(tex_file_paths)
+    logger.info(f"{Path(main_tex_path).name} から読み込まれる {len(tex_file_paths)} 個のtexファイルを翻訳します。")
+    unused_paths = manifest.paths(ROLE_TEX)
+    if unused_paths:
+        logger.info("どこからも読み込まれない %d 個のtexファイルは翻訳しません: %s", len(unused_paths),
+                    ", ".join(str(manifest.relative(path)) for path in unused_paths[:5]) + (" ..." if len(unused_paths) > 5 else ""))
+    chunks_by_file = {}
+    with metrics.stage("chunking", files=len(tex_file_paths)) as record:
+        record["bytes"] = 0
+        for i, file_path in enumerate(tex_file_paths, start=1):
+            logger.info(f"processing file: {file_path.name} ({i}/{len(tex_file_paths)})")
+            tex_content = join_tokens(tokens_by_file[file_path])
+            record["bytes"] += len(tex_content.encode('utf-8'))
+            # 字句解析は1度だけ行い、コメントの除去から分割まで同じトークンを使う
+            tex_content, tokens = preprocess_tex(tex_content, tokens=tokens_by_file[file_path], logger=logger)
+            if is_only_commands(tex_content, tokens=tokens):
+                logger.info(f"翻訳をスキップしました: {file_path.name} ({i}/{len(tex_file_paths)})")
+                continue
+            chunks_by_file[file_path] = split_tex_to_chunks(content=tex_content,
+                                                            token_counter=translator.count_text_tokens,
+                                                            overhead_tokens=translator.prompt_overhead_tokens,
+                                                            tokens=tokens,
+                                                            logger=logger)
+        record["chunks"] = sum(len(tex_chunks) for tex_chunks in chunks_by_file.values())
+    return chunks_by_file
+
+def write_translated_chunks(chunks_by_file: dict, translated_all_chunks: list, logger: logging.Logger = LOGGER):
+    """ファイルをまたいで並べた翻訳済みのチャンクを、ファイルごとに元の順序で書き戻す。
+
+    Args:
+        chunks_by_file (dict): {texファイルのパス: チャンクのリスト}
+        translated_all_chunks (list): 全ファイルのチャンクを順に並べたものの翻訳結果
+    """
+    offset = 0
+    for file_path, tex_chunks in chunks_by_file.items():
+        translated_chunks = translated_all_chunks[offset:offset + len(tex_chunks)]
+        offset += len(tex_chunks)
+        Path(file_path).write_text("".join(translated_chunks), encoding='utf-8')
+        logger.info(f"翻訳完了: {Path(file_path).name}")
+
+def compile_and_export(arxiv_id: str,
+                       main_tex_path: Path,
+                       main_tex_contents: str,
+                       config: TranslatorConfig,
+                       workspace: Workspace = None,
+                       metrics: JobMetrics = None,
+                       repairer: CompileRepairer = None,
+                       build_cache_max_bytes: int = DEFAULT_BUILD_CACHE_MAX_BYTES,
+                       logger: logging.Logger = LOGGER,
+                       ) -> Path:
+    """翻訳済みのtexをコンパイルし、PDFを`output_dir`にコピーする。
+
+    `repairer`を指定すると、コンパイルエラーの原因になったチャンクを原文に戻しながらコンパイルし直す。
+    ビルドディレクトリはジョブをまたいで使い回し、合計が`build_cache_max_bytes`を超えたら古いものから削除する。
+
+    Args:
+        arxiv_id (str): arxivのid
+        main_tex_path (Path): mainのtexファイルのパス
+        main_tex_contents (str): mainのtexファイルの中身 (ビルドディレクトリのキーに使う)
+        config (TranslatorConfig): 設定
+        workspace (Workspace, optional): ジョブの作業ディレクトリ. 指定すればその使用量を記録する. Defaults to None.
+        metrics (JobMetrics, optional): 計測結果の記録先. Defaults to None.
+        repairer (CompileRepairer, optional): 翻訳したチャンクを原文に戻すための情報. Defaults to None.
+        build_cache_max_bytes (int, optional): ビルドディレクトリの合計サイズの上限. Defaults to 2GiB.
+
+    Raises:
+        ValueError: PDFが生成されなかった場合
+
+    Returns:
+        Path: 出力したPDFのパス
+    """
+    metrics = metrics if metrics is not None else JobMetrics(arxiv_id, logger=logger)
+
+    ## コンパイル
+    # プリアンブルが同じならビルドディレクトリを使い回し、latexmkに差分だけを処理させる
+    # ジョブをまたいで使い回すので、ジョブの作業ディレクトリ(容量の上限と終了時の削除の対象)の外に置く
+    build_root = Path(config.working_dir) / "latex-build"
+    build_dir = build_root / arxiv_id.replace('/', '_') / preamble_hash(main_tex_contents)[:16]
+    def _compile():
+        return compile_tex(source_file_path=main_tex_path,
+                           build_dir=build_dir,
+                           texmf_var_dir=Path(config.working_dir) / "texmf-var",
+                           lock_build_dir=False,
+                           logger=logger)
+
+    # 修復のためのコンパイルの間に、他のジョブがビルドディレクトリを書き換えないようにロックしておく
+    with metrics.stage("compile") as record, BuildDirLock(build_dir):
+        if repairer is not None:
+            compile_result = repairer.repair(_compile, base_dir=main_tex_path.parent)
+            record["reverted_chunks"] = len(repairer.reverted)
+        else:
+            compile_result = _compile()
+        record["retries"] = max(compile_result.attempts - 1, 0)
+        record["success"] = compile_result.success
+        record["errors"] = len(compile_result.errors)
+        if workspace is not None:
+            record["workspace_bytes"] = workspace.used_bytes()
+    evict_build_dirs(build_root, build_cache_max_bytes, keep=build_dir, logger=logger)
+
+    ## 結果
+    compiled_pdf_path = compile_result.pdf_path
+    if compiled_pdf_path is None:
+        raise ValueError(f"コンパイルに失敗し、PDFが生成されませんでした: {main_tex_path}")
+    if not compile_result.success:
+        logger.warning("コンパイルエラーがありますが、生成されたPDFを出力します: %s", compiled_pdf_path)
+
+    output_path = Path(config.output_dir) / f"{arxiv_id}_ja.pdf"
+
+    with metrics.stage("export") as record:
+        copy_item(src=compiled_pdf_path, dst=output_path, logger=logger)
+        record["bytes"] = output_path.stat().st_size
+
+    return output_path
 
 def translate(arxiv_id: str,
               template_dir = None,
@@ -31,12 +469,56 @@ def translate(arxiv_id: str,
               output_dir: Path = None,
               openai_api_key = None,
               model: str = "gpt-4o",
-              logger: logging.RootLogger = setup_logger()
+              max_workers: int = 8,
+              use_async: bool = False,
+              use_cache: bool = True,
+              cache_max_bytes: int = 512 * 1024 * 1024,
+              keep_archive: bool = False,
+              use_source_store: bool = True,
+              source_store_max_bytes: int = 2 * 1024 * 1024 * 1024,
+              report_path: Path = None,
+              use_workspace: bool = True,
+              workspace_quota_bytes: int = 1024 * 1024 * 1024,
+              use_tmpfs: bool = True,
+              keep_on_failure: bool = False,
+              priority: int = None,
+              use_batch_api: bool = False,
+              base_url: str = None,
+              batch_poll_interval: float = 60,
+              stage_gates: dict = None,
+              stream: bool = False,
+              logger: logging.Logger = LOGGER
               ):
     """翻訳実行
 
     Args:
         arxiv_id (str): arxivのid
+        max_workers (int, optional): 同時に実行する翻訳リクエストの上限. Defaults to 8.
+        use_async (bool, optional): Trueならプロセス内で共有される非同期クライアントで翻訳する。
+            複数のジョブを同じプロセスで実行する場合に接続を使い回せる. Defaults to False.
+        use_cache (bool, optional): Trueなら`working_dir`の翻訳キャッシュを使う. Defaults to True.
+        cache_max_bytes (int, optional): 翻訳キャッシュの合計サイズの上限. Defaults to 512MiB.
+        keep_archive (bool, optional): Trueならダウンロードしたアーカイブも`working_dir`に保存する. Defaults to False.
+        use_source_store (bool, optional): Trueならダウンロードしたソースを`working_dir/sources`に保存して使い回す. Defaults to True.
+        source_store_max_bytes (int, optional): 保存するソースの合計サイズの上限. Defaults to 2GiB.
+        report_path (Path, optional): ステージごとの計測レポート(JSON)の保存先.
+            指定がなければ`working_dir/reports/{arxiv_id}-{時刻}.json`で、新しいものから`metrics.MAX_REPORTS`件だけ残す. Defaults to None.
+        use_workspace (bool, optional): Trueならジョブごとに独立した作業ディレクトリを作り、終了時に削除する.
+            Falseなら従来どおり`working_dir`に`arxiv-{arxiv_id}`等を作って残す. Defaults to True.
+        workspace_quota_bytes (int, optional): ジョブごとの作業ディレクトリの容量の上限. Defaults to 1GiB.
+        use_tmpfs (bool, optional): Trueなら、上限が収まる空きがあるときに作業ディレクトリをtmpfs上に作る. Defaults to True.
+        keep_on_failure (bool, optional): Trueなら失敗したジョブの作業ディレクトリを残す (デバッグ用). Defaults to False.
+        priority (int, optional): LLMの呼び出しの優先度 (`llm_scheduler.PRIORITY_*`). 指定がなければ、
+            チャンク数が`INTERACTIVE_MAX_CHUNKS`以下ならPRIORITY_INTERACTIVE、それ以外はPRIORITY_NORMAL. Defaults to None.
+        use_batch_api (bool, optional): TrueならBatch APIで翻訳する (`batch_api.translate_batch`). 安価だが完了まで最大24時間かかる.
+            中断しても同じ引数で実行し直せば続きから再開する. Defaults to False.
+        base_url (str, optional): Batch APIのURL. ローカルの互換サーバーで試す場合に指定する. Defaults to None.
+        batch_poll_interval (float, optional): Batch APIの状態を確認する間隔(秒). Defaults to 60.
+        stage_gates (dict, optional): {ステージ名: ステージに入る前に取得するコンテキストマネージャー}.
+            ステージ名は"download"・"translation"・"compile". 複数の論文を流すときに、ステージごとの同時実行数を
+            共有のセマフォで制限するのに使う (`bulk.translate_many`). Defaults to None.
+        stream (bool, optional): TrueならLLMの応答をストリーミングで受け取り、チャンクごとの進捗をログに出す.
+            応答が途中で止まった場合も早く検知して再試行できる. Defaults to False.
     """
 
     config = TranslatorConfig.load(logger=logger)
@@ -50,81 +532,117 @@ def translate(arxiv_id: str,
         config.openai_api_key = openai_api_key
     config.show()
 
-    # 前処理
-
-    ## ダウンロード
     arxiv_id = extract_arxiv_id(arxiv_id)
-    targz_path = download_arxiv_source(arxiv_id=arxiv_id, output_dir=config.working_dir, logger=logger)
+    if use_batch_api:
+        from .batch_api import translate_batch
+        output_path = translate_batch([arxiv_id],
+                                      template_dir=config.template_dir,
+                                      working_dir=config.working_dir,
+                                      output_dir=config.output_dir,
+                                      openai_api_key=config.openai_api_key,
+                                      model=model,
+                                      base_url=base_url,
+                                      poll_interval=batch_poll_interval,
+                                      use_cache=use_cache,
+                                      cache_max_bytes=cache_max_bytes,
+                                      use_source_store=use_source_store,
+                                      source_store_max_bytes=source_store_max_bytes,
+                                      workspace_quota_bytes=workspace_quota_bytes,
+                                      keep_on_failure=keep_on_failure,
+                                      logger=logger)[arxiv_id]
+        if output_path is None:
+            raise ValueError(f"Batch APIでの翻訳に失敗しました: {arxiv_id}")
+        return output_path
 
-    ## tarの解凍
-    raw_data_path = unfreeze_targz(targz_path, output_dir=config.working_dir, logger=logger)
+    metrics = JobMetrics(arxiv_id, logger=logger)
+    keep_reports = None
+    if report_path is None:
+        report_path = Path(config.working_dir) / "reports" / f"{arxiv_id.replace('/', '_')}-{int(metrics.started_at)}.json"
+        keep_reports = MAX_REPORTS
 
-    ## 作業場所へのコピー
-    tex_dir = raw_data_path.parent/(raw_data_path.name+"-translated")
-    copy_item(src=raw_data_path, dst=tex_dir, overwrite=True, logger=logger)
+    stage_gates = stage_gates or {}
+    def _gate(stage: str):
+        return stage_gates.get(stage) or nullcontext()
 
+    workspace_manager = None
+    if use_workspace:
+        workspace_manager = WorkspaceManager(Path(config.working_dir) / "jobs",
+                                             quota_bytes=workspace_quota_bytes,
+                                             use_tmpfs=use_tmpfs,
+                                             keep_on_failure=keep_on_failure,
+                                             logger=logger)
+        workspace_manager.cleanup_stale()
 
-    # 本処理
+    try:
+        with (workspace_manager.create(arxiv_id) if workspace_manager else nullcontext()) as workspace:
+            # 前処理
+            source_store = None
+            if use_source_store:
+                source_store = ArxivSourceStore(Path(config.working_dir) / "sources",
+                                                max_bytes=source_store_max_bytes,
+                                                logger=logger)
+            jinja_env = Environment(loader=FileSystemLoader(config.template_dir))
+            with _gate("download"):
+                tex_dir, main_tex_path, main_tex_contents, manifest = prepare_source(arxiv_id, config, jinja_env,
+                                                                                     keep_archive=keep_archive,
+                                                                                     source_store=source_store,
+                                                                                     workspace=workspace,
+                                                                                     metrics=metrics,
+                                                                                     logger=logger)
 
-    ## 翻訳用のLLM
-    jinja_env = Environment(loader=FileSystemLoader(config.template_dir))
-    translator = OpenAIChat(api_key=config.openai_api_key,
-                            model=model,
-                            template=jinja_env.get_template('prompt_en_to_ja.j2'),
-                            logger=logger
-                            )
-    logger.info("翻訳用のLLMとして`%s`を設定しました。", model)
+            # 本処理
 
-    ## 日本語パッケージの追加
-    main_tex_path = find_main_tex(tex_dir)
-    main_tex_contents = main_tex_path.read_text('utf-8')
-    template = jinja_env.get_template('tex_style_ja.j2')
-    main_tex_contents = insert_text_after_documentclass(content=main_tex_contents,
-                                                        template=template,
-                                                        logger=logger,
-                                                        )
-    main_tex_path.write_text(main_tex_contents, encoding='utf-8')
-    logger.info("日本語化パッケージの差し込みが完了しました。")
-    
-    ## テキスト分割
-    tex_file_paths = find_files_by_ext(tex_dir, "tex")
-    logger.info(f"合計 {len(tex_file_paths)} 個のtexファイルが見つかりました。")
-    for i, file_path in enumerate(tex_file_paths, start=1):
-        file_path = Path(file_path)
-        logger.info(f"processing file: {file_path.name} ({i}/{len(tex_file_paths)})")
-        tex_content = file_path.read_text('utf-8')
-        tex_content = remove_comments(tex_content, logger)
-        tex_content = reduce_newlines(tex_content)
-        if is_only_commands(tex_content):
-            logger.info(f"翻訳をスキップしました: {file_path.name} ({i}/{len(tex_file_paths)})")
-            continue
-        else:
-            # テキスト分割
-            tex_chunks = split_tex_to_chunks(content=tex_content,
-                                             token_counter=translator.count_tokens,
-                                             logger=logger)
-            # 翻訳
-            translated_chunks=[]
-            for j, tex_chunk in tqdm(enumerate(tex_chunks, start=1), desc="翻訳中..."):
-                logger.info(f"翻訳中 {j}/{len(tex_chunks)}")
-                if f"% skip start\n" in tex_chunk:
-                    translated_chunks.append(tex_chunk)
-                else:
-                    translated_chunk = translator(tex_chunk)
-                    translated_chunk = parse_code_blocks(translated_chunk)[0]["code"]
-                    translated_chunks.append(translated_chunk)
-            translated_tex_contents = "".join(translated_chunks)
-            file_path.write_text(translated_tex_contents, encoding='utf-8')
-            logger.info(f"翻訳完了: {file_path.name} ({i}/{len(tex_file_paths)})")
+            ## 翻訳用のLLM
+            chat_class = AsyncOpenAIChat if use_async else OpenAIChat
+            translator = chat_class(api_key=config.openai_api_key,
+                                    model=model,
+                                    template=jinja_env.get_template('prompt_en_to_ja.j2'),
+                                    logger=logger,
+                                    metrics=metrics,
+                                    stream=stream,
+                                    )
+            logger.info("翻訳用のLLMとして`%s`を設定しました。", model)
 
-    ## コンパイル
-    compile_tex(source_file_path=main_tex_path, logger=logger)
+            ## テキスト分割
+            chunks_by_file = split_tex_dir(tex_dir, translator, metrics=metrics,
+                                           main_tex_path=main_tex_path, manifest=manifest, logger=logger)
+
+            ## 翻訳
+            # ファイルをまたいで全チャンクをまとめて並列に翻訳し、ファイルごとに元の順序で組み直す。
+            all_chunks = [tex_chunk for tex_chunks in chunks_by_file.values() for tex_chunk in tex_chunks]
+            # 小さなジョブが大きなジョブに待たされないよう、チャンク数で優先度を決める
+            if priority is None:
+                priority = PRIORITY_INTERACTIVE if len(all_chunks) <= INTERACTIVE_MAX_CHUNKS else PRIORITY_NORMAL
+            translator.priority = priority
+            logger.info(f"合計 {len(all_chunks)} 個のチャンクを翻訳します。(同時実行数: {max_workers})")
+            cache = None
+            if use_cache:
+                cache = TranslationCache(Path(config.working_dir) / "translation_cache.sqlite3",
+                                         max_bytes=cache_max_bytes,
+                                         logger=logger)
+            with _gate("translation"), metrics.stage("translation", chunks=len(all_chunks)) as record:
+                try:
+                    translated_all_chunks = translate_chunks(all_chunks, translator,
+                                                             max_workers=max_workers, cache=cache, logger=logger)
+                finally:
+                    if cache is not None:
+                        record["cache"] = cache.stats()
+                        logger.info("翻訳キャッシュ: %s", record["cache"])
+                        cache.close()
+            write_translated_chunks(chunks_by_file, translated_all_chunks, logger=logger)
+
+            ## コンパイル
+            # エラーになったら、原因のチャンクだけを原文に戻してPDFを生成する
+            repairer = CompileRepairer(chunks_by_file, translated_all_chunks, logger=logger)
+            with _gate("compile"):
+                output_path = compile_and_export(arxiv_id, main_tex_path, main_tex_contents, config,
+                                                 workspace=workspace, metrics=metrics, repairer=repairer, logger=logger)
+    except BaseException:
+        metrics.finish("error")
+        raise
+    else:
+        metrics.finish("ok")
+    finally:
+        metrics.save(report_path, keep_latest=keep_reports)
 
-    ## 結果
-    compiled_pdf_path = find_files_by_ext(tex_dir, ext="pdf", single=True)
-    
-    output_path = Path(config.output_dir) / f"{arxiv_id}_ja.pdf"
-    
-    copy_item(src=compiled_pdf_path, dst=output_path, logger=logger)
-    
     return output_path
@@ -0,0 +1,244 @@
+"""Redisのジョブキューから翻訳ジョブを取り出して実行するワーカー"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from .translator import translate
+from .config import TranslatorConfig
+from .job_queue import RedisJobQueue, RedisLogHandler
+from .log_utils import job_logger
+from .metrics import REGISTRY
+from .redis_semaphore import RedisSemaphore
+
+LOGGER = logging.getLogger(__name__)
+
+def _start_metrics_server(port: int, logger: logging.Logger = LOGGER) -> ThreadingHTTPServer:
+    """`/metrics`でPrometheus形式のメトリクスを返すHTTPサーバーを起動する。"""
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("メトリクスを公開しています: http://0.0.0.0:%d/metrics", port)
+    return server
+
+class Worker:
+    """ジョブキューからジョブを取り出して翻訳を実行するワーカー
+
+    1プロセスで`concurrency`個のスレッドがそれぞれジョブを取り出す。
+    実際に翻訳を実行できるジョブの数は、全ワーカーで共有する`RedisSemaphore`で`slot_limit`個に制限する。
+    ワーカーを増やすときは、同じRedisを指定してこのプロセスを増やせばよい。
+
+    Attributes:
+        job_queue (RedisJobQueue): ジョブキュー
+        semaphore (RedisSemaphore): 実行スロットを管理するセマフォ
+        config (TranslatorConfig): 翻訳の設定
+        concurrency (int): このプロセスで同時に処理するジョブ数
+    """
+
+    def __init__(self,
+                 job_queue: RedisJobQueue,
+                 semaphore: RedisSemaphore,
+                 config: TranslatorConfig,
+                 concurrency: int = 1,
+                 worker_id: str = None,
+                 logger: logging.Logger = LOGGER):
+        self.job_queue = job_queue
+        self.semaphore = semaphore
+        self.config = config
+        self.concurrency = int(concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._logger = logger
+        self._stopped = threading.Event()
+
+    def _slot_ids(self) -> list:
+        """スレッドごとのワーカーID (処理中リストはこの単位で持つ)"""
+        return [f"{self.worker_id}-{i}" for i in range(self.concurrency)]
+
+    def _heartbeat(self):
+        """ハートビートを送り、停止した他のワーカーのジョブを回収する。"""
+        interval = self.job_queue.worker_ttl / 3
+        while True:
+            try:
+                for slot_id in self._slot_ids():
+                    self.job_queue.heartbeat(slot_id)
+                self.job_queue.recover_stale_jobs()
+            except Exception as e:
+                self._logger.warning("ハートビートの送信に失敗しました: %s", e)
+            if self._stopped.wait(interval):
+                return
+
+    def _log_handler(self, job_id: str) -> RedisLogHandler:
+        """ジョブのログをRedisに送るハンドラーを作る。"""
+        handler = RedisLogHandler(self.job_queue, job_id)
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        return handler
+
+    def process(self, job_id: str, slot_id: str):
+        """ジョブを1つ実行する。
+
+        Args:
+            job_id (str): ジョブの識別子
+            slot_id (str): 実行するスレッドのワーカーID
+        """
+        job = self.job_queue.get(job_id)
+        if job is None:
+            self._logger.warning("ジョブが見つかりません: %s", job_id)
+            self.job_queue.finish(job_id, slot_id, error="ジョブが見つかりません")
+            return
+
+        arxiv_id = job["arxiv_id"]
+        result = None
+        error = None
+        try:
+            # ログはキュー経由でRedisに送り、終了の通知はキューを出し切った後に送る (ログが終了より後に届かないように)
+            with job_logger(job_id, self._log_handler(job_id)) as logger:
+                result, error = self._run_job(job_id, job, logger)
+        finally:
+            self.job_queue.finish(job_id, slot_id, result=result, error=error)
+
+    def _run_job(self, job_id: str, job: dict, logger: logging.Logger) -> tuple:
+        """ジョブの論文を翻訳する。
+
+        Returns:
+            tuple: (PDFのURL, エラーメッセージ) のどちらか一方がNone
+        """
+        arxiv_id = job["arxiv_id"]
+        result = None
+        error = None
+        lease = None
+        last_position = []
+
+        def on_wait(position, current):
+            # 待ち順が変わったときだけログを出す
+            if last_position[-1:] != [position]:
+                last_position.append(position)
+                logger.info(f"Queue waiting for {arxiv_id} (currently running: {current}, position: {position})")
+
+        try:
+            lease = self.semaphore.acquire(job_id, on_wait=on_wait)
+            logger.info(f"Queue acquired for {arxiv_id} (current running: {self.semaphore.current()})")
+            pdf_path = translate(arxiv_id,
+                                 template_dir   = self.config.template_dir,
+                                 working_dir    = self.config.working_dir,
+                                 output_dir     = self.config.output_dir,
+                                 openai_api_key = self.config.openai_api_key,
+                                 model          = job.get("model") or "gpt-4o",
+                                 use_async      = True,
+                                 logger         = logger,
+                                 # 進捗を/logsに流すため、ジョブの指定がなければストリーミングで受け取る
+                                 **{"stream": True, **job["options"]})
+            if isinstance(pdf_path, Path):
+                result = str(Path("/pdf") / pdf_path.name)
+                logger.info(f"PDF_LINK: {result}")
+            else:
+                error = "PDFが生成されませんでした"
+                logger.error("FAILED.")
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            logger.error(e)
+        finally:
+            if lease is not None:
+                lease.release()
+            logger.info(f"release: {job_id} (arxiv_id: {arxiv_id})")
+        return result, error
+
+    def _run_slot(self, slot_id: str):
+        while not self._stopped.is_set():
+            try:
+                job_id = self.job_queue.dequeue(slot_id, timeout=5)
+            except Exception as e:
+                self._logger.warning("ジョブの取り出しに失敗しました: %s", e)
+                self._stopped.wait(5)
+                continue
+            if job_id is not None:
+                self._logger.info("ジョブを開始します: %s (%s)", job_id, slot_id)
+                self.process(job_id, slot_id)
+
+    def stop(self):
+        """新しいジョブの取り出しをやめる。実行中のジョブは最後まで処理する。"""
+        self._stopped.set()
+
+    def run(self):
+        """ワーカーを起動し、`stop`が呼ばれるまでジョブを処理する。"""
+        self._logger.info("ワーカーを起動します: %s (並列数: %d)", self.worker_id, self.concurrency)
+        heartbeat = threading.Thread(target=self._heartbeat, name="worker-heartbeat", daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self._run_slot, args=(slot_id,), name=slot_id)
+                   for slot_id in self._slot_ids()]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            for slot_id in self._slot_ids():
+                self.job_queue.unregister_worker(slot_id)
+            self._logger.info("ワーカーを停止しました: %s", self.worker_id)
+
+def run_worker(redis_url: str = None,
+               concurrency: int = 1,
+               slot_limit: int = 2,
+               slot_lease_ttl: float = 30,
+               metrics_port: int = None,
+               config: TranslatorConfig = None,
+               logger: logging.Logger = LOGGER):
+    """ワーカーを起動する。SIGINT / SIGTERMで実行中のジョブを終えてから停止する。
+
+    Args:
+        redis_url (str, optional): RedisのURL. 指定がなければ環境変数`REDIS_URL`、それも無ければローカルのRedis.
+        concurrency (int, optional): このプロセスで同時に処理するジョブ数. Defaults to 1.
+        slot_limit (int, optional): 全ワーカーで同時に実行できるジョブ数の上限. Defaults to 2.
+        slot_lease_ttl (float, optional): 実行スロットのリースの有効期限(秒). Defaults to 30.
+        metrics_port (int, optional): 指定すると、このポートでこのワーカーのPrometheus形式のメトリクスを公開する.
+        config (TranslatorConfig, optional): 翻訳の設定. 指定がなければ保存済みの設定を読み込む.
+    """
+    import redis
+
+    redis_url = redis_url or os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+    redis_conn = redis.Redis.from_url(redis_url)
+    config = config or TranslatorConfig.load(logger=logger)
+    job_queue = RedisJobQueue(redis_conn, logger=logger)
+    semaphore = RedisSemaphore(redis_conn,
+                               name="running_slots",
+                               limit=slot_limit,
+                               lease_ttl=slot_lease_ttl,
+                               logger=logger)
+    worker = Worker(job_queue, semaphore, config, concurrency=concurrency, logger=logger)
+
+    # Webアプリの`/metrics`で全ワーカーの合計を出せるよう、Redisにも集計する
+    REGISTRY.attach_redis(redis_conn, key=f"{job_queue.prefix}:metrics")
+    if metrics_port is not None:
+        _start_metrics_server(metrics_port, logger=logger)
+
+    def _handle_signal(signum, frame):
+        logger.info("停止要求を受け取りました。実行中のジョブが終わり次第停止します。")
+        worker.stop()
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+    try:
+        worker.run()
+    finally:
+        # 送っていないメトリクスを送ってから終了する
+        REGISTRY.detach_redis()
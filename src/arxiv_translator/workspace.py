@@ -0,0 +1,198 @@
+"""ジョブごとの作業ディレクトリの管理"""
+
+import logging
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from .file_utils import SourceTooLargeError
+from .metrics import directory_size
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+# tmpfsとして使うディレクトリの候補
+DEFAULT_TMPFS_ROOT = Path("/dev/shm")
+
+# プロセス内で作成中のtmpfs上の作業ディレクトリが予約している容量 {tmpfsのルート: バイト数}
+_TMPFS_RESERVED: dict = {}
+_TMPFS_LOCK = threading.Lock()
+
+# 失敗時に残した作業ディレクトリの目印. これがあるディレクトリは自動で削除しない.
+KEEP_MARKER = ".keep"
+
+class Workspace:
+    """1つのジョブの作業ディレクトリ
+
+    作成中はディレクトリの`.lock`をロックしておき、ロックが外れたもの(プロセスが落ちたもの)は
+    `WorkspaceManager.cleanup_stale`で回収できるようにする。
+
+    Attributes:
+        path (Path): 作業ディレクトリ
+        quota_bytes (int): 作業ディレクトリの容量の上限
+        on_tmpfs (bool): tmpfs上に作成したか
+    """
+
+    def __init__(self, path: Path, quota_bytes: int, on_tmpfs: bool = False, exist_ok: bool = False, logger: logging.Logger = LOGGER):
+        self.path = Path(path)
+        self.quota_bytes = int(quota_bytes)
+        self.on_tmpfs = on_tmpfs
+        self._logger = logger
+        # 再開できる処理(バッチなど)では、前回の作業ディレクトリを開き直す
+        self.path.mkdir(parents=True, exist_ok=exist_ok)
+        (self.path / KEEP_MARKER).unlink(missing_ok=True)
+        self._lock_file = open(self.path / ".lock", "w")
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def used_bytes(self) -> int:
+        """作業ディレクトリの使用量"""
+        return directory_size(self.path)
+
+    def remaining_bytes(self) -> int:
+        """上限までの残り容量"""
+        return max(self.quota_bytes - self.used_bytes(), 0)
+
+    def check_quota(self, stage: str = None):
+        """使用量が上限を超えていないか確認する。
+
+        Args:
+            stage (str, optional): ログに出すステージ名
+
+        Raises:
+            SourceTooLargeError: 上限を超えていた場合
+        """
+        used = self.used_bytes()
+        if used > self.quota_bytes:
+            raise SourceTooLargeError(f"作業ディレクトリの使用量が上限を超えました ({stage}): {used} > {self.quota_bytes} bytes")
+
+    def close(self, keep: bool = False):
+        """ロックを外し、作業ディレクトリを削除する。
+
+        Args:
+            keep (bool, optional): Trueなら削除せずに残す (デバッグ用). Defaults to False.
+        """
+        if keep:
+            (self.path / KEEP_MARKER).touch()
+            self._logger.warning("作業ディレクトリを残しました: %s", self.path)
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        if not keep:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._logger.info("作業ディレクトリを削除しました: %s", self.path)
+
+class WorkspaceManager:
+    """ジョブごとに独立した作業ディレクトリを払い出す。
+
+    - ジョブごとに一意なディレクトリを作るので、同じarxiv_idのジョブが同時に動いても衝突しない。
+    - `quota_bytes`が収まる空きがあればtmpfs上に、無ければ`root`の下に作る。
+    - ジョブが終われば(失敗しても)削除する。`keep_on_failure`なら失敗したときだけ残す。
+
+    Attributes:
+        root (Path): 作業ディレクトリを作るディスク上のディレクトリ
+        tmpfs_root (Path): 作業ディレクトリを作るtmpfs上のディレクトリ. Noneならtmpfsを使わない.
+        quota_bytes (int): ジョブごとの容量の上限
+        keep_on_failure (bool): 失敗したジョブの作業ディレクトリを残すか
+    """
+
+    def __init__(self,
+                 root: Path,
+                 quota_bytes: int = 1024 * 1024 * 1024,
+                 use_tmpfs: bool = True,
+                 tmpfs_root: Path = DEFAULT_TMPFS_ROOT,
+                 keep_on_failure: bool = False,
+                 logger: logging.Logger = LOGGER):
+        """コンストラクタ
+
+        Args:
+            root (Path): 作業ディレクトリを作るディスク上のディレクトリ
+            quota_bytes (int, optional): ジョブごとの容量の上限. Defaults to 1GiB.
+            use_tmpfs (bool, optional): Trueなら収まる場合にtmpfsを使う. Defaults to True.
+            tmpfs_root (Path, optional): tmpfsのディレクトリ. Defaults to /dev/shm.
+            keep_on_failure (bool, optional): 失敗したジョブの作業ディレクトリを残すか. Defaults to False.
+        """
+        self.root = Path(root)
+        self.quota_bytes = int(quota_bytes)
+        self.tmpfs_root = None
+        if use_tmpfs and tmpfs_root is not None and Path(tmpfs_root).is_dir() and os.access(tmpfs_root, os.W_OK):
+            self.tmpfs_root = Path(tmpfs_root) / "arxiv_translator"
+        self.keep_on_failure = keep_on_failure
+        self._logger = logger
+
+    def _reserve_tmpfs(self) -> bool:
+        """tmpfsに`quota_bytes`分の空きがあれば予約する。"""
+        if self.tmpfs_root is None:
+            return False
+        with _TMPFS_LOCK:
+            free = shutil.disk_usage(self.tmpfs_root.parent).free
+            reserved = _TMPFS_RESERVED.get(self.tmpfs_root, 0)
+            if free - reserved < self.quota_bytes:
+                return False
+            _TMPFS_RESERVED[self.tmpfs_root] = reserved + self.quota_bytes
+            return True
+
+    def _unreserve_tmpfs(self):
+        with _TMPFS_LOCK:
+            _TMPFS_RESERVED[self.tmpfs_root] = max(_TMPFS_RESERVED.get(self.tmpfs_root, 0) - self.quota_bytes, 0)
+
+    @contextmanager
+    def create(self, name: str):
+        """ジョブの作業ディレクトリを作成し、終わったら削除する。
+
+        Args:
+            name (str): ディレクトリ名の接頭辞 (arxiv_idなど)
+
+        Yields:
+            Workspace: 作業ディレクトリ
+        """
+        on_tmpfs = self._reserve_tmpfs()
+        base = self.tmpfs_root if on_tmpfs else self.root
+        path = base / f"{name.replace('/', '_')}-{uuid.uuid4().hex[:12]}"
+        try:
+            workspace = Workspace(path, self.quota_bytes, on_tmpfs=on_tmpfs, logger=self._logger)
+        except BaseException:
+            if on_tmpfs:
+                self._unreserve_tmpfs()
+            raise
+        self._logger.info("作業ディレクトリ: %s (%s, 上限 %d bytes)", path, "tmpfs" if on_tmpfs else "disk", self.quota_bytes)
+
+        failed = False
+        try:
+            yield workspace
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            try:
+                workspace.close(keep=failed and self.keep_on_failure)
+            finally:
+                if on_tmpfs:
+                    self._unreserve_tmpfs()
+
+    def cleanup_stale(self):
+        """プロセスが落ちて残った作業ディレクトリを削除する。
+
+        ロックを取得できたもの(使用中でないもの)のうち、失敗時に残したもの以外を削除する。
+        """
+        if fcntl is None:
+            return
+        for base in (self.root, self.tmpfs_root):
+            if base is None or not base.is_dir():
+                continue
+            for path in base.iterdir():
+                lock_path = path / ".lock"
+                if not lock_path.is_file() or (path / KEEP_MARKER).exists():
+                    continue
+                with open(lock_path, "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                    shutil.rmtree(path, ignore_errors=True)
+                self._logger.info("残っていた作業ディレクトリを削除しました: %s", path)
@@ -0,0 +1,27 @@
+from pathlib import Path
+from arxiv_translator.compile_repair import CompileRepairer
+from arxiv_translator.tex_compiler import CompileResult, LatexError
+
+def _fake_compile(tex_path: Path):
+    """原文にもある致命的でないエラーを常に出し、`BROKEN`を含むときだけPDFを生成しないコンパイル"""
+    def compile_fn():
+        errors = [LatexError(message="Undefined control sequence.")]
+        if "BROKEN" in tex_path.read_text(encoding="utf-8"):
+            return CompileResult(success=False, errors=errors)
+        return CompileResult(success=False, pdf_path=tex_path.with_suffix(".pdf"), errors=errors)
+    return compile_fn
+
+def test_bisect_reverts_culprit_in_first_half_despite_harmless_errors(tmp_path):
+    tex_path = tmp_path / "main.tex"
+    tex_chunks = [f"paragraph {index}\n" for index in range(8)]
+    translated = [f"段落 {index}\n" for index in range(8)]
+    translated[1] = "BROKEN\n"
+    repairer = CompileRepairer({tex_path: tex_chunks}, translated)
+
+    result = repairer.repair(_fake_compile(tex_path), tmp_path)
+
+    assert result.pdf_path is not None
+    assert repairer.reverted == {(tex_path.resolve(), 1)}
+    content = tex_path.read_text(encoding="utf-8")
+    assert "paragraph 1\n" in content
+    assert "段落 7\n" in content
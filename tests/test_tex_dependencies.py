@@ -0,0 +1,27 @@
+from arxiv_translator.tex_dependencies import resolve_tex_files
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding="utf-8")
+
+def test_follows_arguments_after_whitespace(tmp_path):
+    _write(tmp_path / "main.tex",
+           "\\documentclass{article}\n\\begin{document}\n"
+           "\\input {intro}\n\\include {chapter}\n\\subimport {parts/} {method}\n\\input{direct}\n"
+           "\\end{document}\n")
+    for name in ("intro.tex", "chapter.tex", "parts/method.tex", "direct.tex"):
+        _write(tmp_path / name, "Text.\n")
+
+    files = resolve_tex_files(tmp_path / "main.tex", root_dir=tmp_path)
+
+    assert [path.relative_to(tmp_path.resolve()).as_posix() for path in files] == \
+        ["main.tex", "intro.tex", "chapter.tex", "parts/method.tex", "direct.tex"]
+
+def test_ignores_commented_input(tmp_path):
+    _write(tmp_path / "main.tex", "\\documentclass{article}\n% \\input {draft}\n\\input intro\n")
+    _write(tmp_path / "draft.tex", "Draft.\n")
+    _write(tmp_path / "intro.tex", "Intro.\n")
+
+    files = resolve_tex_files(tmp_path / "main.tex", root_dir=tmp_path)
+
+    assert [path.name for path in files] == ["main.tex", "intro.tex"]
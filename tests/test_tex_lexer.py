@@ -0,0 +1,39 @@
+from arxiv_translator.tex_lexer import (tokenize, join_tokens, clean_tokens,
+                                       TOKEN_COMMENT, TOKEN_VERBATIM, TOKEN_BEGIN_ENV)
+
+SAMPLE = ("\\documentclass[11pt]{article}\r\n"
+          "\\begin{document}\n"
+          "\\section{Intro} Text with 50\\% and $x^{2}$. % note\n"
+          "% only a comment\n"
+          "\\begin{verbatim}\n100% raw {\n\\end{verbatim}\n"
+          "\\verb|a%b| {\\bf bold [x]} \\\\\n"
+          "\n\n\n"
+          "\\end{document}")
+
+def test_tokenize_round_trip():
+    tokens = tokenize(SAMPLE)
+
+    assert "".join(token.text for token in tokens) == SAMPLE
+    assert all(token.text == SAMPLE[token.start:token.end] for token in tokens)
+    assert [token.name for token in tokens if token.kind == TOKEN_BEGIN_ENV] == ["document"]
+
+def test_comments_and_verbatim():
+    tokens = tokenize(SAMPLE)
+    comments = [token.text for token in tokens if token.kind == TOKEN_COMMENT]
+    verbatims = [token.text for token in tokens if token.kind == TOKEN_VERBATIM]
+
+    assert comments == ["% note", "% only a comment"]
+    assert "\\begin{verbatim}\n100% raw {\n\\end{verbatim}" in verbatims
+    assert "\\verb|a%b|" in verbatims
+
+def test_clean_tokens():
+    cleaned = join_tokens(clean_tokens(tokenize(SAMPLE)))
+
+    # コメントだけの行は改行ごと消え、行末のコメントは消えて、エスケープした%と verbatim の%は残る
+    assert "only a comment" not in cleaned
+    assert "note" not in cleaned
+    assert "50\\% and $x^{2}$. \n\\begin{verbatim}\n100% raw {" in cleaned
+    assert "\\verb|a%b|" in cleaned
+    # 改行は\nにそろえ、連続する空行は1行にまとめる
+    assert "\r" not in cleaned
+    assert "\\\\\n\n\\end{document}" in cleaned
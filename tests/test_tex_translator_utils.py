@@ -0,0 +1,39 @@
+import random
+from arxiv_translator.tex_translator_utils import balanced_partition, _count_chunks
+
+def _greedy_sums(counts, capacity):
+    sums = []
+    for count in counts:
+        if not sums or sums[-1] + count > capacity:
+            sums.append(count)
+        else:
+            sums[-1] += count
+    return sums
+
+def _check_partition(counts, capacity):
+    bounds = balanced_partition(counts, capacity)
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(counts)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(bounds, bounds[1:]))
+    assert all(start < end for start, end in bounds)
+    assert all(sum(counts[start:end]) <= capacity for start, end in bounds)
+    assert len(bounds) == _count_chunks(counts, capacity)
+    return bounds
+
+def test_balances_chunks_without_increasing_count():
+    counts = [4, 4, 4, 4]
+
+    bounds = _check_partition(counts, 12)
+
+    # 貪欲に詰めると12と4になる
+    assert [sum(counts[start:end]) for start, end in bounds] == [8, 8]
+
+def test_random_partitions_respect_bounds():
+    rng = random.Random(0)
+    for _ in range(200):
+        capacity = rng.randint(5, 60)
+        counts = [rng.randint(1, capacity) for _ in range(rng.randint(1, 40))]
+        bounds = _check_partition(counts, capacity)
+        assert max(sum(counts[start:end]) for start, end in bounds) <= max(_greedy_sums(counts, capacity))
+
+def test_empty_counts():
+    assert balanced_partition([], 10) == []
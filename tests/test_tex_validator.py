@@ -0,0 +1,28 @@
+import pytest
+from arxiv_translator.tex_validator import TranslationValidationError, validate_translation, check_translation
+
+SOURCE = ("\\section{Method}\\label{sec:method}\n"
+          "We use \\textbf{attention} as in \\cite{vaswani2017}.\n"
+          "\\begin{equation}\nx = y [1]\n\\end{equation}\n"
+          "See Section~\\ref{sec:intro}.")
+TRANSLATED = ("\\section{手法}\\label{sec:method}\n"
+              "\\cite{vaswani2017}と同様に\\textbf{注意機構}を用いる。\n"
+              "\\begin{equation}\nx = y [1]\n\\end{equation}\n"
+              "\\ref{sec:intro}節を参照。")
+
+def test_accepts_structure_preserving_translation():
+    assert validate_translation(SOURCE, TRANSLATED) == []
+    check_translation(SOURCE, TRANSLATED)
+
+@pytest.mark.parametrize("broken", [
+    TRANSLATED.replace("\\textbf{注意機構}", "\\textbf{注意機構"),                    # 中括弧
+    TRANSLATED.replace("y [1]", "y 1]"),                                            # 角括弧
+    TRANSLATED.replace("\\end{equation}", "\\end{align}"),                          # 環境
+    TRANSLATED.replace("sec:intro", "sec:introduction"),                            # キー
+    TRANSLATED.replace("\\textbf{注意機構}", "\\emph{注意機構}"),                     # コマンド
+    TRANSLATED.replace("を用いる。\n", "を用いる。"),                                  # 行数
+])
+def test_rejects_structural_changes(broken):
+    assert validate_translation(SOURCE, broken)
+    with pytest.raises(TranslationValidationError):
+        check_translation(SOURCE, broken)